@@ -18,10 +18,10 @@ from datetime import datetime
 import pytz # 匯入 pytz
 from huggingface_hub import snapshot_download
 from insightface.app import FaceAnalysis
-import threading
 import queue
 import tempfile
 from pathlib import Path
+import profiler
 
 # 建立必要目錄
 os.makedirs("database", exist_ok=True)
@@ -104,10 +104,12 @@ except Exception as e:
 # 匯入資料庫管理器
 try:
     from database_manager import PostgresFaceDatabase
+    from db_migrations import MigrationError
     print("✅ 載入 PostgreSQL 資料庫管理器")
 except ImportError:
     print("❌ 無法載入 PostgreSQL 模組，使用基本資料庫")
     PostgresFaceDatabase = None
+    MigrationError = None
 
 # 人臉資料庫
 class FaceDatabase:
@@ -118,6 +120,9 @@ class FaceDatabase:
                 self.db = PostgresFaceDatabase()
                 self.use_postgres = True
                 print("✅ 使用 PostgreSQL + pgvector 資料庫")
+            except MigrationError:
+                # 資料庫可連線但結構遷移失敗：中止啟動，不以空的 JSON 資料庫繼續服務
+                raise
             except Exception as e:
                 print(f"⚠️ PostgreSQL 連接失敗: {e}")
                 self._init_json_db()
@@ -543,26 +548,15 @@ def get_database_stats():
     """取得資料庫統計"""
     try:
         if face_db.use_postgres:
-            cursor = face_db.db.conn.cursor()
-            
-            # 用戶統計
-            cursor.execute("SELECT COUNT(*) FROM face_profiles")
-            total_users = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM face_profiles WHERE role = '員工'")
-            employees = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM face_profiles WHERE role = '訪客'")
-            visitors = cursor.fetchone()[0]
-            
-            # 識別統計
-            cursor.execute("SELECT COUNT(*) FROM recognition_logs")
-            total_recognitions = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM recognition_logs WHERE recognition_time > NOW() - INTERVAL '24 hours'")
-            today_recognitions = cursor.fetchone()[0]
+            # 觸發器維護的計數，查詢成本不隨日誌量成長
+            user_stats = face_db.db.get_statistics()
+            total_users = user_stats['total']
+            employees = user_stats['employees']
+            visitors = user_stats['visitors']
             
-            cursor.close()
+            recognition_stats = face_db.db.get_recognition_statistics(hours=24)
+            total_recognitions = recognition_stats['total']
+            today_recognitions = recognition_stats['recent']
             
             stats = f"""📊 資料庫統計
             
@@ -637,6 +631,7 @@ def update_user(person_id, name, role, department, email):
             """, (name, role, department, email, person_id))
             face_db.db.conn.commit()
             cursor.close()
+            face_db.db.profile_cache.invalidate()
             
             return f"用戶 {person_id} 更新成功"
         else:
@@ -663,6 +658,7 @@ def delete_user(person_id):
             cursor.execute("DELETE FROM face_profiles WHERE person_id = %s", (person_id,))
             face_db.db.conn.commit()
             cursor.close()
+            face_db.db.profile_cache.invalidate()
             
             return f"用戶 {person_id} 刪除成功"
         else:
@@ -790,7 +786,8 @@ def clear_logs():
     try:
         if face_db.use_postgres:
             cursor = face_db.db.conn.cursor()
-            cursor.execute("DELETE FROM recognition_logs")
+            # 分區表整批截斷，不逐列刪除
+            cursor.execute("TRUNCATE recognition_logs")
             face_db.db.conn.commit()
             cursor.close()
             return "日誌清除成功"
@@ -804,7 +801,8 @@ def clear_attendance_logs():
     try:
         if face_db.use_postgres:
             cursor = face_db.db.conn.cursor()
-            cursor.execute("DELETE FROM attendance_sessions")
+            # 每日彙總一併清除
+            cursor.execute("TRUNCATE attendance_sessions, attendance_daily_rollups")
             face_db.db.conn.commit()
             cursor.close()
             return "出勤日誌清除成功"
@@ -1085,46 +1083,26 @@ with gr.Blocks(title="AuraFace 智能識別系統") as demo:
                 outputs=api_result
             )
 
-# --- 背景任務：定期結束超時的會話 ---
-def session_cleanup_task():
-    """定期檢查並結束超時的會話"""
-    while True:
-        print("背景任務：正在檢查超時會話...")
-        try:
-            if face_db.use_postgres:
-                # 使用 face_db.db 存取 PostgresFaceDatabase 實例
-                face_db.db.end_timed_out_sessions(timeout_seconds=300) # 5分鐘寬限期
-        except Exception as e:
-            print(f"背景任務出錯: {e}")
-        time.sleep(60) # 每60秒檢查一次
-
 # 啟動背景 FastAPI 服務
 def start_background_api():
-    """在背景執行緒中啟動 FastAPI 服務"""
+    """以子程序啟動 FastAPI 服務（worker 數由 API_WORKERS 設定）"""
     try:
         import subprocess
         import sys
-        # 在背景啟動 FastAPI 服務
-        api_thread = threading.Thread(
-            target=lambda: subprocess.run([sys.executable, "api/standalone_api.py"]), 
-            daemon=True
-        )
-        api_thread.start()
+        subprocess.Popen([sys.executable, "api/standalone_api.py"])
         print("✅ 背景 FastAPI 服務已啟動在端口 7859")
     except Exception as e:
         print(f"❌ 背景 FastAPI 服務啟動失敗: {e}")
 
 if __name__ == "__main__":
-    # 啟動背景任務執行緒
-    # 只有在使用 PostgreSQL 時才啟動背景任務
-    if face_db.use_postgres:
-        cleanup_thread = threading.Thread(target=session_cleanup_task, daemon=True)
-        cleanup_thread.start()
-        print("✅ 已啟動背景會話清理任務。")
+    # 超時會話與臨時訪客由 WebSocket 伺服器的生命週期清理任務統一處理
 
     # 啟動背景 API 服務
     start_background_api()
 
+    # 設定 PROFILER_ADMIN_TOKEN 時啟動本機的取樣分析端點
+    profiler.start_admin_server()
+
     demo.launch(
         server_name="0.0.0.0",
         server_port=7860,
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+WebSocket 廣播中心
+每個連線有自己的有界送出佇列與送出任務，識別流程只把訊息放入佇列即返回，
+速度慢的客戶端不會拖慢識別；廣播訊息依主題訂閱只送給需要的客戶端
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+
+# 可訂閱的廣播主題
+TOPICS = ('results', 'person_detected', 'stats', 'attendance')
+# 只保留最新一則的主題：新訊息覆蓋尚未送出的舊訊息
+COALESCED_TOPICS = ('results', 'stats')
+# 多實例時轉送給其他實例的主題（results、stats 屬於各實例自己的連線與程序）
+RELAYED_TOPICS = ('person_detected', 'attendance')
+# 直接回覆客戶端請求的訊息，不因佇列滿而丟棄
+REPLY = 'reply'
+
+
+class ClientChannel:
+    """單一連線的送出佇列"""
+
+    def __init__(self, hub, websocket, topics):
+        self.hub = hub
+        self.websocket = websocket
+        self.topics = set(topics)
+        self.pending = deque()  # [(主題, 訊息字串或 None)]；合併主題的訊息放在 latest
+        self.latest = {}  # {合併主題: 最新訊息字串}
+        self.wakeup = asyncio.Event()
+        self.lagging_drops = 0  # 上次成功送出後累積丟棄的訊息數
+        self.closing = False
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, topic, message):
+        if self.closing:
+            return
+        if topic in COALESCED_TOPICS:
+            if topic in self.latest:
+                self.latest[topic] = message
+                self.hub.stats['coalesced'] += 1
+                return
+            self.latest[topic] = message
+            self.pending.append((topic, None))
+        else:
+            if len(self.pending) >= self.hub.queue_size:
+                if not self._drop_oldest():
+                    # 佇列中全是回覆訊息，無法再丟棄
+                    self.hub.disconnect(self, 'send queue full')
+                    return
+                if self.closing:
+                    # 丟棄後依落後策略斷線，不再放入
+                    return
+            self.pending.append((topic, message))
+        self.hub.stats['max_queue_depth'] = max(self.hub.stats['max_queue_depth'], len(self.pending))
+        self.wakeup.set()
+
+    def _drop_oldest(self):
+        """丟棄最舊的一則可丟棄訊息（廣播），回傳是否成功"""
+        for index, (topic, _) in enumerate(self.pending):
+            if topic != REPLY and topic not in COALESCED_TOPICS:
+                del self.pending[index]
+                self.hub.stats['dropped'] += 1
+                self.lagging_drops += 1
+                if self.hub.policy == 'disconnect' or self.lagging_drops > self.hub.max_lagging_drops:
+                    self.hub.disconnect(self, 'slow consumer')
+                return True
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.pending:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                topic, message = self.pending.popleft()
+                if message is None:
+                    message = self.latest.pop(topic)
+                start = time.perf_counter()
+                try:
+                    await asyncio.wait_for(self.websocket.send(message), self.hub.send_timeout)
+                except asyncio.TimeoutError:
+                    self.hub.disconnect(self, 'send timeout')
+                    return
+                self.lagging_drops = 0
+                self.hub.stats['delivered'] += 1
+                self.hub.stats['last_send_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # 連線已關閉，由 register() 的 finally 移除
+            self.closing = True
+
+
+class BroadcastHub:
+    """管理所有連線的送出佇列與主題訂閱"""
+
+    def __init__(self, queue_size=None, policy=None, max_lagging_drops=None, send_timeout=None):
+        self.queue_size = queue_size or int(os.getenv('BROADCAST_QUEUE_SIZE', 64))
+        # drop：佇列滿時丟棄最舊的廣播，持續落後才斷線；disconnect：第一次丟棄即斷線
+        self.policy = policy or os.getenv('BROADCAST_SLOW_POLICY', 'drop')
+        self.max_lagging_drops = max_lagging_drops or int(os.getenv('BROADCAST_MAX_LAGGING_DROPS', 256))
+        self.send_timeout = send_timeout or float(os.getenv('BROADCAST_SEND_TIMEOUT', 10))
+        self.channels = {}  # {websocket: ClientChannel}
+        self.relay = None  # 跨實例轉送（coordination.PostgresBroadcastRelay），單一實例時為 None
+        self.stats = {
+            'published': 0,
+            'delivered': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'disconnected': 0,
+            'max_queue_depth': 0,
+            'last_send_ms': 0.0
+        }
+
+    def __len__(self):
+        return len(self.channels)
+
+    def attach(self, websocket, topics=TOPICS):
+        self.channels[websocket] = ClientChannel(self, websocket, topics)
+
+    async def detach(self, websocket):
+        channel = self.channels.pop(websocket, None)
+        if channel:
+            channel.closing = True
+            channel.task.cancel()
+            try:
+                await channel.task
+            except asyncio.CancelledError:
+                pass
+
+    def subscribe(self, websocket, topics):
+        """設定連線訂閱的主題，回傳實際生效的主題"""
+        channel = self.channels.get(websocket)
+        if channel is None:
+            return []
+        channel.topics = {topic for topic in topics if topic in TOPICS}
+        return sorted(channel.topics)
+
+    def send(self, websocket, message, topic=REPLY):
+        """送給單一連線（放入佇列後立即返回）；指定主題時只送給有訂閱的連線"""
+        channel = self.channels.get(websocket)
+        if channel and (topic == REPLY or topic in channel.topics):
+            channel.put(topic, json.dumps(message))
+
+    def has_subscribers(self, topic):
+        return any(topic in channel.topics for channel in self.channels.values())
+
+    def publish(self, topic, message, relay=True):
+        """廣播給訂閱該主題的所有連線，訊息只序列化一次；RELAYED_TOPICS 同時轉送給其他實例"""
+        self.stats['published'] += 1
+        payload = None
+        for channel in list(self.channels.values()):
+            if topic in channel.topics:
+                payload = payload or json.dumps(message)
+                channel.put(topic, payload)
+        if relay and self.relay and topic in RELAYED_TOPICS:
+            self.relay.forward(topic, message)
+
+    def disconnect(self, channel, reason):
+        """關閉落後的連線；佇列不再接收訊息，關閉完成後由 register() 的 finally 清理"""
+        if channel.closing:
+            return
+        channel.closing = True
+        channel.pending.clear()
+        channel.latest.clear()
+        self.stats['disconnected'] += 1
+        print(f"⚠️ 中斷落後的客戶端 ({reason}): {getattr(channel.websocket, 'remote_address', '')}")
+        asyncio.create_task(channel.websocket.close(code=1013, reason=reason))
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'clients': len(self.channels),
+            'queued': sum(len(channel.pending) for channel in self.channels.values()),
+            'relay': self.relay.snapshot() if self.relay else None
+        }
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+出勤變更串流
+每個 API 程序以一條 LISTEN attendance_changes 連線接收通知，每次通知只查詢一次新的變更，
+放入記憶體環形緩衝後喚醒所有訂閱者；訂閱者落後超出緩衝或以 Last-Event-ID 續傳較舊的事件時，
+才單獨向資料庫補讀
+"""
+
+import os
+import asyncio
+from collections import deque
+
+ATTENDANCE_CHANGES_CHANNEL = 'attendance_changes'
+
+CHANGE_QUERY = """
+    SELECT c.id, c.change, c.session_uuid, c.person_id, c.status,
+           c.arrival_time, c.last_seen_at, c.departure_time, c.changed_at,
+           p.name, p.department, p.role
+    FROM attendance_changes c
+    LEFT JOIN face_profiles p ON p.person_id = c.person_id
+    WHERE c.id > $1
+    ORDER BY c.id
+    LIMIT $2
+"""
+
+
+class ResumeTooOld(Exception):
+    """Last-Event-ID 早於保留期限，客戶端需重新載入完整列表"""
+
+
+class AttendanceChangeFeed:
+
+    def __init__(self, database_url, pool, buffer_size=None, fetch_limit=1000, reconnect_delay=5):
+        self.database_url = database_url
+        self.pool = pool
+        self.buffer = deque(maxlen=buffer_size or int(os.getenv('ATTENDANCE_STREAM_BUFFER', 1000)))
+        self.fetch_limit = fetch_limit
+        self.reconnect_delay = reconnect_delay
+        self.last_id = None  # 已讀入緩衝的最大 id（None 表示尚未連線）
+        self.subscribers = 0
+        self.stats = {
+            'notifications': 0,
+            'fetches': 0,
+            'backfills': 0,
+            'events': 0
+        }
+        self._changed = asyncio.Condition()
+        self._notified = asyncio.Event()
+        self._conn = None
+        self._task = None
+        self._closed = False
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        import asyncpg
+        while not self._closed:
+            try:
+                self._conn = await asyncpg.connect(self.database_url)
+                lost = False
+
+                def on_lost(conn):
+                    nonlocal lost
+                    lost = True
+                    self._notified.set()
+
+                self._conn.add_termination_listener(on_lost)
+                await self._conn.add_listener(ATTENDANCE_CHANGES_CHANNEL, self._on_notify)
+                # 先開始監聽再讀取目前位置；重新連線時從上次的位置補讀中斷期間的變更
+                if self.last_id is None:
+                    self.last_id = await self._conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM attendance_changes")
+                self._notified.set()
+                while True:
+                    await self._notified.wait()
+                    self._notified.clear()
+                    if lost:
+                        break
+                    await self._fetch_new()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 出勤變更監聽中斷: {e}")
+            if not self._closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.stats['notifications'] += 1
+        self._notified.set()
+
+    async def _fetch_new(self):
+        """讀取 last_id 之後的變更放入緩衝（同一時間只有一個讀取，通知在讀取期間累積為一次）"""
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(CHANGE_QUERY, self.last_id, self.fetch_limit)
+            self.stats['fetches'] += 1
+            if not rows:
+                return
+            for row in rows:
+                self.buffer.append(dict(row))
+            self.last_id = rows[-1]['id']
+            self.stats['events'] += len(rows)
+            async with self._changed:
+                self._changed.notify_all()
+            if len(rows) < self.fetch_limit:
+                return
+
+    async def _backfill(self, after_id):
+        """向資料庫補讀 after_id 之後、緩衝以前的變更"""
+        self.stats['backfills'] += 1
+        async with self.pool.acquire() as conn:
+            oldest = await conn.fetchval("SELECT MIN(id) FROM attendance_changes")
+            if oldest is not None and after_id + 1 < oldest:
+                raise ResumeTooOld()
+            rows = await conn.fetch(CHANGE_QUERY, after_id, self.fetch_limit)
+        return [dict(row) for row in rows]
+
+    async def events(self, after_id=None, heartbeat=15.0):
+        """
+        產生 after_id 之後的變更；after_id 為 None 時從目前位置開始。
+        超過 heartbeat 秒沒有變更時產生 None，讓呼叫端送出心跳並檢查連線
+        """
+        self.subscribers += 1
+        try:
+            while self.last_id is None:
+                await asyncio.sleep(0.1)
+            cursor = self.last_id if after_id is None else after_id
+            while True:
+                if cursor < self.last_id:
+                    if self.buffer and cursor + 1 >= self.buffer[0]['id']:
+                        batch = [event for event in self.buffer if event['id'] > cursor]
+                    else:
+                        # 落後超出緩衝範圍
+                        batch = await self._backfill(cursor)
+                    for event in batch:
+                        cursor = event['id']
+                        yield event
+                    continue
+                async with self._changed:
+                    try:
+                        await asyncio.wait_for(self._changed.wait_for(lambda: self.last_id > cursor), heartbeat)
+                    except asyncio.TimeoutError:
+                        yield None
+        finally:
+            self.subscribers -= 1
+
+    async def close(self):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._conn and not self._conn.is_closed():
+            await self._conn.close()
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'last_id': self.last_id,
+            'buffered': len(self.buffer),
+            'subscribers': self.subscribers
+        }
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+多實例協調
+多個 websocket_realtime.py 程序同時運作時，以有時效的租約決定由誰執行單一負責者的任務
+（生命週期清理、分區維護）並對跨程序的事件去重；租約到期未續約即可由其他程序接手。
+客戶端連到哪個程序由 SO_REUSEPORT 或 nginx 決定，人員檢測與出勤廣播以 LISTEN/NOTIFY 轉送給其他程序的連線
+"""
+
+import os
+import json
+import time
+import socket
+import uuid
+import asyncio
+from collections import deque
+
+BROADCAST_CHANNEL = 'broadcast_relay'
+# NOTIFY 內容上限為 8000 位元組
+MAX_NOTIFY_PAYLOAD = 7900
+
+
+def instance_id():
+    """本程序在租約中的識別（主機名稱:PID:隨機碼）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class MemoryLeaseStore:
+    """記憶體租約表：單一程序或測試使用，多個實例可傳入同一個 leases dict 模擬共用"""
+
+    def __init__(self, owner=None, leases=None):
+        self.owner = owner or instance_id()
+        self.leases = leases if leases is not None else {}  # {key: (owner, 到期時間)}
+
+    async def try_acquire(self, key, ttl):
+        """取得或續約租約；租約由其他實例持有且未到期時回傳 False"""
+        now = time.monotonic()
+        current = self.leases.get(key)
+        if current and current[0] != self.owner and current[1] > now:
+            return False
+        self.leases[key] = (self.owner, now + ttl)
+        return True
+
+    async def release(self, key):
+        current = self.leases.get(key)
+        if current and current[0] == self.owner:
+            del self.leases[key]
+
+    async def purge_expired(self):
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self.leases.items() if expires_at <= now]
+        for key in expired:
+            del self.leases[key]
+        return len(expired)
+
+
+class PostgresLeaseStore:
+    """以 coordination_leases 資料表（migrations/007）實作的共用租約表"""
+
+    def __init__(self, pool, owner=None):
+        self.pool = pool
+        self.owner = owner or instance_id()
+
+    async def try_acquire(self, key, ttl):
+        # 只有租約不存在、已到期或本來就由自己持有時才會寫入並回傳資料列
+        async with self.pool.acquire() as conn:
+            owner = await conn.fetchval("""
+                INSERT INTO coordination_leases AS l (lease_key, owner, expires_at)
+                VALUES ($1, $2, clock_timestamp() + make_interval(secs => $3))
+                ON CONFLICT (lease_key) DO UPDATE
+                SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+                WHERE l.owner = EXCLUDED.owner OR l.expires_at <= clock_timestamp()
+                RETURNING owner
+            """, key, self.owner, float(ttl))
+        return owner is not None
+
+    async def release(self, key):
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM coordination_leases WHERE lease_key = $1 AND owner = $2", key, self.owner)
+
+    async def purge_expired(self):
+        async with self.pool.acquire() as conn:
+            status = await conn.execute("DELETE FROM coordination_leases WHERE expires_at <= clock_timestamp()")
+        return int(status.split()[-1])
+
+
+def create_lease_store(db):
+    """依 COORDINATION_BACKEND（postgres / memory）建立租約表；資料庫降級為 JSON 時使用記憶體"""
+    backend = os.getenv('COORDINATION_BACKEND', 'postgres').lower()
+    if backend == 'memory' or not db.use_postgres:
+        return MemoryLeaseStore()
+    return PostgresLeaseStore(db.pool)
+
+
+class PostgresBroadcastRelay:
+    """
+    跨實例廣播：本實例發布的 RELAYED_TOPICS 訊息批次以 pg_notify 送出，
+    專用連線 LISTEN 收到其他實例的訊息後發布給本實例的連線（略過自己送出的通知）。
+    中斷期間的訊息不補送（即時通知；出勤狀態以 REST API 或 /api/attendance/stream 為準）
+    """
+
+    def __init__(self, database_url, pool, hub, owner, max_pending=1000, reconnect_delay=5):
+        self.database_url = database_url
+        self.pool = pool
+        self.hub = hub
+        self.owner = owner
+        self.reconnect_delay = reconnect_delay
+        self.pending = deque(maxlen=max_pending)  # 待送出的通知內容
+        self.connected = False
+        self.stats = {
+            'forwarded': 0,
+            'received': 0,
+            'dropped': 0
+        }
+        self._wakeup = asyncio.Event()
+        self._conn = None
+        self._tasks = []
+        self._closed = False
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._send())]
+
+    def forward(self, topic, message):
+        """放入送出佇列後立即返回"""
+        payload = json.dumps({'origin': self.owner, 'topic': topic, 'message': message}, ensure_ascii=False)
+        if len(payload.encode('utf-8')) > MAX_NOTIFY_PAYLOAD:
+            self.stats['dropped'] += 1
+            return
+        if len(self.pending) == self.pending.maxlen:
+            # 佇列已滿（資料庫送出跟不上），最舊的一則被擠出
+            self.stats['dropped'] += 1
+        self.pending.append(payload)
+        self._wakeup.set()
+
+    async def _send(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.pending:
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), 100))]
+                try:
+                    async with self.pool.acquire() as conn:
+                        await conn.execute(
+                            "SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload",
+                            BROADCAST_CHANNEL, batch)
+                    self.stats['forwarded'] += len(batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.stats['dropped'] += len(batch)
+                    print(f"⚠️ 跨實例廣播送出失敗: {e}")
+
+    async def _listen(self):
+        import asyncpg
+        while not self._closed:
+            try:
+                self._conn = await asyncpg.connect(self.database_url)
+                lost = asyncio.Event()
+                self._conn.add_termination_listener(lambda conn: lost.set())
+                await self._conn.add_listener(BROADCAST_CHANNEL, self._on_notify)
+                self.connected = True
+                await lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 跨實例廣播監聽中斷: {e}")
+            self.connected = False
+            if not self._closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if event.get('origin') == self.owner:
+            return
+        self.stats['received'] += 1
+        self.hub.publish(event['topic'], event['message'], relay=False)
+
+    async def close(self):
+        self._closed = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._conn and not self._conn.is_closed():
+            await self._conn.close()
+
+    def snapshot(self):
+        return {**self.stats, 'pending': len(self.pending), 'connected': self.connected}
+
+
+def create_broadcast_relay(db, hub, owner):
+    """COORDINATION_BACKEND=postgres 且使用資料庫時建立跨實例廣播轉送（與租約相同：memory 表示單一程序）"""
+    backend = os.getenv('COORDINATION_BACKEND', 'postgres').lower()
+    if backend == 'memory' or not db.use_postgres:
+        return None
+    return PostgresBroadcastRelay(db.database_url, db.pool, hub, owner)
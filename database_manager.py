@@ -12,6 +12,9 @@ import json
 from datetime import datetime
 import pytz
 from pgvector.psycopg2 import register_vector
+from db_migrations import apply_migrations
+from pagination import encode_cursor, decode_cursor
+from profile_cache import get_sync_profile_cache
 
 class PostgresFaceDatabase:
     def __init__(self, database_url=None):
@@ -21,6 +24,7 @@ class PostgresFaceDatabase:
         
         self.database_url = database_url
         self.conn = None
+        self.profile_cache = None
         self.connect()
     
     def connect(self):
@@ -28,11 +32,15 @@ class PostgresFaceDatabase:
         try:
             self.conn = psycopg2.connect(self.database_url)
             register_vector(self.conn)
-            print("✅ PostgreSQL 連接成功")
         except Exception as e:
             print(f"❌ PostgreSQL 連接失敗: {e}")
             # 降級到 JSON 資料庫
             return self._fallback_to_json()
+        self.use_postgres = True
+        print("✅ PostgreSQL 連接成功")
+        # 遷移失敗時拋出 MigrationError 中止啟動，不降級為空的 JSON 資料庫
+        apply_migrations(self.conn)
+        self.profile_cache = get_sync_profile_cache(self.database_url)
     
     def _fallback_to_json(self):
         """降級到 JSON 檔案資料庫"""
@@ -115,6 +123,7 @@ class PostgresFaceDatabase:
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
                 """, (person_id, employee_id, name, role, department, email, embedding.tolist()))
                 self.conn.commit()
+            self.profile_cache.invalidate()
             
             return True, f"成功註冊 {name}（ID: {person_id}）"
             
@@ -186,6 +195,11 @@ class PostgresFaceDatabase:
             if hasattr(self, 'use_postgres') and not self.use_postgres:
                 return self.faces.get(person_id)
             
+            hit, person = self.profile_cache.get_person(person_id)
+            if hit:
+                return person
+            version = self.profile_cache.version()
+            
             with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute("""
                     SELECT person_id, employee_id, name, role, department, email, register_time, face_embedding
@@ -195,7 +209,7 @@ class PostgresFaceDatabase:
                 
                 row = cursor.fetchone()
                 if row:
-                    return {
+                    person = {
                         'person_id': row['person_id'],
                         'employee_id': row['employee_id'] or '',
                         'name': row['name'],
@@ -205,6 +219,8 @@ class PostgresFaceDatabase:
                         'register_time': row['register_time'],
                         'embedding': row['face_embedding']
                     }
+                    self.profile_cache.store_person(version, person_id, person)
+                    return dict(person)
                 return None
                 
         except Exception as e:
@@ -223,6 +239,11 @@ class PostgresFaceDatabase:
             if hasattr(self, 'use_postgres') and not self.use_postgres:
                 return self.faces
             
+            cached = self.profile_cache.get_profiles()
+            if cached is not None:
+                return dict(cached)
+            version = self.profile_cache.version()
+            
             with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute("""
                     SELECT person_id, employee_id, name, role, department, email, register_time
@@ -241,24 +262,61 @@ class PostgresFaceDatabase:
                         'register_time': row['register_time'].isoformat() if row['register_time'] else ''
                     }
                 
-                return results
+                self.profile_cache.store_profiles(version, results)
+                return dict(results)
             
         except Exception as e:
             print(f"查詢錯誤: {e}")
             return {}
     
     def get_statistics(self):
-        """取得資料庫統計"""
-        all_faces = self.get_all_faces()
-        total_faces = len(all_faces)
-        employees = sum(1 for info in all_faces.values() if info['role'] == '員工')
-        visitors = total_faces - employees
+        """取得資料庫統計（PostgreSQL 模式讀取觸發器維護的計數）"""
+        if hasattr(self, 'use_postgres') and not self.use_postgres:
+            all_faces = self.get_all_faces()
+            total_faces = len(all_faces)
+            employees = sum(1 for info in all_faces.values() if info['role'] == '員工')
+            return {
+                'total': total_faces,
+                'employees': employees,
+                'visitors': total_faces - employees
+            }
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SELECT counter, value FROM stats_counters WHERE counter LIKE 'face_profiles%'")
+                counters = dict(cursor.fetchall())
+            self.conn.commit()
+        except Exception as e:
+            print(f"查詢統計錯誤: {e}")
+            self.conn.rollback()
+            counters = {}
         
+        total_faces = counters.get('face_profiles', 0)
+        employees = counters.get('face_profiles:role:員工', 0)
         return {
             'total': total_faces,
             'employees': employees,
-            'visitors': visitors
+            'visitors': total_faces - employees
         }
+    
+    def get_recognition_statistics(self, hours=24):
+        """識別次數統計：總數與最近 hours 小時內的次數（小時彙總＋起點不完整的一小時）"""
+        if hasattr(self, 'use_postgres') and not self.use_postgres:
+            return {'total': 0, 'recent': 0}
+        
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT COALESCE((SELECT value FROM stats_counters WHERE counter = 'recognition_logs'), 0),
+                           count_recognitions_since((NOW() - make_interval(hours => %s))::timestamp)
+                """, (hours,))
+                total, recent = cursor.fetchone()
+            self.conn.commit()
+            return {'total': total, 'recent': recent}
+        except Exception as e:
+            print(f"查詢識別統計錯誤: {e}")
+            self.conn.rollback()
+            return {'total': 0, 'recent': 0}
 
     def update_face(self, person_id, name, employee_id, role, department, email=None):
         """更新現有人臉資料"""
@@ -283,6 +341,7 @@ class PostgresFaceDatabase:
                     WHERE person_id = %s
                 """, (name, employee_id, role, department, email, person_id))
                 self.conn.commit()
+                self.profile_cache.invalidate()
                 if cursor.rowcount == 0:
                     return False, f"找不到 ID 為 {person_id} 的人員"
             return True, f"成功更新 ID {person_id} 的資料"
@@ -309,6 +368,7 @@ class PostgresFaceDatabase:
                 cursor.execute("DELETE FROM recognition_logs WHERE person_id = %s", (person_id,))
                 cursor.execute("DELETE FROM face_profiles WHERE person_id = %s", (person_id,))
                 self.conn.commit()
+                self.profile_cache.invalidate()
                 if cursor.rowcount == 0:
                     return False, f"找不到 ID 為 {person_id} 的人員"
             return True, f"成功刪除 ID {person_id} 及其相關日誌和會話"
@@ -335,7 +395,11 @@ class PostgresFaceDatabase:
             print(f"日誌記錄錯誤: {e}")
 
     def log_attendance(self, person_id):
-        """記錄或更新一個出勤會話"""
+        """
+        記錄或更新一個出勤會話
+        以 (person_id) WHERE status='active' 部分唯一索引做單一 UPSERT，
+        回傳 {'session_uuid', 'is_new'}，is_new 表示本次為新進場
+        """
         try:
             if hasattr(self, 'use_postgres') and not self.use_postgres:
                 return  # JSON 模式不支援此功能
@@ -343,32 +407,19 @@ class PostgresFaceDatabase:
             taipei_tz = pytz.timezone('Asia/Taipei')
             now = datetime.now(taipei_tz)
             
+            import uuid
             with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                # 檢查是否有正在進行的會話
+                # 已有活躍會話時只更新 last_seen_at，否則建立新會話
                 cursor.execute("""
-                    SELECT session_uuid FROM attendance_sessions
-                    WHERE person_id = %s AND status = 'active'
-                """, (person_id,))
-                active_session = cursor.fetchone()
-
-                if active_session:
-                    # 如果有，只更新 last_seen_at
-                    cursor.execute("""
-                        UPDATE attendance_sessions
-                        SET last_seen_at = %s
-                        WHERE session_uuid = %s
-                    """, (now, active_session['session_uuid']))
-                    session_uuid = active_session['session_uuid']
-                else:
-                    # 如果沒有，則創建新會話
-                    import uuid
-                    session_uuid = str(uuid.uuid4())
-                    cursor.execute("""
-                        INSERT INTO attendance_sessions (session_uuid, person_id, arrival_time, last_seen_at, status)
-                        VALUES (%s, %s, %s, %s, 'active')
-                    """, (session_uuid, person_id, now, now))
+                    INSERT INTO attendance_sessions (session_uuid, person_id, arrival_time, last_seen_at, status)
+                    VALUES (%s, %s, %s, %s, 'active')
+                    ON CONFLICT (person_id) WHERE status = 'active'
+                    DO UPDATE SET last_seen_at = EXCLUDED.last_seen_at
+                    RETURNING session_uuid, (xmax = 0) AS is_new
+                """, (str(uuid.uuid4()), person_id, now, now))
+                result = cursor.fetchone()
                 self.conn.commit()
-                return session_uuid
+                return dict(result)
         except Exception as e:
             print(f"出勤記錄錯誤: {e}")
             import traceback
@@ -436,49 +487,45 @@ class PostgresFaceDatabase:
             print(f"查詢最近出勤錯誤: {e}")
             return []
 
-    def get_attendance_history(self, person_id=None, days=7):
-        """取得出勤歷史記錄"""
+    def get_attendance_history(self, person_id=None, days=7, limit=None, cursor=None):
+        """
+        取得出勤歷史記錄（依最後出現時間由新到舊）
+        指定 limit 時分頁取回，每筆附帶 cursor，以最後一筆的 cursor 取下一頁
+        """
+        after = decode_cursor(cursor) if cursor else None
         try:
             if hasattr(self, 'use_postgres') and not self.use_postgres:
                 return []
             
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-                if person_id:
-                    cursor.execute("""
-                        SELECT 
-                            a.session_uuid,
-                            a.person_id,
-                            f.name,
-                            a.arrival_time,
-                            a.last_seen_at,
-                            a.departure_time,
-                            a.status,
-                            EXTRACT(EPOCH FROM (COALESCE(a.departure_time, a.last_seen_at) - a.arrival_time))/60 as duration_minutes
-                        FROM attendance_sessions a
-                        JOIN face_profiles f ON a.person_id = f.person_id
-                        WHERE a.person_id = %s 
-                        AND a.arrival_time >= NOW() - INTERVAL '%s days'
-                        ORDER BY a.arrival_time DESC
-                    """, (person_id, days))
-                else:
-                    cursor.execute("""
-                        SELECT 
-                            a.session_uuid,
-                            a.person_id,
-                            f.name,
-                            a.arrival_time,
-                            a.last_seen_at,
-                            a.departure_time,
-                            a.status,
-                            EXTRACT(EPOCH FROM (COALESCE(a.departure_time, a.last_seen_at) - a.arrival_time))/60 as duration_minutes
-                        FROM attendance_sessions a
-                        JOIN face_profiles f ON a.person_id = f.person_id
-                        WHERE a.arrival_time >= NOW() - INTERVAL '%s days'
-                        ORDER BY a.arrival_time DESC
-                    """, (days,))
+            with self.conn.cursor(cursor_factory=RealDictCursor) as db_cursor:
+                db_cursor.execute("""
+                    SELECT 
+                        a.id,
+                        a.session_uuid,
+                        a.person_id,
+                        f.name,
+                        a.arrival_time,
+                        a.last_seen_at,
+                        a.departure_time,
+                        a.status,
+                        EXTRACT(EPOCH FROM (COALESCE(a.departure_time, a.last_seen_at) - a.arrival_time))/60 as duration_minutes
+                    FROM attendance_sessions a
+                    JOIN face_profiles f ON a.person_id = f.person_id
+                    WHERE (%(person_id)s::varchar IS NULL OR a.person_id = %(person_id)s)
+                    AND a.arrival_time >= NOW() - make_interval(days => %(days)s)
+                    AND (%(after_ts)s::timestamp IS NULL OR (a.last_seen_at, a.id) < (%(after_ts)s, %(after_id)s))
+                    ORDER BY a.last_seen_at DESC, a.id DESC
+                    LIMIT %(limit)s
+                """, {
+                    'person_id': person_id,
+                    'days': days,
+                    'after_ts': after[0] if after else None,
+                    'after_id': after[1] if after else None,
+                    'limit': limit
+                })
                 
                 results = []
-                for row in cursor.fetchall():
+                for row in db_cursor.fetchall():
                     results.append({
                         'session_uuid': row['session_uuid'],
                         'person_id': row['person_id'],
@@ -487,7 +534,8 @@ class PostgresFaceDatabase:
                         'last_seen_at': row['last_seen_at'],
                         'departure_time': row['departure_time'],
                         'status': row['status'],
-                        'duration_minutes': float(row['duration_minutes']) if row['duration_minutes'] else 0
+                        'duration_minutes': float(row['duration_minutes']) if row['duration_minutes'] else 0,
+                        'cursor': encode_cursor(row['last_seen_at'], row['id'])
                     })
                 return results
                 
@@ -496,31 +544,48 @@ class PostgresFaceDatabase:
             return []
 
     def get_attendance_summary(self, person_id):
-        """取得某人的出勤統計摘要"""
+        """取得某人的出勤統計摘要（讀取每日彙總表，僅活躍會話即時計算）"""
         try:
             if hasattr(self, 'use_postgres') and not self.use_postgres:
                 return {}
             
             with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
                 cursor.execute("""
+                    WITH daily AS (
+                        SELECT 
+                            SUM(session_count) as total_sessions,
+                            MIN(first_arrival) as first_seen,
+                            MAX(last_departure) as last_departure,
+                            SUM(active_sessions) as active_sessions,
+                            SUM(presence_seconds) as presence_seconds,
+                            COUNT(*) as unique_days
+                        FROM attendance_daily_rollups
+                        WHERE person_id = %s
+                    ), active AS (
+                        SELECT 
+                            MAX(last_seen_at) as last_seen_at,
+                            SUM(EXTRACT(EPOCH FROM (last_seen_at - arrival_time))) as presence_seconds
+                        FROM attendance_sessions
+                        WHERE person_id = %s AND status = 'active'
+                    )
                     SELECT 
-                        COUNT(*) as total_sessions,
-                        MIN(arrival_time) as first_seen,
-                        MAX(last_seen_at) as last_seen,
-                        SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END) as active_sessions,
-                        AVG(EXTRACT(EPOCH FROM (COALESCE(departure_time, last_seen_at) - arrival_time))/60) as avg_duration_minutes,
-                        COUNT(DISTINCT DATE(arrival_time)) as unique_days
-                    FROM attendance_sessions
-                    WHERE person_id = %s
-                """, (person_id,))
+                        daily.total_sessions,
+                        daily.first_seen,
+                        GREATEST(daily.last_departure, active.last_seen_at) as last_seen,
+                        daily.active_sessions,
+                        (daily.presence_seconds + COALESCE(active.presence_seconds, 0))
+                            / NULLIF(daily.total_sessions, 0) / 60 as avg_duration_minutes,
+                        daily.unique_days
+                    FROM daily, active
+                """, (person_id, person_id))
                 
                 row = cursor.fetchone()
-                if row:
+                if row and row['total_sessions']:
                     return {
-                        'total_sessions': row['total_sessions'],
+                        'total_sessions': int(row['total_sessions']),
                         'first_seen': row['first_seen'],
                         'last_seen': row['last_seen'],
-                        'active_sessions': row['active_sessions'],
+                        'active_sessions': int(row['active_sessions']),
                         'avg_duration_minutes': float(row['avg_duration_minutes']) if row['avg_duration_minutes'] else 0,
                         'unique_days': row['unique_days']
                     }
@@ -530,6 +595,34 @@ class PostgresFaceDatabase:
             print(f"查詢出勤統計錯誤: {e}")
             return {}
 
+    def rebuild_attendance_rollups(self):
+        """以完整出勤歷史重建每日彙總表，回傳彙總列數"""
+        if hasattr(self, 'use_postgres') and not self.use_postgres:
+            return 0
+
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SELECT rebuild_attendance_daily_rollups()")
+                row_count = cursor.fetchone()[0]
+            self.conn.commit()
+            return row_count
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def rebuild_stats_counters(self):
+        """以現有人員與識別日誌重建統計計數"""
+        if hasattr(self, 'use_postgres') and not self.use_postgres:
+            return
+
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SELECT rebuild_stats_counters()")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
     def get_current_session(self, person_id):
         """取得指定人員的當前session信息"""
         try:
@@ -636,4 +729,17 @@ def test_database():
     db.close()
 
 if __name__ == "__main__":
-    test_database()
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-rollups":
+        # 回填/校正出勤每日彙總：python database_manager.py rebuild-rollups
+        db = PostgresFaceDatabase()
+        print(f"✅ 已重建出勤每日彙總，共 {db.rebuild_attendance_rollups()} 列")
+        db.close()
+    elif len(sys.argv) > 1 and sys.argv[1] == "rebuild-counters":
+        # 校正統計計數：python database_manager.py rebuild-counters
+        db = PostgresFaceDatabase()
+        db.rebuild_stats_counters()
+        print(f"✅ 已重建統計計數: {db.get_statistics()} {db.get_recognition_statistics()}")
+        db.close()
+    else:
+        test_database()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+記憶體內的人臉向量索引
+以連續的 embedding 矩陣保存少量近期人臉，每列的附帶資料放在平行的 numpy 陣列，
+相似度比對以一次矩陣乘法完成，刪除時以最後一列補位保持矩陣連續
+"""
+
+import numpy as np
+
+
+def normalize(embedding):
+    """轉為 float32 單位向量"""
+    vector = np.asarray(embedding, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingRows:
+    """{鍵 → 列} 的 embedding 矩陣，子類別以 _columns 宣告平行陣列 {名稱: (每列形狀, dtype, 初始值)}"""
+
+    _columns = {}
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.embeddings = None  # (capacity, dim) float32，前 len(self) 列有效
+        self.keys = []
+        self.rows = {}  # {鍵: 列索引}
+        for name, (shape, dtype, fill) in self._columns.items():
+            setattr(self, name, np.full((capacity,) + shape, fill, dtype=dtype))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def _add_row(self, key, vector):
+        if self.embeddings is None:
+            self.embeddings = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+        if len(self.keys) == self.capacity:
+            self._grow()
+        row = len(self.keys)
+        self.rows[key] = row
+        self.keys.append(key)
+        self.embeddings[row] = vector
+        for name, (shape, dtype, fill) in self._columns.items():
+            getattr(self, name)[row] = fill
+        return row
+
+    def _similarities(self, embedding):
+        """與所有有效列的內積"""
+        return self.embeddings[:len(self.keys)] @ np.asarray(embedding, dtype=np.float32).ravel()
+
+    def remove(self, key):
+        row = self.rows.get(key)
+        if row is not None:
+            self._remove_row(row)
+
+    def _remove_rows(self, rows):
+        """一次移除多列：由後往前移除，補位的列一定是未被選中或已處理過的列"""
+        for row in np.sort(np.asarray(rows, dtype=np.int64))[::-1]:
+            self._remove_row(int(row))
+
+    def _remove_row(self, row):
+        last = len(self.keys) - 1
+        del self.rows[self.keys[row]]
+        if row != last:
+            # 最後一列移到被刪除的位置
+            self.embeddings[row] = self.embeddings[last]
+            for name in self._columns:
+                column = getattr(self, name)
+                column[row] = column[last]
+            self.keys[row] = self.keys[last]
+            self.rows[self.keys[row]] = row
+        self.keys.pop()
+        return last
+
+    def _grow(self):
+        size = len(self.keys)
+        self.capacity *= 2
+        embeddings = np.zeros((self.capacity, self.embeddings.shape[1]), dtype=np.float32)
+        embeddings[:size] = self.embeddings[:size]
+        self.embeddings = embeddings
+        for name, (shape, dtype, fill) in self._columns.items():
+            column = np.full((self.capacity,) + shape, fill, dtype=dtype)
+            column[:size] = getattr(self, name)[:size]
+            setattr(self, name, column)
+
+
+class RecentEmbeddingMatrix(EmbeddingRows):
+    """近期成功識別人員的 embedding 矩陣：{person_id → 列}，每列附帶名稱與最後識別時間"""
+
+    _columns = {'times': ((), np.float64, 0.0)}
+
+    def __init__(self, capacity=64):
+        super().__init__(capacity)
+        self.names = []
+
+    def put(self, person_id, name, embedding, recognized_time):
+        """加入或更新一位人員（embedding 只在加入時正規化一次）"""
+        vector = normalize(embedding)
+        row = self.rows.get(person_id)
+        if row is None:
+            row = self._add_row(person_id, vector)
+            self.names.append(name)
+        else:
+            self.embeddings[row] = vector
+            self.names[row] = name
+        self.times[row] = recognized_time
+
+    def touch(self, person_id, recognized_time):
+        """更新最後識別時間，人員不在矩陣中時回傳 False"""
+        row = self.rows.get(person_id)
+        if row is None:
+            return False
+        self.times[row] = recognized_time
+        return True
+
+    def best_match(self, embedding, since):
+        """
+        在 since 之後識別過的人員中找出最相似者，回傳 (person_id, name, similarity)；
+        沒有符合時間條件的人員時回傳 None
+        """
+        size = len(self.keys)
+        if size == 0:
+            return None
+        recent = np.flatnonzero(self.times[:size] > since)
+        if recent.size == 0:
+            return None
+        similarities = self.embeddings[recent] @ normalize(embedding)
+        best = int(np.argmax(similarities))
+        row = int(recent[best])
+        return self.keys[row], self.names[row], float(similarities[best])
+
+    def prune(self, before):
+        """移除最後識別時間不晚於 before 的人員，回傳移除數量"""
+        expired = np.flatnonzero(self.times[:len(self.keys)] <= before)
+        self._remove_rows(expired)
+        return int(expired.size)
+
+    def _remove_row(self, row):
+        last = super()._remove_row(row)
+        self.names[row] = self.names[last]
+        self.names.pop()
+        return last
+
+
+class SimHashIndex(EmbeddingRows):
+    """
+    多表隨機超平面 LSH（SimHash）：每張表取 bits 個超平面的正負號組成桶號，
+    查詢只以矩陣精確比對與查詢向量落在任一相同桶中的列。
+    夾角為 θ 的兩個向量在一張表同桶的機率為 (1 - θ/π)^bits，表越多召回越高、位元越多候選越少
+    """
+
+    def __init__(self, tables=64, bits=10, seed=20240601, capacity=64):
+        self.tables = tables
+        self.bits = bits
+        self.seed = seed
+        self.planes = None  # (tables * bits, dim)
+        self.weights = 1 << np.arange(bits, dtype=np.int64)
+        self.buckets = [{} for _ in range(tables)]  # 每張表 {桶號: set(列索引)}
+        self._columns = {'codes': ((tables,), np.int64, 0)}  # 每列在各表的桶號
+        self.stats = {
+            'queries': 0,
+            'candidates': 0,
+            'hits': 0
+        }
+        super().__init__(capacity)
+
+    def _codes(self, vector):
+        if self.planes is None:
+            rng = np.random.default_rng(self.seed)
+            self.planes = rng.standard_normal((self.tables * self.bits, vector.shape[0])).astype(np.float32)
+        signs = (self.planes @ vector > 0).reshape(self.tables, self.bits)
+        return signs @ self.weights
+
+    def add(self, key, embedding):
+        """加入或取代一列"""
+        self.remove(key)
+        vector = normalize(embedding)
+        codes = self._codes(vector)
+        row = self._add_row(key, vector)
+        self.codes[row] = codes
+        for table, code in zip(self.buckets, codes.tolist()):
+            table.setdefault(code, set()).add(row)
+
+    def query(self, embedding, threshold):
+        """
+        回傳 (同桶候選中相似度 > threshold 的最相似鍵或 None, 同桶候選的最高相似度)；
+        候選以矩陣精確重新比對，只會漏掉（不會誤報）未落在同桶的相似項目
+        """
+        self.stats['queries'] += 1
+        if not self.keys:
+            return None, 0.0
+        vector = normalize(embedding)
+        candidates = set()
+        for table, code in zip(self.buckets, self._codes(vector).tolist()):
+            bucket = table.get(code)
+            if bucket:
+                candidates.update(bucket)
+        if not candidates:
+            return None, 0.0
+        self.stats['candidates'] += len(candidates)
+        rows = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarities = self.embeddings[rows] @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] <= threshold:
+            return None, float(similarities[best])
+        self.stats['hits'] += 1
+        return self.keys[int(rows[best])], float(similarities[best])
+
+    def similar(self, embedding, threshold):
+        """不經分桶、精確比對所有列，回傳 [(鍵, 相似度)]（低閾值時分桶召回不足，需完整比對的場合使用）"""
+        if not self.keys:
+            return []
+        similarities = self._similarities(normalize(embedding))
+        return [(self.keys[row], float(similarities[row])) for row in np.flatnonzero(similarities > threshold)]
+
+    def _remove_row(self, row):
+        last = len(self.keys) - 1
+        for table, code in zip(self.buckets, self.codes[row].tolist()):
+            bucket = table[code]
+            bucket.discard(row)
+            if not bucket:
+                del table[code]
+        if row != last:
+            # 最後一列補位：桶中的列索引一併更新
+            for table, code in zip(self.buckets, self.codes[last].tolist()):
+                bucket = table[code]
+                bucket.discard(last)
+                bucket.add(row)
+        return super()._remove_row(row)
+
+
+_FINGERPRINT_PLANES = {}
+
+
+def simhash_fingerprint(embedding, bits=64, seed=20240601):
+    """
+    SimHash 指紋（16 位十六進位字串）：embedding 在 bits 個固定隨機超平面上的正負號，
+    相似的臉指紋也相近；固定種子讓重啟後同一張臉的指紋不變
+    """
+    vector = normalize(embedding)
+    planes = _FINGERPRINT_PLANES.get((bits, vector.shape[0]))
+    if planes is None:
+        rng = np.random.default_rng(seed)
+        planes = _FINGERPRINT_PLANES[(bits, vector.shape[0])] = \
+            rng.standard_normal((bits, vector.shape[0])).astype(np.float32)
+    signs = planes @ vector > 0
+    return f"{int.from_bytes(np.packbits(signs).tobytes(), 'big'):0{bits // 4}x}"
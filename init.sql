@@ -38,7 +38,7 @@ CREATE TABLE IF NOT EXISTS face_profiles (
 CREATE INDEX IF NOT EXISTS face_embedding_idx 
 ON face_profiles USING hnsw (face_embedding vector_cosine_ops);
 
--- 創建識別記錄表
+-- 創建識別記錄表（連線時由 migrations/002 轉為依日期分區）
 CREATE TABLE IF NOT EXISTS recognition_logs (
     id SERIAL PRIMARY KEY,
     person_id VARCHAR(50),
@@ -95,6 +95,8 @@ CREATE TABLE IF NOT EXISTS attendance_sessions (
 -- 在 last_seen_at 和 session_uuid 創建索引以提高查詢效率
 CREATE INDEX IF NOT EXISTS idx_last_seen_at ON attendance_sessions (last_seen_at);
 CREATE INDEX IF NOT EXISTS idx_session_uuid ON attendance_sessions (session_uuid);
+-- 同一人員只允許一個活躍會話（出勤寫入使用 ON CONFLICT）
+CREATE UNIQUE INDEX IF NOT EXISTS uniq_active_session_per_person ON attendance_sessions (person_id) WHERE status = 'active';
 
 -- 確保 ai360 用戶可以訪問新表
 GRANT ALL PRIVILEGES ON TABLE attendance_sessions TO ai360;
@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+"""
+WebSocket 即時識別壓力測試
+以 N 個並行客戶端依 video_frame 協定送出 JPEG 幀，逐步增加客戶端數，每個階段回報吞吐量、
+p50/p99 延遲（由回傳的 client_timestamp 計算）、丟失率與錯誤數，找出單機可支援的攝影機數量。
+幀來源可為合成畫面（可設定每幀人臉數）、JPEG 目錄或錄製檔；錄製模式以代理伺服器轉送真實客戶端連線，
+並將送出的幀存成精簡的錄製檔（原始 JPEG，不含 base64）。全程離線執行
+
+    python loadtest.py run --clients 1,2,4,8,16 --step-seconds 30 --fps 10 --faces 2 --face-images ./faces
+    python loadtest.py run --replay office.afrec --clients 4,8,16
+    python loadtest.py record --upstream ws://localhost:7861 --port 7871 --out office.afrec
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import base64
+import random
+import struct
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+
+import websockets
+
+MAX_MESSAGE_SIZE = 10 * 1024 * 1024  # 與伺服器的訊息大小限制相同
+
+# 錄製檔：檔頭後接連續的紀錄，每筆為 (客戶端編號, 距錄製開始秒數, JPEG 位元組數) 與 JPEG 內容
+RECORDING_MAGIC = b'AFREC1\n'
+RECORD_HEADER = struct.Struct('<HdI')
+
+
+# ---------- 幀來源 ----------
+
+def _frame_message(jpeg):
+    """預先組好 video_frame 訊息（client_timestamp 之前的部分），送出時只需接上時間戳"""
+    image = 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode('ascii')
+    return '{"type": "video_frame", "image": "' + image + '", "client_timestamp": '
+
+
+def _draw_face(cv2, image, x, y, size):
+    """沒有人臉照片時繪製簡單的臉部圖形（檢測器不一定會判定為人臉，只用於測試解碼與傳輸負載）"""
+    center = (x + size // 2, y + size // 2)
+    cv2.ellipse(image, center, (size * 2 // 5, size // 2), 0, 0, 360, (150, 180, 220), -1)
+    for dx in (-size // 6, size // 6):
+        cv2.circle(image, (center[0] + dx, center[1] - size // 8), max(2, size // 16), (40, 40, 40), -1)
+    cv2.ellipse(image, (center[0], center[1] + size // 5), (size // 6, size // 14), 0, 0, 180, (60, 60, 160), 2)
+
+
+def synthetic_frames(width=480, height=360, faces=1, face_images=None, count=30, quality=50, seed=0):
+    """
+    產生 count 張合成畫面的 JPEG：faces 張臉排成格狀並隨幀緩慢移動。
+    face_images 為人臉照片目錄時貼上真實臉部（人臉檢測與 embedding 才會產生實際負載）
+    """
+    import cv2
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    crops = []
+    if face_images:
+        for path in sorted(glob.glob(os.path.join(face_images, '*'))):
+            crop = cv2.imread(path)
+            if crop is not None:
+                crops.append(crop)
+        if not crops:
+            raise ValueError(f'人臉照片目錄沒有可讀取的圖片: {face_images}')
+
+    gradient = np.linspace(60, 160, width, dtype=np.uint8)
+    background = np.dstack([np.tile(gradient, (height, 1))] * 3)
+    background = cv2.add(background, rng.integers(0, 20, background.shape, dtype=np.uint8))
+
+    columns = max(1, int(np.ceil(np.sqrt(faces)))) if faces else 1
+    rows = max(1, int(np.ceil(faces / columns))) if faces else 1
+    cell_width, cell_height = width // columns, height // rows
+    size = int(min(cell_width, cell_height) * 0.7)
+    jitter = min(cell_width, cell_height) - size
+
+    frames = []
+    for index in range(count):
+        image = background.copy()
+        phase = 2 * np.pi * index / max(count, 1)
+        for face in range(faces):
+            row, column = divmod(face, columns)
+            offset = int(jitter / 2 * (1 + np.sin(phase + face)))
+            x = column * cell_width + offset
+            y = row * cell_height + (jitter - offset) // 2
+            if crops:
+                image[y:y + size, x:x + size] = cv2.resize(crops[face % len(crops)], (size, size))
+            else:
+                _draw_face(cv2, image, x, y, size)
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if ok:
+            frames.append(buffer.tobytes())
+    return frames
+
+
+def directory_frames(path):
+    """讀取目錄中的 JPEG 檔（依檔名排序）"""
+    frames = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(('.jpg', '.jpeg')):
+            with open(os.path.join(path, name), 'rb') as f:
+                frames.append(f.read())
+    if not frames:
+        raise ValueError(f'目錄沒有 JPEG 檔: {path}')
+    return frames
+
+
+def read_recording(path):
+    """讀取錄製檔，回傳 {客戶端編號: [(距錄製開始秒數, JPEG)]}"""
+    streams = {}
+    with open(path, 'rb') as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f'不是錄製檔: {path}')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            client_id, offset, length = RECORD_HEADER.unpack(header)
+            jpeg = f.read(length)
+            if len(jpeg) < length:
+                break  # 錄製中斷造成的不完整紀錄
+            streams.setdefault(client_id, []).append((offset, jpeg))
+    if not streams:
+        raise ValueError(f'錄製檔沒有任何幀: {path}')
+    return streams
+
+
+def recorded_streams(path, fps=None):
+    """錄製檔轉為重播串流 [(送出後等待秒數, 訊息前綴)]；未指定 fps 時保留原始的幀間隔"""
+    streams = []
+    for frames in read_recording(path).values():
+        stream = []
+        for index, (offset, jpeg) in enumerate(frames):
+            if fps:
+                interval = 1 / fps
+            elif index + 1 < len(frames):
+                interval = max(0.0, frames[index + 1][0] - offset)
+            else:
+                # 最後一幀之後接回第一幀，以平均間隔等待
+                interval = (offset - frames[0][0]) / max(len(frames) - 1, 1) or 0.1
+            stream.append((interval, _frame_message(jpeg)))
+        streams.append(stream)
+    return streams
+
+
+class RecordingWriter:
+    """寫入錄製檔；每筆紀錄立即寫出，錄製中斷時已寫入的幀仍可重播"""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(RECORDING_MAGIC)
+        self.started = time.monotonic()
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, client_id, jpeg):
+        self.file.write(RECORD_HEADER.pack(client_id, time.monotonic() - self.started, len(jpeg)))
+        self.file.write(jpeg)
+        self.file.flush()
+        self.frames += 1
+        self.bytes += len(jpeg)
+
+    def close(self):
+        self.file.close()
+
+
+# ---------- 壓力測試 ----------
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StepStats:
+    """單一階段（固定客戶端數）的統計；回應與逾時計入送出該幀時的階段"""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.started = time.perf_counter()
+        self.ended = None
+        self.sent = 0
+        self.expected = 0     # 伺服器應處理（不在跳幀範圍）的幀數
+        self.responses = 0
+        self.dropped = 0      # 應處理但逾時未收到結果
+        self.faces = 0
+        self.latencies = []   # 毫秒
+        self.errors = Counter()
+
+    def report(self, in_flight):
+        elapsed = (self.ended or time.perf_counter()) - self.started
+        latencies = sorted(self.latencies)
+        settled = self.responses + self.dropped
+        return {
+            'clients': self.clients,
+            'seconds': round(elapsed, 1),
+            'sent_fps': round(self.sent / elapsed, 1),
+            'throughput_fps': round(self.responses / elapsed, 1),
+            'p50_ms': _percentile(latencies, 0.5),
+            'p99_ms': _percentile(latencies, 0.99),
+            'max_ms': latencies[-1] if latencies else None,
+            'drop_rate': round(self.dropped / settled, 4) if settled else 0.0,
+            'sent': self.sent,
+            'expected': self.expected,
+            'responses': self.responses,
+            'dropped': self.dropped,
+            'in_flight': in_flight,
+            'faces_per_frame': round(self.faces / self.responses, 2) if self.responses else 0.0,
+            'errors': dict(self.errors)
+        }
+
+
+class LoadClient:
+    """以固定節奏送出幀的客戶端；連線中斷時自動重連"""
+
+    def __init__(self, runner, stream):
+        self.runner = runner
+        self.stream = stream
+        self.pending = {}  # {client_timestamp: (送出時間毫秒, 階段)}，依送出順序
+
+    async def run(self):
+        while True:
+            try:
+                async with websockets.connect(self.runner.url, max_size=MAX_MESSAGE_SIZE,
+                                              ping_interval=None, open_timeout=10) as websocket:
+                    receiver = asyncio.create_task(self.receive(websocket))
+                    try:
+                        await self.send_frames(websocket)
+                    finally:
+                        receiver.cancel()
+            except asyncio.CancelledError:
+                raise
+            except websockets.exceptions.ConnectionClosed:
+                self.runner.step.errors['disconnected'] += 1
+            except Exception as e:
+                self.runner.step.errors[f'connect: {type(e).__name__}'] += 1
+            # 重新連線後伺服器重新計算跳幀，未回應的幀視為丟失
+            self.expire(float('inf'))
+            await asyncio.sleep(1)
+
+    async def send_frames(self, websocket):
+        skip = self.runner.server_skip + 1
+        start = random.randrange(len(self.stream))
+        # 各客戶端錯開送出時間，避免同時到達
+        next_at = time.perf_counter() + random.random() * self.stream[start][0]
+        for sequence, (interval, prefix) in enumerate(
+                itertools.islice(itertools.cycle(self.stream), start, None), start=1):
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            step = self.runner.step
+            now_ms = time.time() * 1000
+            timestamp = round(now_ms, 3)
+            # 伺服器依每個連線的幀序號跳幀，只有不被跳過的幀會有回應
+            if sequence % skip == 0:
+                self.pending[timestamp] = (now_ms, step)
+                step.expected += 1
+            await websocket.send(f'{prefix}{timestamp:.3f}}}')
+            step.sent += 1
+            self.expire(now_ms - self.runner.timeout * 1000)
+            next_at += interval
+            # 送出受阻（伺服器讀取太慢）時不補送累積的幀
+            next_at = max(next_at, time.perf_counter())
+
+    async def receive(self, websocket):
+        async for message in websocket:
+            data = json.loads(message)
+            if data.get('type') == 'recognition_result':
+                entry = self.pending.pop(data.get('client_timestamp'), None)
+                if entry:
+                    sent_ms, step = entry
+                    step.responses += 1
+                    step.faces += len(data.get('faces') or [])
+                    step.latencies.append(round(time.time() * 1000 - sent_ms, 1))
+            elif data.get('type') == 'error':
+                self.runner.step.errors[data.get('message', 'error')[:60]] += 1
+
+    def expire(self, before_ms):
+        """送出時間早於 before_ms 仍未回應的幀計為丟失"""
+        while self.pending:
+            timestamp, (sent_ms, step) = next(iter(self.pending.items()))
+            if sent_ms >= before_ms:
+                break
+            del self.pending[timestamp]
+            step.dropped += 1
+
+    def in_flight(self, step):
+        return sum(1 for _, entry_step in self.pending.values() if entry_step is step)
+
+
+class LoadRunner:
+
+    def __init__(self, url, streams, timeout=5.0, server_skip=4):
+        self.url = url
+        self.streams = streams
+        self.timeout = timeout
+        self.server_skip = server_skip
+        self.clients = []
+        self.tasks = []
+        self.step = StepStats(0)
+
+    def add_client(self):
+        client = LoadClient(self, self.streams[len(self.clients) % len(self.streams)])
+        self.clients.append(client)
+        self.tasks.append(asyncio.create_task(client.run()))
+
+    async def ramp(self, counts, step_seconds, max_p99_ms=None, max_drop_rate=None):
+        """依序增加到各階段的客戶端數並維持 step_seconds 秒；超過延遲或丟失率上限時停止"""
+        results = []
+        print(f"{'clients':>7} {'sent/s':>8} {'resp/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+              f"{'max ms':>8} {'drop':>7} {'flight':>6} {'errors':>6}")
+        try:
+            for count in counts:
+                self.step = StepStats(count)
+                while len(self.clients) < count:
+                    self.add_client()
+                await asyncio.sleep(step_seconds)
+                self.step.ended = time.perf_counter()
+                row = self.step.report(sum(client.in_flight(self.step) for client in self.clients))
+                results.append(row)
+                print(f"{row['clients']:>7} {row['sent_fps']:>8} {row['throughput_fps']:>8} "
+                      f"{_format_ms(row['p50_ms']):>8} {_format_ms(row['p99_ms']):>8} {_format_ms(row['max_ms']):>8} "
+                      f"{row['drop_rate']:>7.1%} {row['in_flight']:>6} {sum(row['errors'].values()):>6}")
+                for message, count_ in row['errors'].items():
+                    print(f"        ⚠️ {message}: {count_}")
+                if max_p99_ms and row['p99_ms'] is not None and row['p99_ms'] > max_p99_ms:
+                    print(f"🛑 p99 延遲 {row['p99_ms']}ms 超過上限 {max_p99_ms}ms，停止增加客戶端")
+                    break
+                if max_drop_rate is not None and row['drop_rate'] > max_drop_rate:
+                    print(f"🛑 丟失率 {row['drop_rate']:.1%} 超過上限 {max_drop_rate:.1%}，停止增加客戶端")
+                    break
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        return results
+
+
+def _format_ms(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def _capacity(results, max_p99_ms, max_drop_rate):
+    """最後一個未超過上限的階段"""
+    best = None
+    for row in results:
+        if max_p99_ms and (row['p99_ms'] is None or row['p99_ms'] > max_p99_ms):
+            break
+        if max_drop_rate is not None and row['drop_rate'] > max_drop_rate:
+            break
+        best = row
+    return best
+
+
+async def run_load_test(args):
+    if args.replay:
+        streams = recorded_streams(args.replay, args.fps if args.fps_override else None)
+        source = f"錄製檔 {args.replay} ({len(streams)} 個串流)"
+    else:
+        if args.images:
+            frames = directory_frames(args.images)
+            source = f"JPEG 目錄 {args.images} ({len(frames)} 張)"
+        else:
+            frames = synthetic_frames(args.width, args.height, args.faces, args.face_images,
+                                      args.frames, args.quality)
+            source = f"合成畫面 {args.width}x{args.height}，每幀 {args.faces} 張臉 ({len(frames)} 張)"
+        messages = [_frame_message(jpeg) for jpeg in frames]
+        streams = [[(1 / args.fps, message) for message in messages]]
+
+    counts = [int(count) for count in args.clients.split(',')]
+    print(f"🚀 壓力測試 {args.url}")
+    print(f"🎞️ 幀來源: {source}")
+    print(f"⏱️ 每階段 {args.step_seconds} 秒，客戶端數 {counts}，回應逾時 {args.timeout} 秒，"
+          f"伺服器每 {args.server_skip + 1} 幀處理 1 幀")
+
+    runner = LoadRunner(args.url, streams, args.timeout, args.server_skip)
+    results = await runner.ramp(counts, args.step_seconds, args.max_p99_ms, args.max_drop_rate)
+
+    best = _capacity(results, args.max_p99_ms, args.max_drop_rate)
+    if best and (args.max_p99_ms or args.max_drop_rate is not None):
+        print(f"✅ 在上限內可支援 {best['clients']} 個客戶端（處理 {best['throughput_fps']} 幀/秒）")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'url': args.url, 'source': source, 'steps': results}, f, ensure_ascii=False, indent=2)
+        print(f"💾 結果已寫入 {args.output}")
+
+
+# ---------- 錄製 ----------
+
+async def run_recorder(args):
+    """代理伺服器：客戶端改連到本機埠，訊息雙向轉送到上游伺服器，並錄下送出的 video_frame"""
+    writer = RecordingWriter(args.out)
+    client_ids = itertools.count()
+
+    async def handle(client, path):
+        client_id = next(client_ids)
+        print(f"📹 客戶端 {client_id} 已連線，開始錄製")
+        try:
+            async with websockets.connect(args.upstream, max_size=MAX_MESSAGE_SIZE, ping_interval=None) as upstream:
+
+                async def client_to_upstream():
+                    async for message in client:
+                        if isinstance(message, str) and '"video_frame"' in message:
+                            data = json.loads(message)
+                            if data.get('type') == 'video_frame' and data.get('image'):
+                                writer.write(client_id, base64.b64decode(data['image'].split(',')[-1]))
+                        await upstream.send(message)
+
+                async def upstream_to_client():
+                    async for message in upstream:
+                        await client.send(message)
+
+                tasks = [asyncio.create_task(client_to_upstream()), asyncio.create_task(upstream_to_client())]
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    task.cancel()
+        except Exception as e:
+            print(f"⚠️ 客戶端 {client_id} 轉送中斷: {e}")
+        print(f"📹 客戶端 {client_id} 已離線（累計 {writer.frames} 幀，{writer.bytes / 1024 / 1024:.1f} MB）")
+
+    async with websockets.serve(handle, args.host, args.port, max_size=MAX_MESSAGE_SIZE, ping_interval=None):
+        print(f"🎙️ 錄製代理 ws://{args.host}:{args.port} → {args.upstream}，寫入 {args.out} (Ctrl+C 結束)")
+        try:
+            await asyncio.Future()
+        finally:
+            writer.close()
+            print(f"💾 共錄製 {writer.frames} 幀，{writer.bytes / 1024 / 1024:.1f} MB")
+
+
+def print_recording_info(path):
+    streams = read_recording(path)
+    print(f"🎞️ {path}: {len(streams)} 個串流")
+    for client_id, frames in streams.items():
+        duration = frames[-1][0] - frames[0][0]
+        size = sum(len(jpeg) for _, jpeg in frames)
+        fps = (len(frames) - 1) / duration if duration > 0 else 0
+        print(f"   客戶端 {client_id}: {len(frames)} 幀，{duration:.1f} 秒 (約 {fps:.1f} fps)，{size / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='WebSocket 即時識別壓力測試')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run = subparsers.add_parser('run', help='以逐步增加的客戶端數進行壓力測試')
+    run.add_argument('--url', default=os.getenv('LOADTEST_URL', 'ws://localhost:7861'))
+    run.add_argument('--clients', default='1,2,4,8', help='各階段的客戶端數，以逗號分隔')
+    run.add_argument('--step-seconds', type=float, default=30)
+    run.add_argument('--fps', type=float, default=10, help='每個客戶端每秒送出的幀數')
+    run.add_argument('--replay', help='重播錄製檔（預設保留原始幀間隔）')
+    run.add_argument('--fps-override', action='store_true', help='重播時改用 --fps 的固定節奏')
+    run.add_argument('--images', help='JPEG 目錄，依檔名順序循環送出')
+    run.add_argument('--faces', type=int, default=1, help='合成畫面每幀的人臉數')
+    run.add_argument('--face-images', help='合成畫面使用的人臉照片目錄（未指定時繪製簡單臉部圖形）')
+    run.add_argument('--width', type=int, default=480)
+    run.add_argument('--height', type=int, default=360)
+    run.add_argument('--quality', type=int, default=50, help='合成畫面的 JPEG 品質')
+    run.add_argument('--frames', type=int, default=30, help='合成畫面的張數')
+    run.add_argument('--timeout', type=float, default=5, help='超過此秒數未回應的幀計為丟失')
+    run.add_argument('--server-skip', type=int, default=4, help='伺服器每處理 1 幀前跳過的幀數')
+    run.add_argument('--max-p99-ms', type=float, help='p99 延遲上限，超過時停止增加客戶端')
+    run.add_argument('--max-drop-rate', type=float, help='丟失率上限 (0~1)，超過時停止增加客戶端')
+    run.add_argument('--output', help='將各階段結果寫入 JSON 檔')
+
+    record = subparsers.add_parser('record', help='啟動錄製代理，錄下真實客戶端送出的幀')
+    record.add_argument('--upstream', default='ws://localhost:7861')
+    record.add_argument('--host', default='0.0.0.0')
+    record.add_argument('--port', type=int, default=7871)
+    record.add_argument('--out', required=True)
+
+    info = subparsers.add_parser('info', help='顯示錄製檔內容')
+    info.add_argument('path')
+
+    args = parser.parse_args()
+    try:
+        if args.command == 'run':
+            asyncio.run(run_load_test(args))
+        elif args.command == 'record':
+            asyncio.run(run_recorder(args))
+        elif args.command == 'info':
+            print_recording_info(args.path)
+        else:
+            parser.print_help()
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Prometheus 格式的效能指標
+計數器、量測值與固定區間的直方圖都存在記憶體中，每次觀測只需一次二分搜尋與兩次加法；
+/metrics 被讀取時才組成文字輸出。識別流程的每個階段以 FrameTrace 記錄耗時
+"""
+
+import time
+import contextvars
+from bisect import bisect_left
+
+# 秒為單位的延遲區間（0.5ms ~ 10s）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.004, 0.006, 0.008, 0.01, 0.015, 0.02, 0.03, 0.04, 0.06, 0.08,
+                   0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不減的計數"""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}  # {標籤值 tuple: 數值}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """
+    讀取時由回呼取得目前值；回呼回傳數值，或有標籤時回傳 {標籤值 tuple: 數值}
+    既有元件自行累計的計數（例如佇列的丟棄數）以 metric_type='counter' 輸出
+    """
+
+    def __init__(self, name, help, callback, labelnames=(), metric_type='gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = labelnames
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        try:
+            values = self.callback()
+        except Exception as e:
+            lines.append(f"# error: {e}")
+            return lines
+        if not self.labelnames:
+            values = {(): values}
+        for labels, value in values.items():
+            if value is not None:
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """固定區間直方圖；quantile() 以區間內線性內插估計分位數"""
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.series = {}  # {標籤值 tuple: [各區間計數..., +Inf 計數, 總和]}
+
+    def observe(self, value, labels=()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels=()):
+        series = self.series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def quantile(self, q, labels=()):
+        series = self.series.get(labels)
+        if not series:
+            return None
+        total = sum(series[:-1])
+        if total == 0:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(series[:-1]):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    # 超過最大區間，只能回報區間下限
+                    return lower
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def summary(self):
+        """{標籤: {'count', 'p50', 'p95', 'p99'}}，延遲以毫秒表示（供統計訊息使用）"""
+        scale = 1000 if self.buckets is LATENCY_BUCKETS else 1
+        result = {}
+        for labels in self.series:
+            key = ','.join(labels) or 'all'
+            result[key] = {'count': self.count(labels)}
+            for q in QUANTILES:
+                value = self.quantile(q, labels)
+                result[key][f"p{int(q * 100)}"] = round(value * scale, 2) if value is not None else None
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = {'le': _format_value(float(bound)) if bound != float('inf') else '+Inf'}
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        # 另以量測值輸出估計的分位數，未使用 histogram_quantile 的工具也可直接讀取
+        lines.append(f"# TYPE {self.name}_quantile gauge")
+        for labels in self.series:
+            for q in QUANTILES:
+                value = self.quantile(q, labels)
+                if value is not None:
+                    label_text = _format_labels(self.labelnames, labels, {'quantile': q})
+                    lines.append(f"{self.name}_quantile{label_text} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, callback, labelnames=(), metric_type='gauge'):
+        return self.register(Gauge(name, help, callback, labelnames, metric_type))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 識別流程（websocket_realtime.py）
+FRAME_STAGE_SECONDS = REGISTRY.histogram(
+    'auraface_frame_stage_seconds', '每幀各處理階段的耗時（秒）', ('stage',))
+FRAME_SECONDS = REGISTRY.histogram(
+    'auraface_frame_seconds', '每幀伺服器端總處理時間（秒）')
+FRAME_E2E_SECONDS = REGISTRY.histogram(
+    'auraface_frame_e2e_seconds', '客戶端送出 (client_timestamp) 到結果放入送出佇列的時間（秒，需客戶端與伺服器時鐘同步）')
+FRAME_DB_ROUND_TRIPS = REGISTRY.histogram(
+    'auraface_frame_db_round_trips', '每幀取用資料庫連線的次數', buckets=COUNT_BUCKETS)
+FRAMES = REGISTRY.counter(
+    'auraface_frames_total', '收到的視訊幀數，依結果分類 (processed / skipped / failed)', ('result',))
+
+# 需要逐幀明細時暫時加入的回呼 listener(trace, 總秒數, 端到端秒數或 None)，例如 profiler.capture_frames；
+# 平常為空串列，finish() 只多一次判斷
+FRAME_LISTENERS = []
+
+
+class FrameTrace:
+    """單一幀的階段計時：mark(stage) 記錄距離上一個標記的耗時"""
+
+    __slots__ = ('started', 'last', 'stages', 'round_trips')
+
+    def __init__(self):
+        self.started = self.last = time.perf_counter()
+        self.stages = []  # [(階段, 秒)]
+        self.round_trips = 0
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+        self.stages.append((stage, elapsed))
+        FRAME_STAGE_SECONDS.observe(elapsed, (stage,))
+
+    def finish(self, client_timestamp=None):
+        """記錄總時間、資料庫往返次數與端到端延遲，回傳總秒數"""
+        total = time.perf_counter() - self.started
+        FRAME_SECONDS.observe(total)
+        FRAME_DB_ROUND_TRIPS.observe(self.round_trips)
+        e2e = None
+        if client_timestamp:
+            try:
+                e2e = time.time() - float(client_timestamp) / 1000
+            except (TypeError, ValueError):
+                pass
+            # 時鐘不同步造成的負值或異常值不記錄
+            if e2e is not None and 0 <= e2e < 3600:
+                FRAME_E2E_SECONDS.observe(e2e)
+            else:
+                e2e = None
+        if FRAME_LISTENERS:
+            for listener in list(FRAME_LISTENERS):
+                listener(self, total, e2e)
+        return total
+
+
+class _NoTrace:
+    """不在幀處理中時的替代物件，省去呼叫端的判斷"""
+
+    __slots__ = ()
+    round_trips = 0
+
+    def mark(self, stage):
+        pass
+
+
+_NO_TRACE = _NoTrace()
+_current_trace = contextvars.ContextVar('frame_trace', default=None)
+
+
+def start_frame():
+    """開始一幀的計時；同一個 asyncio 任務（及其建立的子任務）內以 current_frame() 取得"""
+    trace = FrameTrace()
+    _current_trace.set(trace)
+    return trace
+
+
+def end_frame():
+    _current_trace.set(None)
+
+
+def current_frame():
+    return _current_trace.get() or _NO_TRACE
+
+
+def count_round_trip(count=1):
+    """資料庫管理器取用連線時呼叫，計入目前處理中的幀"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.round_trips += count
@@ -0,0 +1,15 @@
+-- 同一人員只允許一個活躍出勤會話，出勤寫入改為單一 INSERT ... ON CONFLICT
+
+-- 先結束既有資料中重複的活躍會話（保留最後出現的那一筆）
+UPDATE attendance_sessions a
+SET status = 'ended', departure_time = a.last_seen_at
+WHERE a.status = 'active'
+AND EXISTS (
+    SELECT 1 FROM attendance_sessions b
+    WHERE b.person_id = a.person_id
+    AND b.status = 'active'
+    AND (b.last_seen_at, b.id) > (a.last_seen_at, a.id)
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uniq_active_session_per_person
+ON attendance_sessions (person_id) WHERE status = 'active';
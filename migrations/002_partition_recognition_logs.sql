@@ -0,0 +1,100 @@
+-- recognition_logs 改為依 recognition_time 每日分區
+-- 舊分區整個 DROP 取代 DELETE，未來分區由 maintain_recognition_log_partitions() 預先建立
+
+-- 建立（或補齊）單日分區；預設分區中已落在該日的資料會先搬入新分區
+CREATE OR REPLACE FUNCTION create_recognition_log_partition(day DATE)
+RETURNS VOID AS $$
+DECLARE
+    partition_name TEXT := 'recognition_logs_p' || to_char(day, 'YYYYMMDD');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE recognition_logs INCLUDING DEFAULTS)', partition_name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM recognition_logs_default
+                        WHERE recognition_time >= %L AND recognition_time < %L RETURNING *)
+         INSERT INTO %I SELECT * FROM moved',
+        day, day + 1, partition_name);
+    EXECUTE format('ALTER TABLE recognition_logs ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, day, day + 1);
+END;
+$$ LANGUAGE plpgsql;
+
+-- 建立今天起 days_ahead 天的分區，並刪除超過 retention_days 天的分區，回傳被刪除的分區名稱
+CREATE OR REPLACE FUNCTION maintain_recognition_log_partitions(days_ahead INTEGER, retention_days INTEGER)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    day DATE;
+    partition RECORD;
+BEGIN
+    FOR day IN SELECT generate_series(CURRENT_DATE, CURRENT_DATE + days_ahead, INTERVAL '1 day')::DATE LOOP
+        PERFORM create_recognition_log_partition(day);
+    END LOOP;
+
+    IF retention_days IS NULL OR retention_days <= 0 THEN
+        RETURN;
+    END IF;
+
+    FOR partition IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'recognition_logs'::regclass
+        AND c.relname ~ '^recognition_logs_p[0-9]{8}$'
+        AND to_date(substring(c.relname FROM '[0-9]{8}$'), 'YYYYMMDD') < CURRENT_DATE - retention_days
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition.relname);
+        RETURN NEXT partition.relname;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 將既有的一般資料表轉為分區表（沿用原本的 id 序列），資料依日期搬入對應分區
+DO $$
+DECLARE
+    first_day DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'recognition_logs'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE recognition_logs RENAME TO recognition_logs_legacy;
+    ALTER INDEX IF EXISTS recognition_logs_pkey RENAME TO recognition_logs_legacy_pkey;
+
+    CREATE TABLE recognition_logs (
+        id INTEGER NOT NULL DEFAULT nextval('recognition_logs_id_seq'),
+        person_id VARCHAR(50),
+        recognized_name VARCHAR(100),
+        confidence FLOAT,
+        recognition_time TIMESTAMP NOT NULL DEFAULT NOW(),
+        image_source VARCHAR(100),
+        PRIMARY KEY (id, recognition_time)
+    ) PARTITION BY RANGE (recognition_time);
+
+    CREATE TABLE recognition_logs_default PARTITION OF recognition_logs DEFAULT;
+
+    -- 近期視窗查詢（最近 24 小時、最新 N 筆）與依人員查詢/刪除
+    CREATE INDEX idx_recognition_logs_time ON recognition_logs (recognition_time DESC);
+    CREATE INDEX idx_recognition_logs_person_time ON recognition_logs (person_id, recognition_time DESC);
+
+    SELECT MIN(recognition_time)::DATE INTO first_day FROM recognition_logs_legacy;
+    IF first_day IS NOT NULL THEN
+        PERFORM create_recognition_log_partition(day::DATE)
+        FROM generate_series(first_day, CURRENT_DATE, INTERVAL '1 day') AS day;
+    END IF;
+
+    INSERT INTO recognition_logs (id, person_id, recognized_name, confidence, recognition_time, image_source)
+    SELECT id, person_id, recognized_name, confidence, COALESCE(recognition_time, NOW()), image_source
+    FROM recognition_logs_legacy;
+
+    ALTER SEQUENCE recognition_logs_id_seq OWNED BY recognition_logs.id;
+    DROP TABLE recognition_logs_legacy;
+END;
+$$;
+
+SELECT maintain_recognition_log_partitions(7, NULL);
+
+GRANT ALL PRIVILEGES ON TABLE recognition_logs TO ai360;
+GRANT ALL PRIVILEGES ON TABLE recognition_logs_default TO ai360;
@@ -0,0 +1,145 @@
+-- 出勤每日彙總：每人每日（含部門）的會話數、首次到達、最後離開與累計在場秒數
+-- 由 attendance_sessions 的觸發器隨會話開啟/結束增量更新，摘要查詢不再掃描完整歷史
+
+CREATE TABLE IF NOT EXISTS attendance_daily_rollups (
+    person_id VARCHAR(50) NOT NULL,
+    attendance_date DATE NOT NULL,
+    department VARCHAR(100),
+    session_count INTEGER NOT NULL DEFAULT 0,
+    active_sessions INTEGER NOT NULL DEFAULT 0,
+    first_arrival TIMESTAMP,
+    last_departure TIMESTAMP,
+    presence_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,  -- 已結束會話的在場秒數
+    PRIMARY KEY (person_id, attendance_date)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rollups_date_department ON attendance_daily_rollups (attendance_date, department);
+
+-- 依人員與日期重算單一彙總列時使用
+CREATE INDEX IF NOT EXISTS idx_sessions_person_arrival ON attendance_sessions (person_id, arrival_time);
+
+-- 以 attendance_sessions 重算某人某日的彙總列（刪除會話或更改到達時間時使用）
+CREATE OR REPLACE FUNCTION refresh_attendance_daily_rollup(p_person_id VARCHAR, p_date DATE)
+RETURNS VOID AS $$
+BEGIN
+    DELETE FROM attendance_daily_rollups WHERE person_id = p_person_id AND attendance_date = p_date;
+
+    INSERT INTO attendance_daily_rollups
+        (person_id, attendance_date, department, session_count, active_sessions,
+         first_arrival, last_departure, presence_seconds)
+    SELECT s.person_id, p_date, (SELECT department FROM face_profiles WHERE person_id = p_person_id),
+           COUNT(*),
+           COUNT(*) FILTER (WHERE s.status = 'active'),
+           MIN(s.arrival_time),
+           MAX(s.departure_time),
+           COALESCE(SUM(EXTRACT(EPOCH FROM (s.departure_time - s.arrival_time)))
+                    FILTER (WHERE s.status <> 'active' AND s.departure_time IS NOT NULL), 0)
+    FROM attendance_sessions s
+    WHERE s.person_id = p_person_id
+    AND s.arrival_time >= p_date AND s.arrival_time < p_date + 1
+    GROUP BY s.person_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_attendance_daily_rollups()
+RETURNS TRIGGER AS $$
+DECLARE
+    presence_delta DOUBLE PRECISION := 0;
+BEGIN
+    IF TG_OP = 'DELETE'
+       OR (TG_OP = 'UPDATE' AND (OLD.person_id <> NEW.person_id OR OLD.arrival_time::DATE <> NEW.arrival_time::DATE)) THEN
+        PERFORM refresh_attendance_daily_rollup(OLD.person_id, OLD.arrival_time::DATE);
+        IF TG_OP = 'DELETE' THEN
+            RETURN OLD;
+        END IF;
+        PERFORM refresh_attendance_daily_rollup(NEW.person_id, NEW.arrival_time::DATE);
+        RETURN NEW;
+    END IF;
+
+    IF NEW.status <> 'active' AND NEW.departure_time IS NOT NULL THEN
+        presence_delta := EXTRACT(EPOCH FROM (NEW.departure_time - NEW.arrival_time));
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO attendance_daily_rollups AS r
+            (person_id, attendance_date, department, session_count, active_sessions,
+             first_arrival, last_departure, presence_seconds)
+        VALUES (NEW.person_id, NEW.arrival_time::DATE,
+                (SELECT department FROM face_profiles WHERE person_id = NEW.person_id),
+                1, CASE WHEN NEW.status = 'active' THEN 1 ELSE 0 END,
+                NEW.arrival_time, NEW.departure_time, presence_delta)
+        ON CONFLICT (person_id, attendance_date) DO UPDATE SET
+            session_count = r.session_count + 1,
+            active_sessions = r.active_sessions + EXCLUDED.active_sessions,
+            first_arrival = LEAST(r.first_arrival, EXCLUDED.first_arrival),
+            last_departure = GREATEST(r.last_departure, EXCLUDED.last_departure),
+            presence_seconds = r.presence_seconds + EXCLUDED.presence_seconds;
+        RETURN NEW;
+    END IF;
+
+    -- UPDATE：同一天內的狀態/離開時間變更，只套用差異
+    IF OLD.status <> 'active' AND OLD.departure_time IS NOT NULL THEN
+        presence_delta := presence_delta - EXTRACT(EPOCH FROM (OLD.departure_time - OLD.arrival_time));
+    END IF;
+
+    UPDATE attendance_daily_rollups SET
+        active_sessions = active_sessions
+            + (CASE WHEN NEW.status = 'active' THEN 1 ELSE 0 END)
+            - (CASE WHEN OLD.status = 'active' THEN 1 ELSE 0 END),
+        first_arrival = LEAST(first_arrival, NEW.arrival_time),
+        last_departure = GREATEST(last_departure, NEW.departure_time),
+        presence_seconds = presence_seconds + presence_delta
+    WHERE person_id = NEW.person_id AND attendance_date = NEW.arrival_time::DATE;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- last_seen_at 的頻繁更新不影響彙總，不觸發
+DROP TRIGGER IF EXISTS attendance_daily_rollups_insert_delete ON attendance_sessions;
+CREATE TRIGGER attendance_daily_rollups_insert_delete
+    AFTER INSERT OR DELETE ON attendance_sessions
+    FOR EACH ROW EXECUTE FUNCTION update_attendance_daily_rollups();
+
+DROP TRIGGER IF EXISTS attendance_daily_rollups_update ON attendance_sessions;
+CREATE TRIGGER attendance_daily_rollups_update
+    AFTER UPDATE OF status, departure_time, arrival_time, person_id ON attendance_sessions
+    FOR EACH ROW
+    WHEN (OLD.status IS DISTINCT FROM NEW.status
+          OR OLD.departure_time IS DISTINCT FROM NEW.departure_time
+          OR OLD.arrival_time IS DISTINCT FROM NEW.arrival_time
+          OR OLD.person_id IS DISTINCT FROM NEW.person_id)
+    EXECUTE FUNCTION update_attendance_daily_rollups();
+
+-- 以完整歷史重建彙總表（回填既有資料或校正時使用），回傳彙總列數
+CREATE OR REPLACE FUNCTION rebuild_attendance_daily_rollups()
+RETURNS INTEGER AS $$
+DECLARE
+    row_count INTEGER;
+BEGIN
+    -- 重建期間暫停會話寫入，避免觸發器與重建互相覆蓋
+    LOCK TABLE attendance_sessions IN SHARE ROW EXCLUSIVE MODE;
+    DELETE FROM attendance_daily_rollups;
+
+    INSERT INTO attendance_daily_rollups
+        (person_id, attendance_date, department, session_count, active_sessions,
+         first_arrival, last_departure, presence_seconds)
+    SELECT s.person_id, s.arrival_time::DATE, MAX(f.department),
+           COUNT(*),
+           COUNT(*) FILTER (WHERE s.status = 'active'),
+           MIN(s.arrival_time),
+           MAX(s.departure_time),
+           COALESCE(SUM(EXTRACT(EPOCH FROM (s.departure_time - s.arrival_time)))
+                    FILTER (WHERE s.status <> 'active' AND s.departure_time IS NOT NULL), 0)
+    FROM attendance_sessions s
+    LEFT JOIN face_profiles f ON f.person_id = s.person_id
+    WHERE s.arrival_time IS NOT NULL
+    GROUP BY s.person_id, s.arrival_time::DATE;
+
+    GET DIAGNOSTICS row_count = ROW_COUNT;
+    RETURN row_count;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_attendance_daily_rollups();
+
+GRANT ALL PRIVILEGES ON TABLE attendance_daily_rollups TO ai360;
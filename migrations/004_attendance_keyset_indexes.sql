@@ -0,0 +1,6 @@
+-- 出勤記錄依 (last_seen_at, id) 鍵集分頁所需的複合索引（反向掃描即可滿足 DESC 排序）
+CREATE INDEX IF NOT EXISTS idx_sessions_last_seen_id ON attendance_sessions (last_seen_at, id);
+CREATE INDEX IF NOT EXISTS idx_sessions_person_last_seen_id ON attendance_sessions (person_id, last_seen_at, id);
+
+-- 已被 idx_sessions_last_seen_id 涵蓋
+DROP INDEX IF EXISTS idx_last_seen_at;
@@ -0,0 +1,46 @@
+-- 資料版本通知：出勤會話或人員資料有實際變更時遞增全域版本並發出 NOTIFY
+-- API 以 LISTEN 取得最新版本作為快取與 ETag 的依據，未變更的輪詢不需查詢資料庫
+
+-- 以序列作為版本號，避免多個寫入交易競爭同一列
+CREATE SEQUENCE IF NOT EXISTS data_version_seq;
+
+CREATE OR REPLACE FUNCTION notify_data_change()
+RETURNS TRIGGER AS $$
+BEGIN
+    -- 未影響任何資料列的語句（例如清理時沒有超時會話）不遞增版本
+    IF TG_OP <> 'TRUNCATE' THEN
+        IF NOT EXISTS (SELECT 1 FROM changed_rows) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+
+    PERFORM pg_notify('data_changed', TG_TABLE_NAME || ':' || nextval('data_version_seq'));
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    target TEXT;
+BEGIN
+    FOREACH target IN ARRAY ARRAY['attendance_sessions', 'face_profiles'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_notify_insert', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS changed_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()', target || '_notify_insert', target);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_notify_update', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING NEW TABLE AS changed_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()', target || '_notify_update', target);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_notify_delete', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS changed_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()', target || '_notify_delete', target);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_notify_truncate', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER TRUNCATE ON %I
+                        FOR EACH STATEMENT EXECUTE FUNCTION notify_data_change()', target || '_notify_truncate', target);
+    END LOOP;
+END;
+$$;
+
+GRANT ALL PRIVILEGES ON SEQUENCE data_version_seq TO ai360;
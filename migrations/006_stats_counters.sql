@@ -0,0 +1,191 @@
+-- 儀表板統計計數：人員依角色的總數與識別日誌總數存在 stats_counters，
+-- 識別次數另依小時彙總在 recognition_hourly_counts；由語句層級觸發器隨寫入維護，
+-- 統計查詢只讀取固定數量的列，不隨日誌表成長
+
+CREATE TABLE IF NOT EXISTS stats_counters (
+    counter VARCHAR(100) PRIMARY KEY,  -- 'face_profiles' / 'face_profiles:role:<角色>' / 'recognition_logs'
+    value BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS recognition_hourly_counts (
+    bucket TIMESTAMP PRIMARY KEY,  -- date_trunc('hour', recognition_time)
+    recognitions BIGINT NOT NULL DEFAULT 0
+);
+
+-- 將一組 (計數名稱, 差異) 合併後套用
+CREATE OR REPLACE FUNCTION apply_stats_counter_deltas(counters TEXT[], deltas BIGINT[])
+RETURNS VOID AS $$
+    INSERT INTO stats_counters AS c (counter, value)
+    SELECT d.counter, SUM(d.delta)
+    FROM unnest(counters, deltas) AS d(counter, delta)
+    GROUP BY d.counter
+    HAVING SUM(d.delta) <> 0
+    ON CONFLICT (counter) DO UPDATE SET value = c.value + EXCLUDED.value;
+$$ LANGUAGE sql;
+
+-- 將一組 (小時區段, 差異) 套用到小時彙總與識別總數
+CREATE OR REPLACE FUNCTION apply_recognition_count_deltas(buckets TIMESTAMP[], deltas BIGINT[])
+RETURNS VOID AS $$
+    INSERT INTO recognition_hourly_counts AS h (bucket, recognitions)
+    SELECT d.bucket, SUM(d.delta)
+    FROM unnest(buckets, deltas) AS d(bucket, delta)
+    GROUP BY d.bucket
+    HAVING SUM(d.delta) <> 0
+    ON CONFLICT (bucket) DO UPDATE SET recognitions = h.recognitions + EXCLUDED.recognitions;
+
+    SELECT apply_stats_counter_deltas(ARRAY['recognition_logs'], ARRAY[(SELECT SUM(d) FROM unnest(deltas) AS d)::BIGINT]);
+$$ LANGUAGE sql;
+
+-- 人員計數：每個語句以轉換表彙總後一次套用（轉換表只存在於對應的事件，故依事件分開查詢）
+CREATE OR REPLACE FUNCTION update_face_profile_counters()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM stats_counters WHERE counter LIKE 'face_profiles%';
+    ELSIF TG_OP = 'INSERT' THEN
+        PERFORM apply_stats_counter_deltas(array_agg(d.counter), array_agg(d.delta))
+        FROM (SELECT unnest(ARRAY['face_profiles', 'face_profiles:role:' || role]) AS counter, 1::BIGINT AS delta
+              FROM new_rows) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM apply_stats_counter_deltas(array_agg(d.counter), array_agg(d.delta))
+        FROM (SELECT unnest(ARRAY['face_profiles', 'face_profiles:role:' || role]) AS counter, -1::BIGINT AS delta
+              FROM old_rows) d;
+    ELSE
+        PERFORM apply_stats_counter_deltas(array_agg(d.counter), array_agg(d.delta))
+        FROM (SELECT 'face_profiles:role:' || role AS counter, 1::BIGINT AS delta FROM new_rows
+              UNION ALL
+              SELECT 'face_profiles:role:' || role, -1::BIGINT FROM old_rows) d;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 識別計數：總數與每小時區段
+CREATE OR REPLACE FUNCTION update_recognition_log_counters()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        DELETE FROM stats_counters WHERE counter = 'recognition_logs';
+        DELETE FROM recognition_hourly_counts;
+    ELSIF TG_OP = 'INSERT' THEN
+        PERFORM apply_recognition_count_deltas(array_agg(d.bucket), array_agg(d.delta))
+        FROM (SELECT date_trunc('hour', recognition_time) AS bucket, COUNT(*) AS delta
+              FROM new_rows GROUP BY 1) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM apply_recognition_count_deltas(array_agg(d.bucket), array_agg(d.delta))
+        FROM (SELECT date_trunc('hour', recognition_time) AS bucket, -COUNT(*) AS delta
+              FROM old_rows GROUP BY 1) d;
+    ELSE
+        PERFORM apply_recognition_count_deltas(array_agg(d.bucket), array_agg(d.delta))
+        FROM (SELECT date_trunc('hour', recognition_time) AS bucket, COUNT(*) AS delta FROM new_rows GROUP BY 1
+              UNION ALL
+              SELECT date_trunc('hour', recognition_time), -COUNT(*) FROM old_rows GROUP BY 1) d;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    target TEXT;
+    fn TEXT;
+BEGIN
+    FOREACH target IN ARRAY ARRAY['face_profiles', 'recognition_logs'] LOOP
+        fn := CASE target WHEN 'face_profiles' THEN 'update_face_profile_counters'
+                          ELSE 'update_recognition_log_counters' END;
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_counters_insert', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION %I()', target || '_counters_insert', target, fn);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_counters_update', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION %I()', target || '_counters_update', target, fn);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_counters_delete', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION %I()', target || '_counters_delete', target, fn);
+
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', target || '_counters_truncate', target);
+        EXECUTE format('CREATE TRIGGER %I AFTER TRUNCATE ON %I
+                        FOR EACH STATEMENT EXECUTE FUNCTION %I()', target || '_counters_truncate', target, fn);
+    END LOOP;
+END;
+$$;
+
+-- 精確計算 since 之後的識別次數：完整小時取自彙總表，起點所在的不完整小時才查詢日誌（最多一小時的資料）
+CREATE OR REPLACE FUNCTION count_recognitions_since(since TIMESTAMP)
+RETURNS BIGINT AS $$
+    SELECT COALESCE((SELECT SUM(recognitions) FROM recognition_hourly_counts
+                     WHERE bucket >= date_trunc('hour', since) + INTERVAL '1 hour'), 0)
+         + (SELECT COUNT(*) FROM recognition_logs
+            WHERE recognition_time > since
+            AND recognition_time < date_trunc('hour', since) + INTERVAL '1 hour');
+$$ LANGUAGE sql STABLE;
+
+-- 保留期限刪除分區時 DROP TABLE 不會觸發 DELETE 觸發器，改以小時彙總扣除該日的計數
+CREATE OR REPLACE FUNCTION maintain_recognition_log_partitions(days_ahead INTEGER, retention_days INTEGER)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    day DATE;
+    partition RECORD;
+    dropped BIGINT;
+BEGIN
+    FOR day IN SELECT generate_series(CURRENT_DATE, CURRENT_DATE + days_ahead, INTERVAL '1 day')::DATE LOOP
+        PERFORM create_recognition_log_partition(day);
+    END LOOP;
+
+    IF retention_days IS NULL OR retention_days <= 0 THEN
+        RETURN;
+    END IF;
+
+    FOR partition IN
+        SELECT c.relname, to_date(substring(c.relname FROM '[0-9]{8}$'), 'YYYYMMDD') AS day
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'recognition_logs'::regclass
+        AND c.relname ~ '^recognition_logs_p[0-9]{8}$'
+        AND to_date(substring(c.relname FROM '[0-9]{8}$'), 'YYYYMMDD') < CURRENT_DATE - retention_days
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition.relname);
+
+        WITH removed AS (
+            DELETE FROM recognition_hourly_counts
+            WHERE bucket >= partition.day AND bucket < partition.day + 1
+            RETURNING recognitions
+        )
+        SELECT COALESCE(SUM(recognitions), 0) INTO dropped FROM removed;
+        UPDATE stats_counters SET value = value - dropped WHERE counter = 'recognition_logs';
+
+        RETURN NEXT partition.relname;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 以現有資料重建所有計數（回填既有資料或校正時使用）
+CREATE OR REPLACE FUNCTION rebuild_stats_counters()
+RETURNS VOID AS $$
+BEGIN
+    -- 重建期間暫停寫入，避免觸發器與重建互相覆蓋
+    LOCK TABLE face_profiles, recognition_logs IN SHARE ROW EXCLUSIVE MODE;
+    DELETE FROM stats_counters;
+    DELETE FROM recognition_hourly_counts;
+
+    INSERT INTO stats_counters (counter, value)
+    SELECT 'face_profiles', COUNT(*) FROM face_profiles
+    UNION ALL
+    SELECT 'face_profiles:role:' || role, COUNT(*) FROM face_profiles GROUP BY role
+    UNION ALL
+    SELECT 'recognition_logs', COUNT(*) FROM recognition_logs;
+
+    INSERT INTO recognition_hourly_counts (bucket, recognitions)
+    SELECT date_trunc('hour', recognition_time), COUNT(*)
+    FROM recognition_logs
+    GROUP BY 1;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_stats_counters();
+
+GRANT ALL PRIVILEGES ON TABLE stats_counters TO ai360;
+GRANT ALL PRIVILEGES ON TABLE recognition_hourly_counts TO ai360;
@@ -0,0 +1,12 @@
+-- 多個識別程序之間的協調租約：清理/分區維護等單一負責者任務與跨程序的事件去重
+-- 租約短暫且可重建，使用 UNLOGGED 資料表避免寫入 WAL
+
+CREATE UNLOGGED TABLE IF NOT EXISTS coordination_leases (
+    lease_key VARCHAR(200) PRIMARY KEY,
+    owner VARCHAR(200) NOT NULL,
+    expires_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_coordination_leases_expires ON coordination_leases (expires_at);
+
+GRANT ALL PRIVILEGES ON TABLE coordination_leases TO ai360;
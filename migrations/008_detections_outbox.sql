@@ -0,0 +1,39 @@
+-- 事件外寄匣 (outbox)：進場、離開、陌生人自動註冊、臨時訪客離開等事件與出勤寫入在同一交易寫入 detections，
+-- 寫入後以 NOTIFY 喚醒消費者；消費者以 FOR UPDATE SKIP LOCKED 批次認領，處理完成才標記 is_processed
+
+-- 事件需在人員刪除後保留（臨時訪客離開事件即在刪除時寫入），移除外鍵
+ALTER TABLE detections DROP CONSTRAINT IF EXISTS detections_person_id_fkey;
+
+ALTER TABLE detections
+    ADD COLUMN IF NOT EXISTS event_type VARCHAR(50),
+    ADD COLUMN IF NOT EXISTS session_uuid VARCHAR(36),
+    ADD COLUMN IF NOT EXISTS payload JSONB,
+    ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;  -- 處理失敗次數
+
+UPDATE detections SET is_processed = FALSE WHERE is_processed IS NULL;
+ALTER TABLE detections ALTER COLUMN is_processed SET NOT NULL;
+
+-- 待處理事件依 id 認領；已處理事件依處理時間清除
+CREATE INDEX IF NOT EXISTS idx_detections_pending ON detections (id) WHERE NOT is_processed;
+CREATE INDEX IF NOT EXISTS idx_detections_processed_at ON detections (processed_at) WHERE is_processed;
+
+-- 每個寫入語句只發出一次通知，內容為該語句寫入的最大 id
+CREATE OR REPLACE FUNCTION notify_detections_outbox()
+RETURNS TRIGGER AS $$
+DECLARE
+    last_id INTEGER;
+BEGIN
+    SELECT MAX(id) INTO last_id FROM new_rows;
+    IF last_id IS NOT NULL THEN
+        PERFORM pg_notify('detections_outbox', last_id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS detections_outbox_notify ON detections;
+CREATE TRIGGER detections_outbox_notify AFTER INSERT ON detections REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION notify_detections_outbox();
+
+GRANT ALL PRIVILEGES ON TABLE detections TO ai360;
+GRANT ALL PRIVILEGES ON SEQUENCE detections_id_seq TO ai360;
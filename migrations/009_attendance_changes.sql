@@ -0,0 +1,85 @@
+-- 出勤變更紀錄：attendance_sessions 的每個寫入語句以觸發器寫入差異（開啟、最後出現時間更新、結束、刪除），
+-- 並發出 NOTIFY attendance_changes；API 以遞增的 id 作為 SSE 事件編號，客戶端斷線後可由 Last-Event-ID 續傳
+
+CREATE TABLE IF NOT EXISTS attendance_changes (
+    id BIGSERIAL PRIMARY KEY,
+    change VARCHAR(20) NOT NULL,  -- opened / seen / ended / deleted / cleared
+    session_uuid VARCHAR(36),
+    person_id VARCHAR(50),
+    status VARCHAR(20),
+    arrival_time TIMESTAMP,
+    last_seen_at TIMESTAMP,
+    departure_time TIMESTAMP,
+    changed_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'Asia/Taipei')
+);
+
+CREATE INDEX IF NOT EXISTS idx_attendance_changes_changed_at ON attendance_changes (changed_at);
+
+CREATE OR REPLACE FUNCTION record_attendance_changes()
+RETURNS TRIGGER AS $$
+DECLARE
+    last_id BIGINT;
+BEGIN
+    -- 寫入變更的交易依序進行（持有到交易結束），確保 id 順序即提交順序，
+    -- 讀取端以「id 大於上次讀到的 id」續讀不會遺漏較晚提交的較小 id
+    PERFORM pg_advisory_xact_lock(7862003);
+
+    IF TG_OP = 'INSERT' THEN
+        WITH inserted AS (
+            INSERT INTO attendance_changes (change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time)
+            SELECT CASE WHEN status = 'ended' THEN 'ended' ELSE 'opened' END,
+                   session_uuid, person_id, status, arrival_time, last_seen_at, departure_time
+            FROM new_rows
+            ORDER BY arrival_time
+            RETURNING id
+        )
+        SELECT MAX(id) INTO last_id FROM inserted;
+    ELSIF TG_OP = 'UPDATE' THEN
+        WITH inserted AS (
+            INSERT INTO attendance_changes (change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time)
+            SELECT CASE WHEN n.status = 'ended' AND o.status <> 'ended' THEN 'ended' ELSE 'seen' END,
+                   n.session_uuid, n.person_id, n.status, n.arrival_time, n.last_seen_at, n.departure_time
+            FROM new_rows n
+            JOIN old_rows o ON o.id = n.id
+            WHERE (n.status = 'ended' AND o.status <> 'ended') OR n.last_seen_at > o.last_seen_at
+            ORDER BY n.last_seen_at
+            RETURNING id
+        )
+        SELECT MAX(id) INTO last_id FROM inserted;
+    ELSIF TG_OP = 'DELETE' THEN
+        WITH inserted AS (
+            INSERT INTO attendance_changes (change, session_uuid, person_id, status)
+            SELECT 'deleted', session_uuid, person_id, status FROM old_rows
+            RETURNING id
+        )
+        SELECT MAX(id) INTO last_id FROM inserted;
+    ELSE
+        INSERT INTO attendance_changes (change) VALUES ('cleared') RETURNING id INTO last_id;
+    END IF;
+
+    IF last_id IS NOT NULL THEN
+        PERFORM pg_notify('attendance_changes', last_id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS attendance_changes_insert ON attendance_sessions;
+CREATE TRIGGER attendance_changes_insert AFTER INSERT ON attendance_sessions REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION record_attendance_changes();
+
+DROP TRIGGER IF EXISTS attendance_changes_update ON attendance_sessions;
+CREATE TRIGGER attendance_changes_update AFTER UPDATE ON attendance_sessions
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION record_attendance_changes();
+
+DROP TRIGGER IF EXISTS attendance_changes_delete ON attendance_sessions;
+CREATE TRIGGER attendance_changes_delete AFTER DELETE ON attendance_sessions REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION record_attendance_changes();
+
+DROP TRIGGER IF EXISTS attendance_changes_truncate ON attendance_sessions;
+CREATE TRIGGER attendance_changes_truncate AFTER TRUNCATE ON attendance_sessions
+FOR EACH STATEMENT EXECUTE FUNCTION record_attendance_changes();
+
+GRANT ALL PRIVILEGES ON TABLE attendance_changes TO ai360;
+GRANT ALL PRIVILEGES ON SEQUENCE attendance_changes_id_seq TO ai360;
@@ -0,0 +1,89 @@
+-- 出勤變更改於提交前才取得順序鎖：009 的觸發器在語句中途取得 advisory lock 並持有到交易結束，
+-- 所有寫入 attendance_sessions 的交易（批次寫入、生命週期清理、同步 API）因此整段串行。
+-- 改為語句觸發器只寫入暫存表（不加鎖），延遲到提交時執行的約束觸發器才取得鎖、
+-- 搬入 attendance_changes 並配發 id，鎖只涵蓋交易最後的搬移與提交；
+-- 鎖在交易可見後才釋放，id 順序仍等於提交順序，讀取端以「id 大於上次讀到的 id」續讀不變
+
+CREATE TABLE IF NOT EXISTS attendance_changes_pending (
+    seq BIGSERIAL PRIMARY KEY,  -- 交易內的寫入順序
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    change VARCHAR(20) NOT NULL,
+    session_uuid VARCHAR(36),
+    person_id VARCHAR(50),
+    status VARCHAR(20),
+    arrival_time TIMESTAMP,
+    last_seen_at TIMESTAMP,
+    departure_time TIMESTAMP,
+    changed_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'Asia/Taipei')
+);
+
+CREATE INDEX IF NOT EXISTS idx_attendance_changes_pending_txid ON attendance_changes_pending (txid);
+
+-- attendance_sessions 的語句觸發器：只寫入暫存表
+CREATE OR REPLACE FUNCTION record_attendance_changes()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO attendance_changes_pending (change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time)
+        SELECT CASE WHEN status = 'ended' THEN 'ended' ELSE 'opened' END,
+               session_uuid, person_id, status, arrival_time, last_seen_at, departure_time
+        FROM new_rows
+        ORDER BY arrival_time;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO attendance_changes_pending (change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time)
+        SELECT CASE WHEN n.status = 'ended' AND o.status <> 'ended' THEN 'ended' ELSE 'seen' END,
+               n.session_uuid, n.person_id, n.status, n.arrival_time, n.last_seen_at, n.departure_time
+        FROM new_rows n
+        JOIN old_rows o ON o.id = n.id
+        WHERE (n.status = 'ended' AND o.status <> 'ended') OR n.last_seen_at > o.last_seen_at
+        ORDER BY n.last_seen_at;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO attendance_changes_pending (change, session_uuid, person_id, status)
+        SELECT 'deleted', session_uuid, person_id, status FROM old_rows;
+    ELSE
+        INSERT INTO attendance_changes_pending (change) VALUES ('cleared');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- 提交時執行：本交易的暫存列在鎖內依序搬入 attendance_changes；
+-- 約束觸發器只能逐列觸發，第一次觸發即搬完，之後的觸發查無暫存列直接返回
+CREATE OR REPLACE FUNCTION publish_attendance_changes()
+RETURNS TRIGGER AS $$
+DECLARE
+    last_id BIGINT;
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM attendance_changes_pending WHERE txid = pg_current_xact_id()) THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM pg_advisory_xact_lock(7862003);
+
+    WITH moved AS (
+        DELETE FROM attendance_changes_pending
+        WHERE txid = pg_current_xact_id()
+        RETURNING *
+    ), inserted AS (
+        INSERT INTO attendance_changes (change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time, changed_at)
+        SELECT change, session_uuid, person_id, status, arrival_time, last_seen_at, departure_time, changed_at
+        FROM moved
+        ORDER BY seq
+        RETURNING id
+    )
+    SELECT MAX(id) INTO last_id FROM inserted;
+
+    IF last_id IS NOT NULL THEN
+        PERFORM pg_notify('attendance_changes', last_id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS attendance_changes_publish ON attendance_changes_pending;
+CREATE CONSTRAINT TRIGGER attendance_changes_publish AFTER INSERT ON attendance_changes_pending
+DEFERRABLE INITIALLY DEFERRED
+FOR EACH ROW EXECUTE FUNCTION publish_attendance_changes();
+
+GRANT ALL PRIVILEGES ON TABLE attendance_changes_pending TO ai360;
+GRANT ALL PRIVILEGES ON SEQUENCE attendance_changes_pending_seq_seq TO ai360;
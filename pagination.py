@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+鍵集分頁 (keyset pagination) 游標
+游標為不透明字串，內容是上一頁最後一筆的 (last_seen_at, id)，
+下一頁以 (last_seen_at, id) < 游標 取資料，任何頁數的查詢成本都與第一頁相同
+"""
+
+import json
+import base64
+from datetime import datetime
+
+
+def encode_cursor(last_seen_at, row_id):
+    """將排序鍵編碼為游標"""
+    raw = json.dumps([last_seen_at.isoformat(), int(row_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解碼游標，回傳 (last_seen_at, id)；格式錯誤時拋出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        last_seen_at, row_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.fromisoformat(last_seen_at), int(row_id)
+    except Exception:
+        raise ValueError(f"無效的分頁游標: {cursor}")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+在席狀態機
+在記憶體中維護每位人員的活躍出勤會話，只在會話開啟/結束時寫入資料列，
+last_seen_at 則每隔固定間隔才寫回一次
+"""
+
+import os
+import uuid
+from datetime import timedelta
+from write_behind import taipei_now
+
+
+class PresenceTracker:
+    """記錄每位人員目前的活躍會話 (到達時間、最後出現時間、session UUID)，變更交由寫入佇列批次寫入"""
+
+    def __init__(self, write_queue, session_timeout=None, last_seen_interval=None):
+        self.write_queue = write_queue
+        self.session_timeout = timedelta(seconds=session_timeout if session_timeout is not None
+                                         else int(os.getenv('PRESENCE_SESSION_TIMEOUT', 300)))
+        self.last_seen_interval = timedelta(seconds=last_seen_interval if last_seen_interval is not None
+                                            else int(os.getenv('PRESENCE_LAST_SEEN_INTERVAL', 30)))
+        # {person_id: {'session_uuid', 'person_id', 'arrival_time', 'last_seen_at', 'persisted_last_seen_at'}}
+        self.sessions = {}
+        self.stats = {
+            'opened': 0,
+            'closed': 0,
+            'sightings': 0,
+            'last_seen_writes': 0,
+            'lost': 0,
+            'adopted': 0
+        }
+
+    async def load(self, db):
+        """啟動時從 attendance_sessions WHERE status='active' 重建狀態"""
+        rows = await db.get_active_sessions()
+        for row in rows:
+            current = self.sessions.get(row['person_id'])
+            # 舊資料若同一人有多筆活躍會話，以最後出現者為準
+            if current and current['last_seen_at'] >= row['last_seen_at']:
+                continue
+            self.sessions[row['person_id']] = {
+                'session_uuid': row['session_uuid'],
+                'person_id': row['person_id'],
+                'arrival_time': row['arrival_time'],
+                'last_seen_at': row['last_seen_at'],
+                'persisted_last_seen_at': row['last_seen_at']
+            }
+        print(f"🧭 已從資料庫載入 {len(self.sessions)} 個活躍會話")
+
+    def get(self, person_id):
+        return self.sessions.get(person_id)
+
+    def observe(self, person_id, info=None, now=None):
+        """
+        記錄一次出現，回傳 (是否為新進場, 會話)
+        新進場時寫入新會話；已在場時只更新記憶體，距上次寫回超過間隔才更新 last_seen_at
+        """
+        now = now or taipei_now()
+        self.stats['sightings'] += 1
+        session = self.sessions.get(person_id)
+
+        if session and now - session['last_seen_at'] > self.session_timeout:
+            # 已超時但尚未被 expire() 結束，視為離開後再進場
+            self._close(session)
+            session = None
+
+        if session is None:
+            session = {
+                'session_uuid': str(uuid.uuid4()),
+                'person_id': person_id,
+                'arrival_time': now,
+                'last_seen_at': now,
+                'persisted_last_seen_at': now
+            }
+            self.sessions[person_id] = session
+            self.stats['opened'] += 1
+            self.write_queue.enqueue_session_open(session, info)
+            return True, session
+
+        session['last_seen_at'] = max(session['last_seen_at'], now)
+        if session['last_seen_at'] - session['persisted_last_seen_at'] >= self.last_seen_interval:
+            session['persisted_last_seen_at'] = session['last_seen_at']
+            self.stats['last_seen_writes'] += 1
+            self.write_queue.enqueue_session_touch(session['session_uuid'], session['last_seen_at'])
+        return False, session
+
+    def _close(self, session):
+        """結束會話，離開時間為最後出現時間"""
+        self.sessions.pop(session['person_id'], None)
+        self.stats['closed'] += 1
+        self.write_queue.enqueue_session_close(session['session_uuid'], session['last_seen_at'])
+
+    def checkpoint_idle(self, now=None, lookahead=None):
+        """
+        資料庫端的清理以「已寫回」的 last_seen_at 判斷超時，而寫回最多落後 last_seen_interval；
+        將寫回值已超過 session_timeout（或在 lookahead 內即將超過）、但之後又出現過的會話寫回最新的 last_seen_at，
+        避免仍在場的人員被提早結束、離開時間也才會正確；回傳寫回筆數
+        """
+        now = now or taipei_now()
+        deadline = now - self.session_timeout + (lookahead or timedelta(0))
+        count = 0
+        for session in self.sessions.values():
+            if (session['persisted_last_seen_at'] < deadline
+                    and session['last_seen_at'] > session['persisted_last_seen_at']):
+                session['persisted_last_seen_at'] = session['last_seen_at']
+                self.write_queue.enqueue_session_touch(session['session_uuid'], session['last_seen_at'])
+                count += 1
+        self.stats['last_seen_writes'] += count
+        return count
+
+    def end(self, session_uuids):
+        """移除已在資料庫中結束的會話"""
+        self._drop(session_uuids, 'closed')
+
+    def discard(self, session_uuids):
+        """移除已在資料庫中被結束或刪除的會話，下次出現時重新開啟"""
+        self._drop(session_uuids, 'lost')
+
+    def _drop(self, session_uuids, stat):
+        session_uuids = set(session_uuids)
+        for person_id, session in list(self.sessions.items()):
+            if session['session_uuid'] in session_uuids:
+                del self.sessions[person_id]
+                self.stats[stat] += 1
+
+    def adopt(self, adopted_sessions):
+        """資料庫已有同一人員的活躍會話時，改用既有的 session_uuid 與到達時間"""
+        by_uuid = {local_uuid: (session_uuid, arrival_time)
+                   for local_uuid, session_uuid, arrival_time in adopted_sessions}
+        for session in self.sessions.values():
+            if session['session_uuid'] in by_uuid:
+                session['session_uuid'], arrival_time = by_uuid[session['session_uuid']]
+                session['arrival_time'] = min(session['arrival_time'], arrival_time)
+                self.stats['adopted'] += 1
+
+    def remove(self, person_id):
+        """移除指定人員的狀態（例如臨時訪客被清理）"""
+        return self.sessions.pop(person_id, None)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+人員資料快取
+person_id → 姓名/角色/部門/員工編號/郵箱 一次載入後常駐記憶體，含 embedding 的單人資料則在查詢時按需快取。
+本程序寫入時立即失效，其他程序的寫入則透過 face_profiles 的 NOTIFY 失效；
+通知連線中斷期間版本未知，一律直接查詢資料庫
+"""
+
+import threading
+from response_cache import DataVersionWatcher
+
+
+class ProfileCache:
+    """以 (資料庫通知版本, 本地寫入次數) 為版本的人員資料快取，兩者皆只增不減，可直接比較新舊"""
+
+    def __init__(self, source=None):
+        # source 為 DataVersionListener / DataVersionWatcher，提供 face_profiles 的最新版本
+        self.source = source
+        self.local_version = 0
+        self.profiles = None  # {person_id: {'name', 'role', 'department', 'employee_id', 'email', 'register_time'}}
+        self.persons = {}  # {person_id: get_person_by_id 的結果（含 embedding）}
+        self.loaded_version = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'reloads': 0,
+            'invalidations': 0
+        }
+        self._lock = threading.Lock()
+
+    def version(self):
+        """目前版本；通知未連線時回傳 None（不使用快取）"""
+        remote = self.source.version if self.source else None
+        if remote is None:
+            return None
+        return (remote, self.local_version)
+
+    def get_profiles(self):
+        """取得全部人員資料（不含 embedding），快取失效時回傳 None"""
+        version = self.version()
+        with self._lock:
+            if version is not None and self.profiles is not None and self.loaded_version == version:
+                self.stats['hits'] += 1
+                return self.profiles
+            self.stats['misses'] += 1
+            return None
+
+    def store_profiles(self, version, profiles):
+        """存入查詢結果；version 須是查詢前取得的版本，查詢期間有變更時此結果不會被使用"""
+        if version is None:
+            return
+        with self._lock:
+            if self.loaded_version is not None and version < self.loaded_version:
+                return
+            if self.loaded_version != version:
+                self.persons = {}
+            self.profiles = profiles
+            self.loaded_version = version
+            self.stats['reloads'] += 1
+
+    def get_person(self, person_id):
+        """
+        取得單人資料（含 embedding），回傳 (是否命中, 資料)
+        人員清單有效且其中沒有此人時回傳 (True, None)，不必再查詢資料庫
+        """
+        version = self.version()
+        with self._lock:
+            if version is None or self.loaded_version != version:
+                return False, None
+            if person_id in self.persons:
+                self.stats['hits'] += 1
+                return True, dict(self.persons[person_id])
+            if self.profiles is not None and person_id not in self.profiles:
+                self.stats['hits'] += 1
+                return True, None
+            self.stats['misses'] += 1
+            return False, None
+
+    def store_person(self, version, person_id, person):
+        """存入單人查詢結果（查詢期間版本改變則捨棄）"""
+        if version is None or person is None:
+            return
+        with self._lock:
+            if self.loaded_version is not None and version < self.loaded_version:
+                return
+            if self.loaded_version != version:
+                # 版本較新：舊的人員清單與單人資料一併作廢
+                self.profiles = None
+                self.persons = {}
+                self.loaded_version = version
+            self.persons[person_id] = person
+
+    def invalidate(self):
+        """本程序寫入人員資料後呼叫"""
+        with self._lock:
+            self.local_version += 1
+            self.profiles = None
+            self.persons = {}
+            self.stats['invalidations'] += 1
+
+    def on_change(self, version):
+        """收到其他程序的變更通知：釋放舊資料（版本比對已使其失效）"""
+        with self._lock:
+            self.profiles = None
+            self.persons = {}
+
+
+_sync_caches = {}
+_sync_caches_lock = threading.Lock()
+
+
+def get_sync_profile_cache(database_url):
+    """同步版資料庫共用的快取（每個程序、每個資料庫一份），以背景執行緒監聽變更"""
+    with _sync_caches_lock:
+        cache = _sync_caches.get(database_url)
+        if cache is None:
+            cache = ProfileCache()
+            cache.source = DataVersionWatcher(database_url, on_change=cache.on_change, tables=('face_profiles',))
+            cache.source.start()
+            _sync_caches[database_url] = cache
+        return cache
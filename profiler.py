@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+線上取樣分析器
+不需重新啟動服務：管理員觸發後，由背景執行緒每隔固定間隔讀取所有執行緒的呼叫堆疊 (sys._current_frames)，
+N 秒後輸出火焰圖工具（flamegraph.pl、speedscope）可讀的 collapsed stack 文字；另可擷取接下來 K 幀的各階段耗時。
+未觸發時沒有任何取樣執行緒或掛勾，不影響服務
+
+需設定 PROFILER_ADMIN_TOKEN 才會啟用。WebSocket 伺服器以 profile / capture_frames 訊息觸發，
+其他程序（app.py）以 start_admin_server() 啟動預設只聽本機的 HTTP 端點（逐幀耗時僅在登記了幀處理流程的程序提供）：
+    curl -H "X-Admin-Token: $PROFILER_ADMIN_TOKEN" "http://127.0.0.1:7864/debug/profile?seconds=10" > out.collapsed
+    flamegraph.pl out.collapsed > out.svg
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import metrics
+
+MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', 120))
+MAX_FRAMES = 1000
+
+# 葉節點為這些函式的樣本視為閒置（事件迴圈等待 I/O、執行緒等待鎖或佇列），預設不列入火焰圖
+IDLE_FUNCTIONS = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('socket.py', 'accept'),
+    ('selectors.py', 'poll'),
+}
+
+
+class ProfilerBusy(Exception):
+    """同一程序同時只允許一個取樣"""
+
+
+class NoFramePipeline(Exception):
+    """本程序沒有以 FrameTrace 計時的幀處理流程，無法擷取逐幀耗時"""
+
+
+_profile_lock = threading.Lock()
+_frame_pipeline = None
+
+
+def register_frame_pipeline(name):
+    """處理幀的服務（websocket_realtime）啟動時登記，capture_frames 才可使用"""
+    global _frame_pipeline
+    _frame_pipeline = name
+
+
+def check_token(token):
+    """比對管理員權杖；未設定 PROFILER_ADMIN_TOKEN 時一律拒絕"""
+    expected = os.getenv('PROFILER_ADMIN_TOKEN', '')
+    return bool(expected and token) and hmac.compare_digest(str(token), expected)
+
+
+def _stack(frame):
+    """由葉節點往上讀取呼叫堆疊，回傳 [(檔名, 函式, 起始行)]"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+        frame = frame.f_back
+    return stack
+
+
+def sample_stacks(seconds, interval=None, include_idle=False):
+    """
+    阻塞 seconds 秒取樣所有執行緒（本執行緒除外），回傳 (collapsed 文字, 統計)。
+    每行為「執行緒;外層函式;...;內層函式 樣本數」；函式以起始行區分，同一函式內不同行合併計算
+    """
+    interval = interval or float(os.getenv('PROFILER_INTERVAL', 0.005))
+    seconds = max(0.1, min(float(seconds), MAX_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        samples = idle = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        next_at = started
+        while time.perf_counter() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                stack = _stack(frame)
+                if not stack:
+                    continue
+                if not include_idle and stack[0][:2] in IDLE_FUNCTIONS:
+                    idle += 1
+                    continue
+                stacks[(ident, tuple(stack))] += 1
+            samples += 1
+            # 固定取樣節奏；落後時（例如 GIL 長時間被佔用）從目前時間重新計算
+            next_at = max(next_at + interval, time.perf_counter())
+            time.sleep(max(0.0, next_at - time.perf_counter()))
+        elapsed = time.perf_counter() - started
+    finally:
+        _profile_lock.release()
+
+    lines = Counter()
+    for (ident, stack), count in stacks.items():
+        frames = ';'.join(f"{function} ({filename}:{line})" for filename, function, line in reversed(stack))
+        lines[f"{names.get(ident, ident)};{frames}"] += count
+    collapsed = ''.join(f"{line} {count}\n" for line, count in sorted(lines.items()))
+    stats = {
+        'seconds': round(elapsed, 2),
+        'interval_ms': round(interval * 1000, 2),
+        'samples': samples,
+        'stacks': sum(stacks.values()),
+        'idle_stacks': idle,
+        'threads': len({ident for ident, _ in stacks})
+    }
+    return collapsed, stats
+
+
+class FrameCapture:
+    """收集接下來 count 幀的各階段耗時（由 FrameTrace.finish 回呼，在處理幀的執行緒上執行）"""
+
+    def __init__(self, count):
+        self.count = count
+        self.frames = []
+        self.done = threading.Event()
+
+    def __call__(self, trace, total, e2e):
+        if self.done.is_set():
+            return
+        stages = {}
+        for stage, seconds in trace.stages:
+            stages[stage] = stages.get(stage, 0) + seconds
+        self.frames.append({
+            'stages_ms': {stage: round(seconds * 1000, 3) for stage, seconds in stages.items()},
+            'total_ms': round(total * 1000, 3),
+            'e2e_ms': round(e2e * 1000, 1) if e2e is not None else None,
+            'db_round_trips': trace.round_trips
+        })
+        if len(self.frames) >= self.count:
+            self.done.set()
+
+    def report(self):
+        """逐幀明細與各階段的平均、最大值及佔總時間比例"""
+        total = sum(frame['total_ms'] for frame in self.frames)
+        stages = {}
+        for frame in self.frames:
+            for stage, ms in frame['stages_ms'].items():
+                stages.setdefault(stage, []).append(ms)
+        return {
+            'frames': len(self.frames),
+            'requested': self.count,
+            'total_ms': {
+                'avg': round(total / len(self.frames), 3) if self.frames else None,
+                'max': max((frame['total_ms'] for frame in self.frames), default=None)
+            },
+            'stages': {
+                stage: {
+                    'frames': len(values),
+                    'avg_ms': round(sum(values) / len(values), 3),
+                    'max_ms': max(values),
+                    'share': round(sum(values) / total, 3) if total else None
+                }
+                for stage, values in stages.items()
+            },
+            'detail': self.frames
+        }
+
+
+def capture_frames(count, timeout=60):
+    """阻塞等待接下來 count 幀處理完成（最多 timeout 秒），回傳 FrameCapture.report()"""
+    if _frame_pipeline is None:
+        raise NoFramePipeline()
+    capture = FrameCapture(max(1, min(int(count), MAX_FRAMES)))
+    metrics.FRAME_LISTENERS.append(capture)
+    try:
+        capture.done.wait(min(float(timeout), MAX_SECONDS))
+    finally:
+        metrics.FRAME_LISTENERS.remove(capture)
+        capture.done.set()
+    return capture.report()
+
+
+async def _in_thread(func, *args):
+    # 使用獨立執行緒等待，不佔用事件迴圈預設的執行緒池
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='profiler') as executor:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def profile_async(seconds, interval=None, include_idle=False):
+    """sample_stacks 的非同步版本，取樣期間事件迴圈照常執行"""
+    return await _in_thread(sample_stacks, seconds, interval, include_idle)
+
+
+async def capture_frames_async(count, timeout=60):
+    """capture_frames 的非同步版本；幀在事件迴圈上處理，等待需在其他執行緒"""
+    return await _in_thread(capture_frames, count, timeout)
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if not check_token(self.headers.get('X-Admin-Token') or params.get('token')):
+            return self._reply(403, {'error': '需要管理員權杖'})
+        try:
+            if url.path == '/debug/profile':
+                collapsed, stats = sample_stacks(
+                    float(params.get('seconds', 10)),
+                    float(params['interval_ms']) / 1000 if 'interval_ms' in params else None,
+                    params.get('idle') == 'true'
+                )
+                headers = {f"X-Profile-{key.replace('_', '-')}": value for key, value in stats.items()}
+                return self._reply(200, collapsed, 'text/plain; charset=utf-8', headers)
+            if url.path == '/debug/frames':
+                report = capture_frames(int(params.get('count', 20)), float(params.get('timeout', 60)))
+                return self._reply(200, report)
+            return self._reply(404, {'error': f'未知路徑: {url.path}'})
+        except ProfilerBusy:
+            return self._reply(409, {'error': '已有取樣進行中'})
+        except NoFramePipeline:
+            return self._reply(404, {'error': '此程序沒有逐幀計時的處理流程（僅 WebSocket 即時識別服務提供）'})
+        except ValueError as e:
+            return self._reply(400, {'error': str(e)})
+
+    def _reply(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body, ensure_ascii=False)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"🔬 取樣分析請求: {format % args}")
+
+
+def start_admin_server(host=None, port=None):
+    """於背景執行緒啟動取樣分析 HTTP 端點；未設定 PROFILER_ADMIN_TOKEN 時不啟動"""
+    if not os.getenv('PROFILER_ADMIN_TOKEN'):
+        return None
+    host = host or os.getenv('PROFILER_HOST', '127.0.0.1')
+    port = port or int(os.getenv('PROFILER_PORT', 7864))
+    try:
+        server = ThreadingHTTPServer((host, port), _AdminHandler)
+    except OSError as e:
+        print(f"⚠️ 取樣分析端點啟動失敗: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='profiler-admin', daemon=True).start()
+    print(f"🔬 取樣分析端點已啟動: http://{host}:{port}/debug/profile")
+    return server
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+查詢結果短效快取
+以正規化後的查詢參數為鍵，ETag 由資料版本、參數與 TTL 時間區段組成；
+資料版本透過 LISTEN data_changed 取得，出勤或人員資料變更時快取立即失效
+"""
+
+import os
+import json
+import time
+import select
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+DATA_CHANGED_CHANNEL = 'data_changed'
+
+
+class ResponseCache:
+    """以查詢參數為鍵的快取，項目只在 ETag 相同（版本未變且仍在同一 TTL 區段）時命中"""
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl if ttl is not None else float(os.getenv('API_CACHE_TTL', 5))
+        self.max_entries = max_entries or int(os.getenv('API_CACHE_MAX_ENTRIES', 256))
+        self.entries = OrderedDict()  # {key: (etag, value)}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'not_modified': 0
+        }
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**params):
+        """正規化查詢參數（與參數順序無關）"""
+        return json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+
+    def etag(self, key, version):
+        """資料版本未知（尚未連上通知）或停用快取時回傳 None"""
+        if version is None or self.ttl <= 0:
+            return None
+        bucket = int(time.time() // self.ttl)
+        digest = hashlib.sha1(f"{version}:{bucket}:{key}".encode('utf-8')).hexdigest()[:20]
+        return f'W/"{digest}"'
+
+    def get(self, key, etag):
+        if etag is None:
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == etag:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, key, etag, value):
+        if etag is None:
+            return
+        with self._lock:
+            self.entries[key] = (etag, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+
+def if_none_match(header, etag):
+    """判斷 If-None-Match 標頭是否包含目前的 ETag"""
+    if not header or etag is None:
+        return False
+    return any(tag.strip() in (etag, '*') for tag in header.split(','))
+
+
+def parse_notify(payload):
+    """解析通知內容 '資料表:版本'"""
+    table, _, version = payload.rpartition(':')
+    return table, int(version)
+
+
+class DataVersionListener:
+    """
+    以 asyncpg 專用連線 LISTEN data_changed，維護最新資料版本（斷線期間版本為 None）
+    指定 tables 時只有這些資料表的變更會更新版本
+    """
+
+    def __init__(self, database_url, on_change=None, reconnect_delay=5, tables=None):
+        self.database_url = database_url
+        self.on_change = on_change
+        self.tables = tables
+        self.reconnect_delay = reconnect_delay
+        self.version = None
+        self._conn = None
+        self._task = None
+        self._closed = False
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        import asyncpg
+        while not self._closed:
+            try:
+                self._conn = await asyncpg.connect(self.database_url)
+                lost = asyncio.Event()
+                self._conn.add_termination_listener(lambda conn: lost.set())
+                await self._conn.add_listener(DATA_CHANGED_CHANNEL, self._on_notify)
+                # 先開始監聽再讀取目前版本，避免遺漏兩者之間的變更
+                self._set_version(await self._conn.fetchval("SELECT last_value FROM data_version_seq"))
+                await lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 資料版本監聽中斷: {e}")
+            self.version = None
+            if not self._closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _on_notify(self, conn, pid, channel, payload):
+        table, version = parse_notify(payload)
+        if self.tables is None or table in self.tables:
+            self._set_version(version)
+
+    def _set_version(self, version):
+        if self.version is None or version > self.version:
+            self.version = version
+            if self.on_change:
+                self.on_change(version)
+
+    async def close(self):
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._conn and not self._conn.is_closed():
+            await self._conn.close()
+
+
+class DataVersionWatcher(threading.Thread):
+    """同步版本：在背景執行緒以 psycopg2 LISTEN data_changed（供 Gradio 程序使用）"""
+
+    def __init__(self, database_url, on_change=None, reconnect_delay=5, tables=None):
+        super().__init__(daemon=True)
+        self.database_url = database_url
+        self.on_change = on_change
+        self.tables = tables
+        self.reconnect_delay = reconnect_delay
+        self.version = None
+
+    def run(self):
+        import psycopg2
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.database_url)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {DATA_CHANGED_CHANNEL}")
+                    cursor.execute("SELECT last_value FROM data_version_seq")
+                    self._set_version(cursor.fetchone()[0])
+                while True:
+                    select.select([conn], [], [], 30)
+                    conn.poll()
+                    while conn.notifies:
+                        table, version = parse_notify(conn.notifies.pop(0).payload)
+                        if self.tables is None or table in self.tables:
+                            self._set_version(version)
+            except Exception as e:
+                print(f"⚠️ 資料版本監聽中斷: {e}")
+            finally:
+                self.version = None
+                if conn:
+                    conn.close()
+            time.sleep(self.reconnect_delay)
+
+    def _set_version(self, version):
+        if self.version is None or version > self.version:
+            self.version = version
+            if self.on_change:
+                self.on_change(version)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+即時識別的每個身分狀態
+人員、陌生人與客戶端連線的狀態都存在同一個有上限的儲存區：
+每筆為固定欄位的紀錄，依種類設定存活時間，以最小堆積依到期時間淘汰，
+超過筆數上限時淘汰最久未使用者
+"""
+
+import os
+import heapq
+from collections import OrderedDict, deque
+
+PERSON = 'person'
+STRANGER = 'stranger'
+CLIENT = 'client'
+
+
+class IdentityState:
+    """單一身分的狀態紀錄（固定欄位）"""
+
+    __slots__ = ('kind', 'key', 'last_seen', 'expires_at',
+                 'last_recognition', 'detections', 'notifications', 'frames', 'data')
+
+    def __init__(self, kind, key, detection_history=10, notification_history=5):
+        self.kind = kind
+        self.key = key
+        self.last_seen = 0.0
+        self.expires_at = 0.0
+        self.last_recognition = None  # 最後一次寫入識別日誌的時間（人員）
+        self.detections = deque(maxlen=detection_history) if kind in (PERSON, STRANGER) else None  # 最近的檢測時間（人員、陌生人）
+        self.notifications = deque(maxlen=notification_history) if kind == PERSON else None  # 最近的通知時間
+        self.frames = 0  # 已收到的幀數（客戶端）
+        self.data = None  # 陌生人的資料
+
+
+class IdentityStateStore:
+    """以 (種類, 鍵) 為索引的有界狀態儲存區"""
+
+    def __init__(self, ttls, max_entries=None, on_evict=None):
+        # ttls: {種類: 存活秒數}，最後一次 touch 後超過即淘汰
+        self.ttls = ttls
+        self.max_entries = max_entries or int(os.getenv('STATE_MAX_ENTRIES', 10000))
+        # on_evict(record, reason)：到期 ('expired') 或超過上限 ('evicted') 時呼叫，主動 pop 不呼叫
+        self.on_evict = on_evict
+        self.records = OrderedDict()  # {(種類, 鍵): IdentityState}，依最近使用排序
+        self._expiry = []  # [(到期時間, 序號, (種類, 鍵))]，紀錄更新後舊項目留在堆積中，取出時比對略過
+        self._sequence = 0
+        self.stats = {
+            'expired': 0,
+            'evicted': 0
+        }
+        self.removed_by_kind = {}  # {種類: {'expired': 筆數, 'evicted': 筆數}}
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, kind, key):
+        """取得紀錄（不更新使用時間）"""
+        return self.records.get((kind, key))
+
+    def touch(self, kind, key, now):
+        """取得或建立紀錄並延長存活時間"""
+        self.expire(now)
+        record_key = (kind, key)
+        record = self.records.get(record_key)
+        if record is None:
+            record = IdentityState(kind, key)
+            self.records[record_key] = record
+            self._evict_overflow()
+        else:
+            self.records.move_to_end(record_key)
+        record.last_seen = now
+        record.expires_at = now + self.ttls[kind]
+        self._sequence += 1
+        heapq.heappush(self._expiry, (record.expires_at, self._sequence, record_key))
+        self._compact()
+        return record
+
+    def pop(self, kind, key):
+        return self.records.pop((kind, key), None)
+
+    def expire(self, now):
+        """淘汰所有已到期的紀錄，回傳淘汰數量"""
+        expired = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, _, record_key = heapq.heappop(self._expiry)
+            record = self.records.get(record_key)
+            if record is None or record.expires_at != expires_at:
+                continue
+            del self.records[record_key]
+            expired += 1
+            self._count_removed(record, 'expired')
+            self._notify(record, 'expired')
+        self.stats['expired'] += expired
+        return expired
+
+    def _evict_overflow(self):
+        while len(self.records) > self.max_entries:
+            _, record = self.records.popitem(last=False)
+            self.stats['evicted'] += 1
+            self._count_removed(record, 'evicted')
+            self._notify(record, 'evicted')
+
+    def _compact(self):
+        # 堆積中過時項目過多時重建，避免頻繁 touch 使堆積無限成長
+        if len(self._expiry) > 4 * len(self.records) + 64:
+            self._expiry = [(record.expires_at, index, record_key)
+                            for index, (record_key, record) in enumerate(self.records.items())]
+            heapq.heapify(self._expiry)
+
+    def _count_removed(self, record, reason):
+        counts = self.removed_by_kind.setdefault(record.kind, {'expired': 0, 'evicted': 0})
+        counts[reason] += 1
+
+    def _notify(self, record, reason):
+        if self.on_evict:
+            try:
+                self.on_evict(record, reason)
+            except Exception as e:
+                print(f"⚠️ 狀態淘汰回呼發生錯誤: {e}")
+
+    def snapshot(self):
+        """目前大小、累計淘汰數，以及各種類的筆數與淘汰數"""
+        by_kind = {kind: {'size': 0, **counts} for kind, counts in self.removed_by_kind.items()}
+        for kind, _ in self.records:
+            by_kind.setdefault(kind, {'size': 0, 'expired': 0, 'evicted': 0})['size'] += 1
+        return {
+            **self.stats,
+            'size': len(self.records),
+            'max_entries': self.max_entries,
+            'by_kind': by_kind
+        }
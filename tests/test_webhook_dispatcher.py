@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+webhook 發送器斷路器測試：以本機 aiohttp 接收端模擬各種回應
+執行：python -m pytest tests/ 或 python -m unittest discover tests
+"""
+
+import os
+import sys
+import asyncio
+import unittest
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+class StubReceiver:
+    """依 status 回應的接收端，delay 秒後才回應"""
+
+    def __init__(self):
+        self.status = 200
+        self.delay = 0.0
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def handle(self, request):
+        self.requests += 1
+        await request.read()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.json_response({'status': self.status}, status=self.status)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/webhook', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/webhook'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+
+async def wait_until(condition, timeout=3.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError('等待逾時')
+        await asyncio.sleep(0.01)
+
+
+class CircuitBreakerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.receiver = StubReceiver()
+        await self.receiver.start()
+        self.dispatcher = WebhookDispatcher(
+            {'test': self.receiver.url}, workers=1, batch_size=1, max_retries=0,
+            backoff_base=0.01, timeout=2, breaker_threshold=1, breaker_reset=0.2)
+        self.dispatcher.start()
+        self.target = self.dispatcher.targets['test']
+        self.breaker = self.target.breaker
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close(timeout=0.5)
+        await self.receiver.close()
+
+    async def open_breaker(self):
+        self.receiver.status = 500
+        self.dispatcher.submit('test', {'event': 'fail'})
+        await wait_until(lambda: self.target.stats['failed'] == 1)
+        self.assertEqual(self.breaker.state, 'open')
+        await asyncio.sleep(0.25)
+        self.assertEqual(self.breaker.state, 'half_open')
+
+    async def test_rejected_trial_closes_breaker(self):
+        """開路 → 半開 → 試探請求收到 4xx → 關閉，之後的事件照常送出"""
+        await self.open_breaker()
+
+        self.receiver.status = 400
+        self.dispatcher.submit('test', {'event': 'rejected'})
+        await wait_until(lambda: self.target.stats['failed'] == 2)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertFalse(self.breaker.trial)
+
+        self.receiver.status = 200
+        self.dispatcher.submit('test', {'event': 'ok'})
+        await wait_until(lambda: self.target.stats['delivered'] == 1, timeout=0.5)
+
+    async def test_cancelled_trial_is_released(self):
+        """試探請求進行中被取消時釋放試探，下一個請求可以重新試探"""
+        await self.open_breaker()
+
+        self.receiver.status = 200
+        self.receiver.delay = 1.0
+        requests = self.receiver.requests
+        task = asyncio.create_task(self.dispatcher._deliver(self.target, [({'event': 'slow'}, 0)]))
+        await wait_until(lambda: self.receiver.requests == requests + 1)
+        self.assertTrue(self.breaker.trial)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertFalse(self.breaker.trial)
+        self.assertEqual(self.breaker.wait_time(), 0.0)
+
+
+class LatencyTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.receiver = StubReceiver()
+        await self.receiver.start()
+        self.dispatcher = WebhookDispatcher(
+            {'test': self.receiver.url}, workers=1, batch_size=1, max_retries=0, timeout=2)
+        self.dispatcher.start()
+        self.target = self.dispatcher.targets['test']
+
+    async def asyncTearDown(self):
+        await self.dispatcher.close(timeout=0.5)
+        await self.receiver.close()
+
+    async def test_e2e_latency_includes_queue_wait(self):
+        """單一 worker 依序送出：後面的事件在佇列中等待，端到端時間大於請求耗時"""
+        self.receiver.delay = 0.05
+        for index in range(3):
+            self.dispatcher.submit('test', {'event': index})
+        await wait_until(lambda: self.target.stats['delivered'] == 3)
+
+        snapshot = self.target.snapshot()
+        self.assertEqual(len(self.target.e2e_latencies), 3)
+        self.assertGreaterEqual(snapshot['latency_avg_ms'], 50)
+        self.assertGreaterEqual(max(self.target.e2e_latencies), 150)
+        self.assertGreater(snapshot['e2e_latency_avg_ms'], snapshot['latency_avg_ms'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Webhook 非同步發送器
+事件放入各目標的有界佇列後立即返回，由背景工作任務以長連線 (keep-alive) 的
+aiohttp session 發送；失敗時以指數退避重試，連續失敗時斷路器暫停發送，
+可選擇在時間窗內將同一目標的事件合併為一次請求
+
+本機測試：python webhook_dispatcher.py stub --port 8001 [--fail-rate 0.3] [--delay 0.5]
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from collections import deque
+
+import aiohttp
+
+
+class CircuitBreaker:
+    """連續失敗達門檻即開路 reset_timeout 秒，之後半開放行一次請求，成功才恢復"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False  # 半開狀態下已有一個請求在嘗試
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def wait_time(self):
+        """距離可以發送的秒數，0 表示可立即發送（半開時只放行一個請求）"""
+        state = self.state
+        if state == 'closed':
+            return 0.0
+        if state == 'half_open' and not self.trial:
+            self.trial = True
+            return 0.0
+        if state == 'half_open':
+            return 1.0
+        return self.opened_at + self.reset_timeout - time.monotonic()
+
+    def release_trial(self):
+        """半開試探的請求未得到結果（例如被取消）時釋放，讓下一個請求重新試探"""
+        self.trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.trial:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class RetryableError(Exception):
+    """可重試的發送失敗（連線錯誤、逾時、429、5xx）"""
+
+
+class RejectedError(Exception):
+    """接收端拒絕的請求（429 以外的 4xx），不重試；端點仍有回應，斷路器視為成功"""
+
+
+class WebhookTarget:
+    """單一 webhook 目標：長連線 session、有界佇列、工作任務與統計"""
+
+    def __init__(self, name, url, queue_size, batch_size, batch_window, breaker):
+        self.name = name
+        self.url = url
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.breaker = breaker
+        self.session = None
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.in_flight = 0
+        self.latencies = deque(maxlen=256)  # 最近成功請求的耗時（毫秒）
+        self.e2e_latencies = deque(maxlen=256)  # 最近送達事件自放入佇列到送達的時間（毫秒，含排隊、等待斷路器與重試）
+        self.stats = {
+            'enqueued': 0,
+            'delivered': 0,
+            'requests': 0,
+            'retries': 0,
+            'failed': 0,
+            'dropped': 0
+        }
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            'queue_depth': len(self.queue),
+            'in_flight': self.in_flight,
+            'breaker': self.breaker.state,
+            'breaker_opened': self.breaker.opened,
+            **_latency_summary('latency', self.latencies),
+            **_latency_summary('e2e_latency', self.e2e_latencies)
+        }
+
+
+def _latency_summary(prefix, values):
+    values = sorted(values)
+    return {
+        f'{prefix}_avg_ms': round(sum(values) / len(values), 2) if values else 0.0,
+        f'{prefix}_p95_ms': round(values[int(len(values) * 0.95)], 2) if values else 0.0
+    }
+
+
+class WebhookDispatcher:
+    """管理多個 webhook 目標的背景發送"""
+
+    def __init__(self, targets, queue_size=None, workers=None, batch_size=None, batch_window_ms=None,
+                 max_retries=None, backoff_base=None, backoff_max=None, timeout=None,
+                 breaker_threshold=None, breaker_reset=None):
+        # targets: {名稱: URL}
+        self.queue_size = queue_size or int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+        self.workers = workers or int(os.getenv('WEBHOOK_WORKERS', 2))
+        batch_size = batch_size or int(os.getenv('WEBHOOK_BATCH_SIZE', 1))
+        batch_window = (batch_window_ms if batch_window_ms is not None
+                        else int(os.getenv('WEBHOOK_BATCH_WINDOW_MS', 200))) / 1000
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('WEBHOOK_MAX_RETRIES', 5))
+        self.backoff_base = backoff_base or float(os.getenv('WEBHOOK_BACKOFF_BASE', 0.5))
+        self.backoff_max = backoff_max or float(os.getenv('WEBHOOK_BACKOFF_MAX', 30))
+        self.timeout = aiohttp.ClientTimeout(total=timeout or float(os.getenv('WEBHOOK_TIMEOUT', 5)))
+        breaker_threshold = breaker_threshold or int(os.getenv('WEBHOOK_BREAKER_THRESHOLD', 5))
+        breaker_reset = breaker_reset or float(os.getenv('WEBHOOK_BREAKER_RESET', 30))
+        self.targets = {
+            name: WebhookTarget(name, url, self.queue_size, batch_size, batch_window,
+                                CircuitBreaker(breaker_threshold, breaker_reset))
+            for name, url in targets.items()
+        }
+        self._closed = False
+
+    def start(self):
+        """建立各目標的長連線 session 並啟動工作任務"""
+        for target in self.targets.values():
+            if target.session is None:
+                connector = aiohttp.TCPConnector(limit=self.workers, keepalive_timeout=60)
+                target.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+                target.tasks = [asyncio.create_task(self._worker(target)) for _ in range(self.workers)]
+
+    def submit(self, name, payload):
+        """加入一個事件（不等待發送）；佇列已滿時丟棄最舊的事件"""
+        target = self.targets[name]
+        if self._closed:
+            target.stats['dropped'] += 1
+            return
+        if len(target.queue) >= target.queue_size:
+            target.queue.popleft()
+            target.stats['dropped'] += 1
+            if target.stats['dropped'] % 100 == 1:
+                print(f"⚠️ {name} webhook 佇列已滿 ({len(target.queue)})，丟棄最舊事件 (累計 {target.stats['dropped']})")
+        target.queue.append((payload, time.monotonic()))
+        target.stats['enqueued'] += 1
+        target.wakeup.set()
+
+    async def _take_batch(self, target):
+        """取出下一批事件；啟用合併時等待時間窗或累積到 batch_size"""
+        while not target.queue:
+            target.wakeup.clear()
+            await target.wakeup.wait()
+        if target.batch_size > 1 and len(target.queue) < target.batch_size:
+            deadline = target.queue[0][1] + target.batch_window
+            while len(target.queue) < target.batch_size and time.monotonic() < deadline:
+                target.wakeup.clear()
+                try:
+                    await asyncio.wait_for(target.wakeup.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+            if not target.queue:
+                return []
+        return [target.queue.popleft() for _ in range(min(target.batch_size, len(target.queue)))]
+
+    async def _worker(self, target):
+        while True:
+            batch = await self._take_batch(target)
+            if not batch:
+                continue
+            target.in_flight += 1
+            try:
+                await self._deliver(target, batch)
+            except asyncio.CancelledError:
+                # 關閉時未送出的事件放回佇列前端，由 close() 統計
+                target.queue.extendleft(reversed(batch))
+                raise
+            finally:
+                target.in_flight -= 1
+
+    async def _deliver(self, target, batch):
+        """發送一批事件，可重試的錯誤以指數退避（含隨機抖動）重試"""
+        payloads = [payload for payload, _ in batch]
+        body = payloads[0] if target.batch_size == 1 else {'events': payloads}
+        attempt = 0
+        while True:
+            wait = target.breaker.wait_time()
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = target.breaker.wait_time()
+            # 半開時取得放行的即為試探請求；不論結果或被取消都需釋放，否則其他請求會一直等待
+            trial = target.breaker.trial
+            try:
+                start = time.perf_counter()
+                await self._post(target, body)
+            except RetryableError as e:
+                target.breaker.record_failure()
+                error = e
+            except RejectedError as e:
+                target.breaker.record_success()
+                target.stats['failed'] += len(batch)
+                print(f"❌ {target.name} webhook 被拒絕: {e}")
+                return
+            except Exception as e:
+                target.stats['failed'] += len(batch)
+                print(f"❌ {target.name} webhook 發送失敗: {e}")
+                return
+            else:
+                target.breaker.record_success()
+                target.latencies.append((time.perf_counter() - start) * 1000)
+                delivered_at = time.monotonic()
+                target.e2e_latencies.extend((delivered_at - enqueued_at) * 1000 for _, enqueued_at in batch)
+                target.stats['delivered'] += len(batch)
+                return
+            finally:
+                if trial:
+                    target.breaker.release_trial()
+            if attempt >= self.max_retries:
+                target.stats['failed'] += len(batch)
+                print(f"❌ {target.name} webhook 發送失敗，已重試 {attempt} 次: {error}")
+                return
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+            attempt += 1
+            target.stats['retries'] += 1
+            await asyncio.sleep(delay)
+
+    async def _post(self, target, body):
+        target.stats['requests'] += 1
+        try:
+            async with target.session.post(target.url, json=body) as response:
+                await response.read()
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableError(f"HTTP {response.status}")
+                if response.status >= 400:
+                    raise RejectedError(f"HTTP {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise RetryableError(repr(e)) from e
+
+    async def close(self, timeout=5.0):
+        """停止接收事件，在 timeout 秒內盡量送完佇列，之後取消工作任務並關閉連線"""
+        self._closed = True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and any(
+                target.queue or target.in_flight for target in self.targets.values()):
+            await asyncio.sleep(0.05)
+        for target in self.targets.values():
+            for task in target.tasks:
+                task.cancel()
+            await asyncio.gather(*target.tasks, return_exceptions=True)
+            if target.queue:
+                print(f"⚠️ {target.name} webhook 關閉時仍有 {len(target.queue)} 個事件未送出")
+                target.stats['dropped'] += len(target.queue)
+                target.queue.clear()
+            if target.session:
+                await target.session.close()
+                target.session = None
+
+    def snapshot(self):
+        return {name: target.snapshot() for name, target in self.targets.items()}
+
+
+async def run_stub_server(port, fail_rate, delay):
+    """本機 webhook 接收端：記錄收到的事件，可模擬延遲與失敗"""
+    from aiohttp import web
+
+    received = {'requests': 0, 'events': 0}
+
+    async def handle(request):
+        await asyncio.sleep(delay)
+        body = await request.json()
+        received['requests'] += 1
+        if random.random() < fail_rate:
+            return web.Response(status=503, text='simulated failure')
+        events = body['events'] if isinstance(body, dict) and 'events' in body else [body]
+        received['events'] += len(events)
+        for event in events:
+            print(f"📥 {request.path} {event.get('event')} (請求 {received['requests']}, 事件 {received['events']})")
+        return web.json_response({'ok': True})
+
+    app = web.Application()
+    app.router.add_post('/{tail:.*}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    print(f"🧪 webhook 測試接收端已啟動: http://localhost:{port} (失敗率 {fail_rate}, 延遲 {delay}s)")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Webhook 發送器工具')
+    subparsers = parser.add_subparsers(dest='command')
+    stub = subparsers.add_parser('stub', help='啟動本機 webhook 測試接收端')
+    stub.add_argument('--port', type=int, default=8001)
+    stub.add_argument('--fail-rate', type=float, default=0.0)
+    stub.add_argument('--delay', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.command == 'stub':
+        asyncio.run(run_stub_server(args.port, args.fail_rate, args.delay))
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -13,11 +13,20 @@ import numpy as np
 from PIL import Image
 import io
 import time
-import hashlib
 import uuid
-import aiohttp
+import signal
+from http import HTTPStatus
 from datetime import datetime, timezone, timedelta
-from database_manager import PostgresFaceDatabase
+from async_database_manager import AsyncPostgresFaceDatabase
+from write_behind import WriteBehindQueue, taipei_now
+from presence import PresenceTracker
+from embedding_index import RecentEmbeddingMatrix, SimHashIndex, simhash_fingerprint
+from state_store import IdentityStateStore, PERSON, STRANGER, CLIENT
+from coordination import create_lease_store, create_broadcast_relay
+from broadcast import BroadcastHub, TOPICS
+from webhook_dispatcher import WebhookDispatcher
+import metrics
+import profiler
 from insightface.app import FaceAnalysis
 from huggingface_hub import snapshot_download
 import os
@@ -94,12 +103,15 @@ try:
 except ImportError:
     print("⚠️ onnxruntime 模組不可用")
 
-# 初始化資料庫
-face_db = PostgresFaceDatabase()
+# 初始化資料庫（連接池於 main() 中建立）
+face_db = AsyncPostgresFaceDatabase()
 
 class RealtimeFaceRecognition:
     def __init__(self):
-        self.connected_clients = set()
+        # 每個連線的送出佇列與主題訂閱
+        self.hub = BroadcastHub()
+        self.stats_publish_interval = float(os.getenv('STATS_PUBLISH_INTERVAL', 5))  # 推送 stats 主題的間隔（0 表示不推送）
+        self.admin_tasks = set()  # 進行中的取樣分析
         self.recognition_stats = {
             'total_frames': 0,
             'faces_detected': 0,
@@ -108,50 +120,143 @@ class RealtimeFaceRecognition:
             'unknown_detected': 0
         }
         # 智能採樣控制（CPU 優化）
-        self.client_frame_counters = {}  # 每個客戶端的幀計數器
         self.skip_frames = 4  # 跳過幀數：每5幀處理1幀（降低 CPU 負載）
         
         # 資料庫寫入控制（避免重複寫入）
-        self.recent_recognitions = {}  # {person_id: last_recognition_time}
+        # 近期成功識別人員的資料庫 embedding（陌生人確認時比對，不需查詢資料庫）
+        self.recent_embeddings = RecentEmbeddingMatrix()
         self.recognition_cooldown = 10  # 同一人10秒內不重複寫入識別日誌
         
         # 智能通知機制
-        self.person_detection_history = {}  # {person_id: [detection_times]}
-        self.person_notification_times = {}  # {person_id: [notification_times]}
         self.stable_detection_count = 3      # 需要連續3次穩定識別
         self.first_notification_interval = 60   # 首次通知後1分鐘
         self.regular_notification_interval = 300  # 之後每5分鐘
         
         # 陌生人追蹤和去重機制
-        self.stranger_faces = {}  # {face_hash: {'uuid': str, 'first_seen': datetime, 'last_seen': datetime, 'embedding': np.array}}
         self.stranger_cooldown = 900  # 15分鐘冷卻期（900秒）
+        # 陌生人 embedding 的 LSH 索引：查詢只精確比對同桶的陌生人；紀錄超過冷卻期自狀態儲存區淘汰時一併移出索引
+        self.stranger_index = SimHashIndex(
+            tables=int(os.getenv('STRANGER_LSH_TABLES', 128)),
+            bits=int(os.getenv('STRANGER_LSH_BITS', 10))
+        )
         
         # 分流Webhook配置
         self.employee_webhook_url = os.getenv('EMPLOYEE_WEBHOOK_URL', 'http://host.docker.internal:8001/webhook/employee-detected')
         self.stranger_webhook_url = os.getenv('STRANGER_WEBHOOK_URL', 'http://host.docker.internal:8002/webhook/stranger-detected')
+        # 長連線的背景發送器，識別流程只負責放入佇列
+        self.webhooks = WebhookDispatcher({
+            'employee': self.employee_webhook_url,
+            'stranger': self.stranger_webhook_url
+        })
         
         # 陌生人確認機制（防止員工誤判）
-        self.stranger_candidates = {}  # {face_hash: {'detections': [timestamps], 'embedding': np.array}}
         self.stranger_confirm_threshold = 5  # 連續5次檢測才確認是陌生人
         self.stranger_confirm_window = 30  # 30秒內的檢測
         self.recent_success_window = 30  # 30秒內有成功識別就不算陌生人
         
         # 臨時訪客管理
-        self.temp_visitors = {}  # {person_id: {'registered_time': datetime, 'embedding': np.array}}
-        self.temp_visitor_timeout = 300  # 5分鐘無活動後清理
+        self.temp_visitor_timeout = int(os.getenv('TEMP_VISITOR_TIMEOUT', 300))  # 5分鐘無活動後清理
+        
+        # 每個身分的狀態（人員的識別冷卻/檢測/通知、陌生人、客戶端幀計數），依種類設定存活時間並限制總筆數
+        self.state = IdentityStateStore(
+            ttls={
+                PERSON: int(os.getenv('STATE_PERSON_TTL', 600)),
+                STRANGER: self.stranger_cooldown,
+                CLIENT: int(os.getenv('STATE_CLIENT_TTL', 3600))
+            },
+            on_evict=self.on_state_evicted
+        )
+        
+        # 延後寫入：識別結果先回傳，日誌與出勤批次寫入資料庫
+        self.write_queue = WriteBehindQueue(
+            face_db,
+            on_new_sessions=self.handle_new_sessions,
+            on_sessions_lost=lambda session_uuids: self.presence.discard(session_uuids),
+            on_sessions_adopted=lambda adopted: self.presence.adopt(adopted)
+        )
+        
+        # 在席狀態機：記憶體中維護活躍會話，減少 last_seen_at 寫入
+        self.presence = PresenceTracker(self.write_queue)
+        
+        # 生命週期清理：結束超時會話、刪除過期臨時訪客
+        self.sweep_interval = int(os.getenv('SWEEP_INTERVAL', 30))
+        self.sweep_stats = {
+            'sweeps': 0,
+            'ended_sessions': 0,
+            'removed_visitors': 0,
+            'last_ended_sessions': 0,
+            'last_removed_visitors': 0,
+            'last_sweep_ms': 0.0,
+            'errors': 0
+        }
+        
+        # 多實例協調：清理與分區維護只由持有租約的實例執行，跨實例的事件以租約去重
+        self.leases = create_lease_store(face_db)
+        self.leader_tasks = {'sweeper': False, 'partitions': False}
+        # 人員檢測與出勤廣播轉送給連到其他實例的客戶端
+        self.hub.relay = create_broadcast_relay(face_db, self.hub, self.leases.owner)
+        
+        # 識別日誌分區維護：預先建立未來分區，整個刪除超過保留天數的分區
+        self.partition_maintenance_interval = 3600
+        self.partition_days_ahead = int(os.getenv('RECOGNITION_LOG_PARTITION_DAYS_AHEAD', 7))
+        self.outbox_retention_days = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+        self.attendance_changes_retention_hours = int(os.getenv('ATTENDANCE_CHANGES_RETENTION_HOURS', 24))
+        self.log_retention_days = int(os.getenv('RECOGNITION_LOG_RETENTION_DAYS', 90))
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """將各元件既有的統計註冊為 /metrics 的量測值（讀取時才計算），並登記逐幀計時供取樣分析擷取"""
+        registry = metrics.REGISTRY
+        profiler.register_frame_pipeline('websocket_realtime')
+        registry.gauge('auraface_websocket_clients', '目前連線的客戶端數', lambda: len(self.hub))
+        registry.gauge('auraface_queue_depth', '各背景佇列目前的待處理數', lambda: {
+            ('write_behind',): self.write_queue.pending,
+            ('broadcast',): self.hub.snapshot()['queued'],
+            **{(f'webhook_{name}',): len(target.queue) for name, target in self.webhooks.targets.items()}
+        }, ('queue',))
+        registry.gauge('auraface_dropped_total', '因佇列已滿或合併而未送出的項目數', lambda: {
+            ('write_behind',): self.write_queue.stats['dropped'],
+            ('broadcast',): self.hub.stats['dropped'],
+            ('broadcast_coalesced',): self.hub.stats['coalesced'],
+            **{(f'webhook_{name}',): target.stats['dropped'] for name, target in self.webhooks.targets.items()}
+        }, ('queue',), metric_type='counter')
+        registry.gauge('auraface_write_behind_last_flush_seconds', '最近一次批次寫入的耗時（秒）',
+                       lambda: self.write_queue.stats['last_flush_ms'] / 1000)
+        registry.gauge('auraface_webhook_latency_seconds', 'webhook 最近請求的耗時（秒）', lambda: {
+            (name, stat): target.snapshot()[f'latency_{stat}_ms'] / 1000
+            for name, target in self.webhooks.targets.items() for stat in ('avg', 'p95')
+        }, ('target', 'stat'))
+        registry.gauge('auraface_webhook_e2e_latency_seconds', 'webhook 事件自放入佇列到送達的時間（秒）', lambda: {
+            (name, stat): target.snapshot()[f'e2e_latency_{stat}_ms'] / 1000
+            for name, target in self.webhooks.targets.items() for stat in ('avg', 'p95')
+        }, ('target', 'stat'))
+        registry.gauge('auraface_identity_states', '即時識別狀態儲存區各種類的筆數', lambda: {
+            (kind,): counts['size'] for kind, counts in self.state.snapshot()['by_kind'].items()
+        }, ('kind',))
+        registry.gauge('auraface_identity_state_removed_total', '狀態儲存區因到期或超過上限淘汰的筆數', lambda: {
+            (kind, reason): counts[reason]
+            for kind, counts in self.state.snapshot()['by_kind'].items() for reason in ('expired', 'evicted')
+        }, ('kind', 'reason'), metric_type='counter')
+    
+    async def process_http_request(self, path, request_headers):
+        """WebSocket 埠上的一般 HTTP 請求：GET /metrics 回傳 Prometheus 格式指標，其餘照常升級為 WebSocket"""
+        if path.split('?')[0] != '/metrics':
+            return None
+        body = metrics.REGISTRY.render().encode('utf-8')
+        return HTTPStatus.OK, [('Content-Type', metrics.CONTENT_TYPE)], body
     
     async def register(self, websocket, path):
         """註冊新的 WebSocket 連接"""
-        self.connected_clients.add(websocket)
+        self.hub.attach(websocket)
         print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 新客戶端連接: {websocket.remote_address}")
         
         try:
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'connection_status',
                 'status': 'connected',
                 'message': '已連接到即時人臉識別系統',
                 'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S')
-            }))
+            })
             
             await self.handle_client(websocket)
         except websockets.exceptions.ConnectionClosed as e:
@@ -159,12 +264,9 @@ class RealtimeFaceRecognition:
         except Exception as e:
             print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 客戶端異常斷線: {websocket.remote_address}, 錯誤: {e}")
         finally:
-            if websocket in self.connected_clients:
-                self.connected_clients.remove(websocket)
+            await self.hub.detach(websocket)
             # 清理該客戶端的幀計數器
-            client_id = id(websocket)
-            if client_id in self.client_frame_counters:
-                del self.client_frame_counters[client_id]
+            self.state.pop(CLIENT, id(websocket))
             print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 客戶端清理完成: {websocket.remote_address}")
     
     async def handle_client(self, websocket):
@@ -176,16 +278,16 @@ class RealtimeFaceRecognition:
                     await self.process_message(websocket, data)
                 except json.JSONDecodeError as e:
                     print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] JSON 解析錯誤: {e}")
-                    await websocket.send(json.dumps({
+                    self.hub.send(websocket, {
                         'type': 'error',
                         'message': f'JSON 格式錯誤: {str(e)}'
-                    }))
+                    })
                 except Exception as e:
                     print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 訊息處理錯誤: {e}")
-                    await websocket.send(json.dumps({
+                    self.hub.send(websocket, {
                         'type': 'error',
                         'message': f'訊息處理錯誤: {str(e)}'
-                    }))
+                    })
         except websockets.exceptions.ConnectionClosed:
             print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 客戶端連接已關閉")
         except Exception as e:
@@ -211,27 +313,61 @@ class RealtimeFaceRecognition:
             await self.get_attendance_logs(websocket)
         elif message_type == 'clear_attendance':
             await self.clear_attendance_logs(websocket)
+        elif message_type in ('profile', 'capture_frames'):
+            self.start_admin_task(websocket, data)
+        elif message_type == 'subscribe':
+            topics = self.hub.subscribe(websocket, data.get('topics', TOPICS))
+            self.hub.send(websocket, {'type': 'subscribed', 'topics': topics})
         else:
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'error',
                 'message': f'未知訊息類型: {message_type}'
-            }))
+            })
+
+    def start_admin_task(self, websocket, data):
+        """管理員的取樣分析請求在背景執行，期間同一連線仍可繼續送幀"""
+        if not profiler.check_token(data.get('token')):
+            self.hub.send(websocket, {
+                'type': 'error',
+                'message': '需要管理員權杖 (PROFILER_ADMIN_TOKEN)'
+            })
+            return
+        task = asyncio.create_task(self.run_admin_task(websocket, data))
+        self.admin_tasks.add(task)
+        task.add_done_callback(self.admin_tasks.discard)
+
+    async def run_admin_task(self, websocket, data):
+        try:
+            if data['type'] == 'profile':
+                seconds = float(data.get('seconds', 10))
+                print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 🔬 開始取樣分析 {seconds} 秒")
+                collapsed, stats = await profiler.profile_async(
+                    seconds, data.get('interval_ms') and float(data['interval_ms']) / 1000, bool(data.get('idle')))
+                self.hub.send(websocket, {'type': 'profile_result', 'format': 'collapsed',
+                                          'stats': stats, 'collapsed': collapsed})
+            else:
+                report = await profiler.capture_frames_async(int(data.get('frames', 20)), float(data.get('timeout', 60)))
+                self.hub.send(websocket, {'type': 'frame_breakdown', **report})
+        except profiler.ProfilerBusy:
+            self.hub.send(websocket, {'type': 'error', 'message': '已有取樣進行中'})
+        except Exception as e:
+            self.hub.send(websocket, {'type': 'error', 'message': f'取樣分析失敗: {str(e)}'})
 
     async def get_all_persons(self, websocket):
         """取得所有已註冊人員列表並發送給客戶端"""
         try:
-            all_faces = face_db.get_all_faces()
+            all_faces = await face_db.get_all_faces()
             person_list = [{"person_id": pid, **pinfo} for pid, pinfo in all_faces.items()]
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'persons_list',
                 'success': True,
                 'data': person_list
-            }))
+            })
         except Exception as e:
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'error',
                 'message': f'獲取人員列表失敗: {str(e)}'
-            }))
+            })
 
     async def update_person(self, websocket, data):
         """更新人員資料"""
@@ -244,49 +380,48 @@ class RealtimeFaceRecognition:
             email = data.get('email', '')
             
             if not all([person_id, name, role, department is not None]):
-                await websocket.send(json.dumps({'type': 'update_result', 'success': False, 'message': '缺少必要資料'}))
+                self.hub.send(websocket, {'type': 'update_result', 'success': False, 'message': '缺少必要資料'})
                 return
 
-            success, message = face_db.update_face(person_id, name, employee_id, role, department, email)
-            await websocket.send(json.dumps({
+            success, message = await face_db.update_face(person_id, name, employee_id, role, department, email)
+            self.hub.send(websocket, {
                 'type': 'update_result',
                 'success': success,
                 'message': message
-            }))
+            })
         except Exception as e:
-            await websocket.send(json.dumps({'type': 'update_result', 'success': False, 'message': f'更新失敗: {str(e)}'}))
+            self.hub.send(websocket, {'type': 'update_result', 'success': False, 'message': f'更新失敗: {str(e)}'})
 
     async def delete_person(self, websocket, data):
         """刪除人員資料"""
         try:
             person_id = data.get('person_id')
             if not person_id:
-                await websocket.send(json.dumps({'type': 'delete_result', 'success': False, 'message': '缺少 person_id'}))
+                self.hub.send(websocket, {'type': 'delete_result', 'success': False, 'message': '缺少 person_id'})
                 return
 
-            success, message = face_db.delete_face(person_id)
-            await websocket.send(json.dumps({
+            success, message = await face_db.delete_face(person_id)
+            self.hub.send(websocket, {
                 'type': 'delete_result',
                 'success': success,
                 'message': message
-            }))
+            })
         except Exception as e:
-            await websocket.send(json.dumps({'type': 'delete_result', 'success': False, 'message': f'刪除失敗: {str(e)}'}))
+            self.hub.send(websocket, {'type': 'delete_result', 'success': False, 'message': f'刪除失敗: {str(e)}'})
     
     async def process_video_frame(self, websocket, data):
         """處理視訊幀並進行人臉識別"""
         try:
             # 智能採樣：跳過幀以減少GPU負載
-            client_id = id(websocket)
-            if client_id not in self.client_frame_counters:
-                self.client_frame_counters[client_id] = 0
-            
-            self.client_frame_counters[client_id] += 1
+            client_state = self.state.touch(CLIENT, id(websocket), time.time())
+            client_state.frames += 1
             
             # 每4幀處理1幀，跳過其他幀
-            if self.client_frame_counters[client_id] % (self.skip_frames + 1) != 0:
+            if client_state.frames % (self.skip_frames + 1) != 0:
                 # 跳過此幀，不進行處理
+                metrics.FRAMES.inc(labels=('skipped',))
                 return
+            trace = metrics.start_frame()
             
             # 解析 base64 圖片
             image_data = data.get('image')
@@ -301,6 +436,9 @@ class RealtimeFaceRecognition:
             image_bytes = base64.b64decode(image_data)
             nparr = np.frombuffer(image_bytes, np.uint8)
             cv_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+            if cv_image is None:
+                raise ValueError('無法解碼圖片')
+            trace.mark('decode')
             
             # 進行人臉識別
             start_time = time.time()
@@ -333,13 +471,19 @@ class RealtimeFaceRecognition:
                 'client_timestamp': data.get('client_timestamp')  # 回傳客戶端時間戳用於延遲計算
             }
             
-            await websocket.send(json.dumps(response))
+            self.hub.send(websocket, response, topic='results')
+            trace.mark('respond')
+            trace.finish(data.get('client_timestamp'))
+            metrics.FRAMES.inc(labels=('processed',))
             
         except Exception as e:
-            await websocket.send(json.dumps({
+            metrics.FRAMES.inc(labels=('failed',))
+            self.hub.send(websocket, {
                 'type': 'error',
                 'message': f'圖片處理錯誤: {str(e)}'
-            }))
+            })
+        finally:
+            metrics.end_frame()
     
     async def identify_faces_async(self, cv_image):
         """非同步人臉識別"""
@@ -355,9 +499,12 @@ class RealtimeFaceRecognition:
                 scale_factor = 1 / scale
             else:
                 scale_factor = 1.0
+            trace = metrics.current_frame()
+            trace.mark('resize')
             
-            # 執行人臉檢測（GPU加速）
+            # 執行人臉檢測（GPU加速）；FaceAnalysis.get 同時完成檢測與 embedding 擷取
             faces = face_app.get(cv_image)
+            trace.mark('detect_embed')
             
             if not faces:
                 return []
@@ -365,13 +512,19 @@ class RealtimeFaceRecognition:
             results = []
             current_time = time.time()
             
-            for face in faces:
+            # 同一幀各人臉的向量搜尋彼此獨立，並行送出（不設閾值，取得最相似人員與信心度）
+            all_face_matches = await face_db.find_similar_faces_batch(
+                [face.normed_embedding for face in faces], threshold=0.0
+            )
+            trace.mark('vector_search')
+            
+            for face, all_matches in zip(faces, all_face_matches):
                 # 調整座標回原始尺寸
                 if scale_factor != 1.0:
                     face.bbox = face.bbox * scale_factor
                 
-                # 在資料庫中搜尋相似人臉，使用平衡的閾值
-                matches = face_db.find_similar_faces(face.normed_embedding, threshold=0.4)
+                # 使用平衡的閾值判定是否為已註冊人員
+                matches = [m for m in all_matches if m['confidence'] >= 0.4]
                 
                 if matches:
                     best_match = matches[0]
@@ -383,66 +536,30 @@ class RealtimeFaceRecognition:
                     # 方案2：分離識別日誌和出勤更新
                     
                     # 識別日誌：10秒冷卻，統一門檻0.4
-                    should_log_recognition = False
-                    if person_id not in self.recent_recognitions:
-                        should_log_recognition = True
-                    else:
-                        last_time = self.recent_recognitions[person_id]
-                        if current_time - last_time > self.recognition_cooldown:
-                            should_log_recognition = True
+                    person_state = self.state.touch(PERSON, person_id, current_time)
+                    should_log_recognition = (
+                        person_state.last_recognition is None
+                        or current_time - person_state.last_recognition > self.recognition_cooldown
+                    )
                     
-                    # 寫入識別日誌（受冷卻限制）
+                    # 寫入識別日誌（受冷卻限制，交由寫入佇列批次寫入）
                     if should_log_recognition and best_match['confidence'] >= 0.4:
-                        face_db.log_recognition(
+                        self.write_queue.enqueue_recognition(
                             person_id, 
                             best_match['name'], 
                             best_match['confidence'], 
                             "websocket_stream"
                         )
-                        self.recent_recognitions[person_id] = current_time
-                        # 獲取session_uuid用於日誌顯示
-                        session_info = face_db.get_current_session(person_id)
-                        session_uuid = session_info.get("session_uuid") if session_info else "無session"
-                        print(f"📝 記錄識別日誌: {best_match['name']} (信心度: {best_match['confidence']:.3f}, UUID: {session_uuid})")
+                        person_state.last_recognition = current_time
+                        await self.remember_recent_embedding(person_id, current_time)
+                        print(f"📝 記錄識別日誌: {best_match['name']} (信心度: {best_match['confidence']:.3f})")
                     
-                    # 出勤更新：不受冷卻限制，每次識別都更新
-                    is_new_session = False
+                    # 出勤更新：不受冷卻限制，由在席狀態機決定是否需要寫入
+                    # 新session的webhook在批次寫入後由 handle_new_sessions 發送
                     if best_match['confidence'] >= 0.4:
-                        # 先檢查是否已有活躍session
-                        current_session = face_db.get_current_session(person_id)
-                        if not current_session:
-                            is_new_session = True
+                        is_new_session, _ = self.presence.observe(person_id, best_match)
+                        if is_new_session:
                             print(f"📢 檢測到新進場: {best_match['name']}")
-                        
-                        # 更新/建立attendance session
-                        session_uuid = face_db.log_attendance(person_id)
-                        
-                        # 只有新session才發送webhook
-                        if is_new_session and session_uuid:
-                            # 根據role決定推送到哪個webhook
-                            if best_match['role'] == '訪客':
-                                # 訪客推送到陌生人webhook
-                                visitor_data = {
-                                    'event': 'temp_visitor_detected',
-                                    'session_uuid': session_uuid,
-                                    'person_id': best_match['person_id'],
-                                    'name': best_match['name'],
-                                    'department': best_match['department'],
-                                    'role': best_match['role'],
-                                    'employee_id': '',
-                                    'email': '',
-                                    'status': 'active',
-                                    'status_text': '已註冊訪客',
-                                    'arrival_time': datetime.now(TW_TZ).isoformat(),
-                                    'last_seen_at': datetime.now(TW_TZ).isoformat(),
-                                    'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S'),
-                                    'camera_id': 'websocket_stream',
-                                    'confidence': best_match['confidence']
-                                }
-                                await self.send_stranger_webhook(visitor_data)
-                            else:
-                                # 員工推送到員工webhook
-                                await self.send_employee_webhook(best_match, "detected")
                     
                     # 清除可能的陌生人候選（員工從遠處走近的情況）
                     self.clear_related_stranger_candidates(face.normed_embedding)
@@ -456,8 +573,6 @@ class RealtimeFaceRecognition:
                         'confidence': best_match['confidence']
                     })
                 else:
-                    # 查詢最相似的人員（不設閾值，獲取信心度資訊）
-                    all_matches = face_db.find_similar_faces(face.normed_embedding, threshold=0.0)
                     best_similarity = all_matches[0]['confidence'] if all_matches else 0.0
                     
                     # 如果有匹配但低於0.4閾值，根據信心度決定如何顯示
@@ -498,8 +613,7 @@ class RealtimeFaceRecognition:
                                     })
                                     
                                     # 清理候選記錄
-                                    if face_hash in self.stranger_candidates:
-                                        del self.stranger_candidates[face_hash]
+                                    self.forget_stranger(face_hash)
                                 else:
                                     # 註冊失敗，顯示為陌生人
                                     results.append({
@@ -533,8 +647,7 @@ class RealtimeFaceRecognition:
                             temp_visitor_id, temp_visitor_name = await self.register_temp_visitor(face.normed_embedding, current_time)
                             
                             if temp_visitor_id:
-                                # 註冊成功，建立attendance session
-                                face_db.log_attendance(temp_visitor_id)
+                                # 註冊成功 (attendance session已在register_temp_visitor中建立)
                                 
                                 results.append({
                                     'bbox': face.bbox.tolist(),
@@ -547,8 +660,7 @@ class RealtimeFaceRecognition:
                                 })
                                 
                                 # 清理候選記錄
-                                if face_hash in self.stranger_candidates:
-                                    del self.stranger_candidates[face_hash]
+                                self.forget_stranger(face_hash)
                             else:
                                 # 註冊失敗，顯示為陌生人
                                 stranger_uuid = str(uuid.uuid4())
@@ -572,6 +684,8 @@ class RealtimeFaceRecognition:
                                 'confidence': 0.0
                             })
             
+            # 比對結果的後續處理（出勤、通知、陌生人確認與註冊）
+            trace.mark('match')
             return results
             
         except Exception as e:
@@ -670,65 +784,133 @@ class RealtimeFaceRecognition:
         return annotated
     
     async def send_stats(self, websocket):
-        """發送統計資料"""
-        response = {
+        """回覆 get_stats（不受訂閱主題過濾）"""
+        self.hub.send(websocket, self.stats_snapshot())
+    
+    def stats_snapshot(self):
+        """各元件的統計資料（get_stats 回覆與 stats 主題共用）"""
+        return {
             'type': 'stats',
-            'data': self.recognition_stats
+            'data': self.recognition_stats,
+            'write_behind': {**self.write_queue.stats, 'pending': self.write_queue.pending},
+            'presence': {**self.presence.stats, 'active': len(self.presence.sessions)},
+            'sweeper': self.sweep_stats,
+            'instance': {'id': self.leases.owner, 'pid': os.getpid(), 'leader': self.leader_tasks},
+            'state': self.state.snapshot(),
+            'stranger_index': {**self.stranger_index.stats, 'size': len(self.stranger_index)},
+            'broadcast': self.hub.snapshot(),
+            'webhooks': self.webhooks.snapshot(),
+            'latency': {
+                'stages': metrics.FRAME_STAGE_SECONDS.summary(),
+                'frame': metrics.FRAME_SECONDS.summary().get('all'),
+                'e2e': metrics.FRAME_E2E_SECONDS.summary().get('all'),
+                'db_round_trips': metrics.FRAME_DB_ROUND_TRIPS.summary().get('all')
+            }
         }
-        await websocket.send(json.dumps(response))
     
+    async def handle_new_sessions(self, new_sessions):
+        """批次寫入建立新出勤會話後，發送進場webhook"""
+        webhooks = []
+        for session, info in new_sessions:
+            arrival_time = session['arrival_time'].replace(tzinfo=TW_TZ).isoformat()
+            last_seen_at = session['last_seen_at'].replace(tzinfo=TW_TZ).isoformat()
+            print(f"📢 新進場會話已寫入: {info.get('name', session['person_id'])} (UUID: {session['session_uuid']})")
+            self.hub.publish('attendance', {
+                'type': 'attendance_update',
+                'event': 'arrived',
+                'session_uuid': session['session_uuid'],
+                'person_id': session['person_id'],
+                'name': info.get('name', session['person_id']),
+                'arrival_time': arrival_time
+            })
+            
+            # 根據role決定推送到哪個webhook
+            if info.get('is_temp_visitor'):
+                # 自動註冊的臨時訪客
+                webhooks.append(self.send_stranger_webhook({
+                    'event': 'stranger_auto_registered',
+                    'session_uuid': session['session_uuid'],
+                    'person_id': session['person_id'],
+                    'name': info['name'],
+                    'department': '臨時',
+                    'role': '訪客',
+                    'employee_id': session['person_id'],
+                    'email': '',
+                    'status': 'active',
+                    'status_text': '陌生訪客',
+                    'arrival_time': arrival_time,
+                    'last_seen_at': last_seen_at,
+                    'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S'),
+                    'camera_id': 'websocket_stream',
+                    'confidence': 0.12
+                }))
+            elif info.get('role') == '訪客':
+                # 訪客推送到陌生人webhook
+                webhooks.append(self.send_stranger_webhook({
+                    'event': 'temp_visitor_detected',
+                    'session_uuid': session['session_uuid'],
+                    'person_id': session['person_id'],
+                    'name': info['name'],
+                    'department': info['department'],
+                    'role': info['role'],
+                    'employee_id': '',
+                    'email': '',
+                    'status': 'active',
+                    'status_text': '已註冊訪客',
+                    'arrival_time': arrival_time,
+                    'last_seen_at': last_seen_at,
+                    'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S'),
+                    'camera_id': 'websocket_stream',
+                    'confidence': info['confidence']
+                }))
+            elif info:
+                # 員工推送到員工webhook
+                webhooks.append(self.send_employee_webhook(info, "detected", session_info={
+                    'session_uuid': session['session_uuid'],
+                    'status': 'active',
+                    'arrival_time': arrival_time,
+                    'last_seen_at': last_seen_at
+                }))
+        
+        await asyncio.gather(*webhooks, return_exceptions=True)
+
     async def handle_person_detection(self, person_id, best_match, current_time):
         """處理人員檢測的智能通知機制"""
         try:
-            # 記錄檢測歷史
-            if person_id not in self.person_detection_history:
-                self.person_detection_history[person_id] = []
-            
-            self.person_detection_history[person_id].append(current_time)
-            
-            # 只保留最近的檢測記錄（避免記憶體洩漏）
-            if len(self.person_detection_history[person_id]) > 10:
-                self.person_detection_history[person_id] = self.person_detection_history[person_id][-10:]
+            # 記錄檢測歷史（只保留最近10次）
+            person_state = self.state.touch(PERSON, person_id, current_time)
+            person_state.detections.append(current_time)
             
             # 檢查是否達到穩定識別次數
-            recent_detections = [t for t in self.person_detection_history[person_id] if current_time - t <= 10]  # 10秒內的檢測
+            recent_detections = [t for t in person_state.detections if current_time - t <= 10]  # 10秒內的檢測
             
             if len(recent_detections) >= self.stable_detection_count:
                 # 檢查是否需要發送通知
                 should_notify = False
+                last_notifications = person_state.notifications
                 
-                if person_id not in self.person_notification_times:
+                if not last_notifications:
                     # 首次檢測到此人
                     should_notify = True
-                    self.person_notification_times[person_id] = []
                 else:
-                    # 檢查距離上次通知的時間
-                    last_notifications = self.person_notification_times[person_id]
-                    if not last_notifications:
-                        # 沒有通知記錄，發送首次通知
-                        should_notify = True
+                    last_notification_time = last_notifications[-1]
+                    time_since_last = current_time - last_notification_time
+                    
+                    # 根據通知次數決定間隔
+                    if len(last_notifications) == 1:
+                        # 第二次通知：首次通知後1分鐘
+                        if time_since_last >= self.first_notification_interval:
+                            should_notify = True
                     else:
-                        last_notification_time = last_notifications[-1]
-                        time_since_last = current_time - last_notification_time
-                        
-                        # 根據通知次數決定間隔
-                        if len(last_notifications) == 1:
-                            # 第二次通知：首次通知後1分鐘
-                            if time_since_last >= self.first_notification_interval:
-                                should_notify = True
-                        else:
-                            # 後續通知：每5分鐘
-                            if time_since_last >= self.regular_notification_interval:
-                                should_notify = True
+                        # 後續通知：每5分鐘
+                        if time_since_last >= self.regular_notification_interval:
+                            should_notify = True
                 
                 # 發送通知
                 if should_notify:
                     await self.send_person_detected_notification(person_id, best_match, current_time)
-                    self.person_notification_times[person_id].append(current_time)
-                    
-                    # 只保留最近的通知記錄
-                    if len(self.person_notification_times[person_id]) > 5:
-                        self.person_notification_times[person_id] = self.person_notification_times[person_id][-5:]
+                    # 只保留最近5次通知記錄
+                    person_state.notifications.append(current_time)
         
         except Exception as e:
             print(f"處理人員檢測通知時發生錯誤: {e}")
@@ -736,7 +918,8 @@ class RealtimeFaceRecognition:
     async def send_person_detected_notification(self, person_id, person_info, current_time):
         """發送人員檢測通知給所有連接的客戶端"""
         try:
-            notification_count = len(self.person_notification_times.get(person_id, []))
+            person_state = self.state.get(PERSON, person_id)
+            notification_count = len(person_state.notifications) if person_state else 0
             is_first_detection = notification_count == 0
             
             notification = {
@@ -751,14 +934,9 @@ class RealtimeFaceRecognition:
                 'notification_count': notification_count + 1
             }
             
-            # 發送給所有連接的客戶端
-            if self.connected_clients:
-                message = json.dumps(notification)
-                await asyncio.gather(
-                    *[client.send(message) for client in self.connected_clients],
-                    return_exceptions=True
-                )
-                
+            # 放入訂閱者的送出佇列，不等待客戶端接收
+            if self.hub:
+                self.hub.publish('person_detected', notification)
                 print(f"📢 發送人員檢測通知: {person_info['name']} ({'首次' if is_first_detection else f'第{notification_count + 1}次'})")
         
         except Exception as e:
@@ -778,45 +956,38 @@ class RealtimeFaceRecognition:
             return 0.0
 
     def generate_face_hash(self, face_embedding):
-        """為人臉嵌入生成唯一哈希值"""
+        """為人臉嵌入生成 SimHash 指紋（同一人的不同幀指紋相近）"""
         try:
-            # 將嵌入轉換為字符串然後生成哈希
-            embedding_str = str(face_embedding.round(6))  # 四捨五入到6位小數
-            return hashlib.md5(embedding_str.encode()).hexdigest()[:16]
+            return simhash_fingerprint(face_embedding)
         except Exception as e:
             print(f"生成人臉哈希時發生錯誤: {e}")
             return str(uuid.uuid4())[:16]
 
     def find_similar_stranger(self, face_embedding, threshold=0.8):
-        """在已知陌生人中尋找相似的人臉"""
+        """在已知陌生人中尋找相似的人臉（LSH 分桶後只精確比對同桶的陌生人）"""
         try:
             current_time = time.time()
             
-            # 清理過期的陌生人記錄
-            expired_keys = []
-            for face_hash, info in self.stranger_faces.items():
-                if current_time - info['last_seen'] > self.stranger_cooldown:
-                    expired_keys.append(face_hash)
+            # 淘汰超過冷卻期未出現的陌生人記錄（同時自索引移除）
+            self.state.expire(current_time)
             
-            for key in expired_keys:
-                del self.stranger_faces[key]
-            
-            # 尋找相似的陌生人
-            for face_hash, info in self.stranger_faces.items():
-                similarity = self.compute_face_similarity(face_embedding, info['embedding'])
-                if similarity > threshold:
-                    return face_hash, info
+            face_hash, _ = self.stranger_index.query(face_embedding, threshold)
+            if face_hash:
+                stranger_state = self.state.get(STRANGER, face_hash)
+                if stranger_state:
+                    return face_hash, stranger_state.data
             
             return None, None
         except Exception as e:
             print(f"尋找相似陌生人時發生錯誤: {e}")
             return None, None
 
-    async def send_employee_webhook(self, person_data, event_type="detected"):
+    async def send_employee_webhook(self, person_data, event_type="detected", session_info=None):
         """發送員工識別webhook - 發送原始資料，讓webhook_receiver包裝API格式"""
         try:
             # 獲取當前session信息 (包含session_uuid)
-            session_info = face_db.get_current_session(person_data["person_id"])
+            if session_info is None:
+                session_info = await face_db.get_current_session(person_data["person_id"])
             
             # 組織員工資料，發送原始事件資料
             payload = {
@@ -828,20 +999,17 @@ class RealtimeFaceRecognition:
                 "role": person_data["role"],
                 "employee_id": person_data.get("employee_id", ""),
                 "email": person_data.get("email", ""),
-                "confidence": person_data["confidence"],
+                "confidence": person_data.get("confidence"),
                 "status": session_info.get("status", "active") if session_info else "active",
                 "arrival_time": session_info.get("arrival_time") if session_info else None,
                 "last_seen_at": session_info.get("last_seen_at") if session_info else None,
+                "departure_time": session_info.get("departure_time") if session_info else None,
                 "timestamp": datetime.now(TW_TZ).strftime("%Y-%m-%d %H:%M:%S"),
                 "camera_id": "websocket_stream"
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.employee_webhook_url, json=payload, timeout=5) as response:
-                    if response.status == 200:
-                        print(f"✅ 員工識別推送成功: {person_data['name']} (UUID: {payload.get('session_uuid', 'N/A')})")
-                    else:
-                        print(f"❌ 員工識別推送失敗: {response.status}")
+            # 放入發送佇列，由背景工作任務發送與重試
+            self.webhooks.submit('employee', payload)
         except Exception as e:
             print(f"❌ 發送員工webhook時發生錯誤: {e}")
 
@@ -851,7 +1019,7 @@ class RealtimeFaceRecognition:
             # 判斷事件類型
             event_type = stranger_data.get('event', 'stranger_detected')
             
-            if event_type in ['stranger_auto_registered', 'temp_visitor_detected']:
+            if event_type in ['stranger_auto_registered', 'temp_visitor_detected', 'visitor_departed']:
                 # 直接發送原始事件資料
                 payload = stranger_data
             elif event_type == 'temp_visitor_departed':
@@ -873,36 +1041,35 @@ class RealtimeFaceRecognition:
                     "best_match_confidence": stranger_data.get("best_match_confidence", 0.0)
                 }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.stranger_webhook_url, json=payload, timeout=5) as response:
-                    if response.status == 200:
-                        print(f"✅ 陌生人事件推送成功: {event_type}")
-                    else:
-                        print(f"❌ 陌生人事件推送失敗: {response.status}")
+            self.webhooks.submit('stranger', payload)
         except Exception as e:
             print(f"❌ 發送陌生人webhook時發生錯誤: {e}")
 
-    def check_recent_success_recognition(self, face_embedding, current_time):
+    async def remember_recent_embedding(self, person_id, current_time):
+        """將成功識別人員的 embedding 放入近期矩陣（每位人員進入時只查詢一次）"""
+        if self.recent_embeddings.touch(person_id, current_time):
+            return
+        try:
+            person_data = await face_db.get_person_by_id(person_id)
+            if person_data and person_data.get('embedding') is not None:
+                self.recent_embeddings.put(person_id, person_data.get('name', 'Unknown'),
+                                           person_data['embedding'], current_time)
+        except Exception as e:
+            print(f"載入人員embedding時發生錯誤: {e}")
+
+    async def check_recent_success_recognition(self, face_embedding, current_time):
         """檢查最近是否有成功識別記錄（防止員工誤判）"""
         try:
-            # 檢查最近30秒內是否有成功識別
+            # 檢查最近30秒內是否有成功識別：與近期人員 embedding 矩陣一次比對
             cutoff_time = current_time - self.recent_success_window
+            self.recent_embeddings.prune(cutoff_time)
             
-            for person_id, last_time in self.recent_recognitions.items():
-                if last_time > cutoff_time:
-                    # 檢查是否是同一個人（通過embedding相似度）
-                    try:
-                        # 從資料庫獲取該人員的embedding
-                        person_data = face_db.get_person_by_id(person_id)
-                        if person_data and 'embedding' in person_data:
-                            stored_embedding = np.array(person_data['embedding'])
-                            similarity = self.compute_face_similarity(face_embedding, stored_embedding)
-                            if similarity > 0.6:  # 相似度較高，可能是同一人
-                                print(f"🔍 檢測到可能是員工誤判: {person_data.get('name', 'Unknown')} (相似度: {similarity:.3f})")
-                                return True
-                    except Exception as e:
-                        print(f"檢查人員embedding時發生錯誤: {e}")
-                        continue
+            match = self.recent_embeddings.best_match(face_embedding, cutoff_time)
+            if match:
+                _, name, similarity = match
+                if similarity > 0.6:  # 相似度較高，可能是同一人
+                    print(f"🔍 檢測到可能是員工誤判: {name} (相似度: {similarity:.3f})")
+                    return True
             
             return False
         except Exception as e:
@@ -913,51 +1080,35 @@ class RealtimeFaceRecognition:
         """確認陌生人檢測（連續檢測機制）"""
         try:
             # 檢查最近是否有成功識別（防止員工誤判）
-            if self.check_recent_success_recognition(face_embedding, current_time):
+            if await self.check_recent_success_recognition(face_embedding, current_time):
                 print("🔍 最近有成功識別記錄，可能是員工誤判，不作為陌生人處理")
                 return False, None
             
-            # 尋找相似的已知陌生人候選
-            similar_hash = None
-            best_similarity = 0.0
-            for existing_hash, candidate_info in self.stranger_candidates.items():
-                similarity = np.dot(face_embedding, candidate_info['embedding'])
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                if similarity > 0.6:  # 降低到0.6閾值
-                    similar_hash = existing_hash
-                    print(f"🔍 找到相似陌生人候選 (相似度: {similarity:.3f})")
-                    break
-            
-            if not similar_hash and best_similarity > 0:
-                print(f"🔍 最高相似度: {best_similarity:.3f} (未達0.6閾值)")
+            # 淘汰超過冷卻期未出現的陌生人（同時自索引移除）
+            cutoff_time = current_time - self.stranger_confirm_window
+            self.state.expire(current_time)
+            
+            # 尋找相似的已知陌生人（LSH 分桶後只精確比對同桶的陌生人）
+            similar_hash, similarity = self.stranger_index.query(face_embedding, 0.6)
+            if similar_hash:
+                print(f"🔍 找到相似陌生人候選 (相似度: {similarity:.3f})")
+            elif similarity > 0:
+                print(f"🔍 最高相似度: {similarity:.3f} (未達0.6閾值)")
             
             # 如果找到相似的，使用現有hash；否則生成新hash
             if similar_hash:
                 face_hash = similar_hash
             else:
                 face_hash = self.generate_face_hash(face_embedding)
-                self.stranger_candidates[face_hash] = {
-                    'detections': [],
-                    'embedding': face_embedding.copy()
-                }
-            
-            # 添加當前檢測時間
-            self.stranger_candidates[face_hash]['detections'].append(current_time)
-            
-            # 清理過期的檢測記錄
-            cutoff_time = current_time - self.stranger_confirm_window
-            before_cleanup = len(self.stranger_candidates[face_hash]['detections'])
-            self.stranger_candidates[face_hash]['detections'] = [
-                t for t in self.stranger_candidates[face_hash]['detections'] 
-                if t > cutoff_time
-            ]
-            after_cleanup = len(self.stranger_candidates[face_hash]['detections'])
-            if before_cleanup > after_cleanup:
-                print(f"🧹 清理過期檢測: {before_cleanup} → {after_cleanup} (窗口: {self.stranger_confirm_window}秒)")
-            
-            # 檢查是否達到確認閾值
-            detection_count = len(self.stranger_candidates[face_hash]['detections'])
+                if face_hash in self.stranger_index:
+                    # 指紋相同但相似度未達門檻的不同人（極少見）
+                    face_hash = f"{face_hash}-{str(uuid.uuid4())[:8]}"
+                self.stranger_index.add(face_hash, face_embedding)
+            
+            # 添加當前檢測時間並計算視窗內的檢測次數
+            stranger_state = self.state.touch(STRANGER, face_hash, current_time)
+            stranger_state.detections.append(current_time)
+            detection_count = sum(1 for detected_time in stranger_state.detections if detected_time > cutoff_time)
             print(f"🔍 陌生人候選檢測: {detection_count}/{self.stranger_confirm_threshold}")
             
             if detection_count >= self.stranger_confirm_threshold:
@@ -976,172 +1127,192 @@ class RealtimeFaceRecognition:
             # 生成臨時訪客名稱
             temp_visitor_name = f"訪客_{datetime.now().strftime('%m%d_%H%M')}"
             
-            # 註冊到資料庫 (讓系統自動生成person_id)
-            success, message = face_db.register_face(
-                name=temp_visitor_name,
-                role="訪客",
-                department="臨時",
-                embedding=face_embedding,
-                employee_id=None,
-                email=""
-            )
+            # 註冊到資料庫；其他實例已註冊同一位陌生人時沿用其資料
+            temp_visitor_id, temp_visitor_name, created = await face_db.register_temp_visitor(
+                temp_visitor_name, face_embedding)
             
-            if success:
-                print(f"✅ 自動註冊臨時訪客: {temp_visitor_name}")
-                
-                # 從message解析person_id: "成功註冊 name（ID: person_id）"
-                import re
-                person_id_match = re.search(r'ID: ([^）]+)', message)
-                if person_id_match:
-                    temp_visitor_id = person_id_match.group(1)
+            if temp_visitor_id:
+                if created:
+                    print(f"✅ 自動註冊臨時訪客: {temp_visitor_name}")
                 else:
-                    temp_visitor_id = f"temp_visitor_{int(current_time)}"
+                    print(f"🔗 沿用已註冊的臨時訪客: {temp_visitor_name} ({temp_visitor_id})")
                 
-                # 記錄到臨時訪客管理
-                self.temp_visitors[temp_visitor_id] = {
-                    'registered_time': current_time,
-                    'embedding': face_embedding.copy(),
-                    'name': temp_visitor_name
-                }
-                
-                # 建立attendance session並取得UUID
-                session_uuid = face_db.log_attendance(temp_visitor_id)
-                
-                # 發送webhook通知 (API格式)
-                stranger_data = {
-                    'event': 'stranger_auto_registered',
-                    'session_uuid': session_uuid,
-                    'person_id': temp_visitor_id,
+                # 建立attendance session；webhook 於批次寫入後發送 (stranger_auto_registered)
+                self.presence.observe(temp_visitor_id, {
                     'name': temp_visitor_name,
-                    'department': '臨時',
-                    'role': '訪客',
-                    'employee_id': temp_visitor_id,
-                    'email': '',
-                    'status': 'active',
-                    'status_text': '陌生訪客',
-                    'arrival_time': datetime.now(TW_TZ).isoformat(),
-                    'last_seen_at': datetime.now(TW_TZ).isoformat(),
-                    'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S'),
-                    'camera_id': 'websocket_stream',
-                    'confidence': 0.12
-                }
-                await self.send_stranger_webhook(stranger_data)
+                    'is_temp_visitor': True
+                })
                 
                 return temp_visitor_id, temp_visitor_name
             else:
-                print(f"❌ 自動註冊失敗: {message}")
+                print("❌ 自動註冊臨時訪客失敗")
                 return None, None
                 
         except Exception as e:
             print(f"自動註冊臨時訪客時發生錯誤: {e}")
             return None, None
 
-    async def cleanup_temp_visitors(self):
-        """清理離開的臨時訪客"""
-        try:
-            current_time = time.time()
-            visitors_to_remove = []
-            
-            for temp_visitor_id, visitor_info in self.temp_visitors.items():
-                # 檢查最後活動時間
-                try:
-                    # 從attendance_sessions獲取最後活動時間
-                    cursor = face_db.conn.cursor()
-                    cursor.execute("""
-                        SELECT last_seen_at FROM attendance_sessions 
-                        WHERE person_id = %s AND status = 'active'
-                        ORDER BY last_seen_at DESC LIMIT 1
-                    """, (temp_visitor_id,))
-                    
-                    result = cursor.fetchone()
-                    cursor.close()
-                    
-                    if result:
-                        last_seen = result[0]
-                        if last_seen:
-                            # 轉換為時間戳
-                            last_seen_timestamp = last_seen.timestamp()
-                            
-                            # 如果超過5分鐘沒有活動，準備清理
-                            if current_time - last_seen_timestamp > self.temp_visitor_timeout:
-                                visitors_to_remove.append(temp_visitor_id)
-                                print(f"🧹 準備清理臨時訪客: {visitor_info['name']} (離開 {(current_time - last_seen_timestamp)/60:.1f} 分鐘)")
-                except Exception as e:
-                    print(f"檢查臨時訪客 {temp_visitor_id} 時發生錯誤: {e}")
-            
-            # 清理離開的臨時訪客
-            for temp_visitor_id in visitors_to_remove:
-                await self.remove_temp_visitor(temp_visitor_id)
-                
-        except Exception as e:
-            print(f"清理臨時訪客時發生錯誤: {e}")
+    async def sweep_lifecycle(self):
+        """
+        生命週期清理：以少數幾個集合式語句結束超時會話、刪除過期臨時訪客，
+        再依回傳的資料列批次發送離開通知
+        """
+        start = time.perf_counter()
+        now = taipei_now()
+        
+        # 先寫回已寫回值超時、但之後又出現過的會話，資料庫端才不會提早結束仍在場的人員
+        self.presence.checkpoint_idle(now)
+        await self.write_queue.flush()
+        
+        result = await face_db.sweep_lifecycle(
+            now,
+            session_timeout_seconds=self.presence.session_timeout.total_seconds(),
+            temp_visitor_timeout_seconds=self.temp_visitor_timeout
+        )
+        ended_sessions = result['ended_sessions']
+        removed_visitors = result['removed_visitors']
+        
+        self.presence.end(row['session_uuid'] for row in ended_sessions)
+        for row in removed_visitors:
+            self.presence.remove(row['person_id'])
+        
+        self.sweep_stats['sweeps'] += 1
+        self.sweep_stats['ended_sessions'] += len(ended_sessions)
+        self.sweep_stats['removed_visitors'] += len(removed_visitors)
+        self.sweep_stats['last_ended_sessions'] = len(ended_sessions)
+        self.sweep_stats['last_removed_visitors'] = len(removed_visitors)
+        self.sweep_stats['last_sweep_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        
+        if ended_sessions or removed_visitors:
+            print(f"🧹 生命週期清理: 結束 {len(ended_sessions)} 個會話，刪除 {len(removed_visitors)} 位臨時訪客 "
+                  f"({self.sweep_stats['last_sweep_ms']}ms)")
+            await self.send_departure_webhooks(ended_sessions, removed_visitors)
 
-    async def remove_temp_visitor(self, temp_visitor_id):
-        """移除臨時訪客的註冊記錄"""
-        try:
-            visitor_info = self.temp_visitors.get(temp_visitor_id)
-            if not visitor_info:
-                return
-            
-            # 結束attendance session
-            cursor = face_db.conn.cursor()
-            cursor.execute("""
-                UPDATE attendance_sessions 
-                SET status = 'ended', departure_time = CURRENT_TIMESTAMP
-                WHERE person_id = %s AND status = 'active'
-            """, (temp_visitor_id,))
-            
-            # 刪除人員註冊記錄
-            cursor.execute("""
-                DELETE FROM face_profiles WHERE person_id = %s
-            """, (temp_visitor_id,))
-            
-            face_db.conn.commit()
-            cursor.close()
-            
-            # 從記憶體中移除
-            del self.temp_visitors[temp_visitor_id]
-            
-            print(f"🧹 已清理臨時訪客: {visitor_info['name']}")
-            
-            # 發送離開通知
-            await self.send_stranger_webhook({
-                'event': 'temp_visitor_departed',
-                'temp_visitor_id': temp_visitor_id,
-                'name': visitor_info['name'],
-                'departure_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    async def send_departure_webhooks(self, ended_sessions, removed_visitors):
+        """依清理回傳的資料列批次發送離開通知"""
+        webhooks = []
+        for row in ended_sessions:
+            self.hub.publish('attendance', {
+                'type': 'attendance_update',
+                'event': 'departed',
+                'session_uuid': row['session_uuid'],
+                'person_id': row['person_id'],
+                'name': row['name'],
+                'departure_time': row['departure_time'].replace(tzinfo=TW_TZ).isoformat()
             })
-            
-        except Exception as e:
-            print(f"移除臨時訪客時發生錯誤: {e}")
+            if row['role'] == '訪客' and row['department'] == '臨時':
+                # 臨時訪客於刪除時才發送 temp_visitor_departed
+                continue
+            session_info = {
+                'session_uuid': row['session_uuid'],
+                'status': 'ended',
+                'arrival_time': row['arrival_time'].replace(tzinfo=TW_TZ).isoformat(),
+                'last_seen_at': row['last_seen_at'].replace(tzinfo=TW_TZ).isoformat(),
+                'departure_time': row['departure_time'].replace(tzinfo=TW_TZ).isoformat()
+            }
+            if row['role'] == '訪客':
+                webhooks.append(self.send_stranger_webhook({
+                    'event': 'visitor_departed',
+                    'person_id': row['person_id'],
+                    'name': row['name'],
+                    'department': row['department'],
+                    'role': row['role'],
+                    **session_info,
+                    'timestamp': datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S'),
+                    'camera_id': 'websocket_stream'
+                }))
+            else:
+                webhooks.append(self.send_employee_webhook(row, "departed", session_info=session_info))
+        
+        for row in removed_visitors:
+            departure_time = row['last_seen_at'] or taipei_now()
+            webhooks.append(self.send_stranger_webhook({
+                'event': 'temp_visitor_departed',
+                'temp_visitor_id': row['person_id'],
+                'name': row['name'],
+                'departure_time': departure_time.strftime('%Y-%m-%d %H:%M:%S')
+            }))
+        
+        await asyncio.gather(*webhooks, return_exceptions=True)
+
+    def on_state_evicted(self, record, reason):
+        """狀態到期或超過上限被淘汰：陌生人同時自 LSH 索引移除"""
+        if record.kind == STRANGER:
+            self.stranger_index.remove(record.key)
+
+    def forget_stranger(self, face_hash):
+        """移除陌生人紀錄與索引列（主動移除不經淘汰回呼）"""
+        self.state.pop(STRANGER, face_hash)
+        self.stranger_index.remove(face_hash)
 
     def clear_related_stranger_candidates(self, face_embedding):
         """清除與當前人臉相關的陌生人候選（員工從遠處走近被正確識別後）"""
         try:
-            to_remove = []
-            for existing_hash, candidate_info in self.stranger_candidates.items():
-                similarity = np.dot(face_embedding, candidate_info['embedding'])
-                if similarity > 0.4:  # 與員工識別閾值一致
-                    candidate_count = len(candidate_info['detections'])
-                    print(f"🧹 清除相關陌生人候選: 相似度{similarity:.3f}, 已累積{candidate_count}/5")
-                    to_remove.append(existing_hash)
-            
-            # 清除相關候選
-            for hash_to_remove in to_remove:
-                del self.stranger_candidates[hash_to_remove]
+            cutoff_time = time.time() - self.stranger_confirm_window
+            # 與員工識別閾值一致；0.4 時分桶召回不足，精確比對所有陌生人
+            for face_hash, similarity in self.stranger_index.similar(face_embedding, 0.4):
+                stranger_state = self.state.get(STRANGER, face_hash)
+                candidate_count = sum(1 for detected_time in stranger_state.detections
+                                      if detected_time > cutoff_time) if stranger_state else 0
+                self.forget_stranger(face_hash)
+                print(f"🧹 清除相關陌生人候選: 相似度{similarity:.3f}, 已累積{candidate_count}/{self.stranger_confirm_threshold}")
                 
         except Exception as e:
             print(f"清除陌生人候選時發生錯誤: {e}")
 
-    async def start_cleanup_task(self):
-        """啟動清理任務"""
+    async def start_sweeper_task(self):
+        """定期執行生命週期清理"""
+        while True:
+            try:
+                await asyncio.sleep(self.sweep_interval)
+                # 租約在 3 個週期內未續約才會由其他實例接手
+                self.leader_tasks['sweeper'] = await self.leases.try_acquire(
+                    'leader:sweeper', self.sweep_interval * 3)
+                if self.leader_tasks['sweeper']:
+                    await self.sweep_lifecycle()
+                    await self.leases.purge_expired()
+                else:
+                    # 由其他實例清理；對方的清理時間點未知，寫回在下一個週期前就會超時的會話
+                    self.presence.checkpoint_idle(taipei_now(), timedelta(seconds=self.sweep_interval))
+                    await self.write_queue.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.sweep_stats['errors'] += 1
+                print(f"生命週期清理發生錯誤: {e}")
+
+    async def start_stats_task(self):
+        """定期推送統計資料給訂閱 stats 主題的客戶端（沒有訂閱者時不計算）"""
         while True:
+            await asyncio.sleep(self.stats_publish_interval)
             try:
-                await asyncio.sleep(60)  # 每分鐘檢查一次
-                await self.cleanup_temp_visitors()
+                if self.hub.has_subscribers('stats'):
+                    self.hub.publish('stats', self.stats_snapshot())
             except Exception as e:
-                print(f"清理任務發生錯誤: {e}")
-                await asyncio.sleep(60)
+                print(f"推送統計資料發生錯誤: {e}")
+
+    async def start_partition_task(self):
+        """定期維護識別日誌分區"""
+        while True:
+            try:
+                self.leader_tasks['partitions'] = await self.leases.try_acquire(
+                    'leader:partitions', self.partition_maintenance_interval * 2)
+                if self.leader_tasks['partitions']:
+                    dropped = await face_db.maintain_recognition_log_partitions(
+                        self.partition_days_ahead, self.log_retention_days)
+                    if dropped:
+                        print(f"🗑️ 已刪除過期識別日誌分區: {', '.join(dropped)}")
+                    purged = await face_db.purge_processed_events(self.outbox_retention_days)
+                    if purged:
+                        print(f"🗑️ 已刪除 {purged} 筆處理完成的外寄匣事件")
+                    purged = await face_db.purge_attendance_changes(self.attendance_changes_retention_hours)
+                    if purged:
+                        print(f"🗑️ 已刪除 {purged} 筆過期的出勤變更紀錄")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"識別日誌分區維護發生錯誤: {e}")
+            await asyncio.sleep(self.partition_maintenance_interval)
 
     async def handle_stranger_detection(self, face_embedding, current_time, confidence_info=None):
         """處理陌生人檢測和去重"""
@@ -1152,12 +1323,16 @@ class RealtimeFaceRecognition:
             if stranger_info:
                 # 更新已知陌生人的最後見到時間
                 stranger_info['last_seen'] = current_time
+                self.state.touch(STRANGER, face_hash, current_time)
                 print(f"🔄 更新陌生人記錄: {stranger_info['uuid']}")
                 return stranger_info['uuid'], False  # 返回UUID和是否為新陌生人
             else:
                 # 發現新陌生人
                 stranger_uuid = str(uuid.uuid4())
                 face_hash = self.generate_face_hash(face_embedding)
+                if face_hash in self.stranger_index:
+                    # 指紋相同但相似度未達門檻的不同人（極少見）
+                    face_hash = f"{face_hash}-{stranger_uuid[:8]}"
                 
                 stranger_data = {
                     'uuid': stranger_uuid,
@@ -1168,10 +1343,12 @@ class RealtimeFaceRecognition:
                     'best_match_confidence': confidence_info.get('best_match_confidence', 0.0) if confidence_info else 0.0
                 }
                 
-                self.stranger_faces[face_hash] = stranger_data
+                self.stranger_index.add(face_hash, face_embedding)
+                self.state.touch(STRANGER, face_hash, current_time).data = stranger_data
                 
-                # 發送webhook通知
-                await self.send_stranger_webhook(stranger_data)
+                # 發送webhook通知（其他實例在冷卻期內已通知同一指紋的陌生人則略過）
+                if await self.leases.try_acquire(f"stranger:{face_hash}", self.stranger_cooldown):
+                    await self.send_stranger_webhook(stranger_data)
                 
                 print(f"🆕 發現新陌生人: {stranger_uuid}")
                 return stranger_uuid, True  # 返回UUID和是否為新陌生人
@@ -1191,11 +1368,11 @@ class RealtimeFaceRecognition:
             image_data = data.get('image')
             
             if not all([name, role, image_data]):
-                await websocket.send(json.dumps({
+                self.hub.send(websocket, {
                     'type': 'register_result',
                     'success': False,
                     'message': '缺少必要資料'
-                }))
+                })
                 return
             
             # 解碼圖片
@@ -1210,11 +1387,11 @@ class RealtimeFaceRecognition:
             faces = face_app.get(cv_image)
             
             if len(faces) == 0:
-                await websocket.send(json.dumps({
+                self.hub.send(websocket, {
                     'type': 'register_result',
                     'success': False,
                     'message': '未檢測到人臉'
-                }))
+                })
                 return
             
             # 如果檢測到多張人臉，自動選擇最大的（通常是主要目標）
@@ -1223,29 +1400,29 @@ class RealtimeFaceRecognition:
                 # 按人臉大小排序，選擇最大的
                 faces = sorted(faces, key=lambda f: (f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]), reverse=True)
                 
-                await websocket.send(json.dumps({
+                self.hub.send(websocket, {
                     'type': 'register_info',
                     'message': f'檢測到 {len(faces)} 張人臉，已自動選擇最大的進行註冊'
-                }))
+                })
             
             # 註冊最大的人臉
             embedding = faces[0].normed_embedding
             face_area = (faces[0].bbox[2] - faces[0].bbox[0]) * (faces[0].bbox[3] - faces[0].bbox[1])
             print(f"[{datetime.now(TW_TZ).strftime('%H:%M:%S')}] 註冊人臉大小: {face_area:.0f} 像素")
-            success, message = face_db.register_face(name, role, department, embedding, employee_id, email)
+            success, message = await face_db.register_face(name, role, department, embedding, employee_id, email)
             
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'register_result',
                 'success': success,
                 'message': message
-            }))
+            })
             
         except Exception as e:
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'register_result',
                 'success': False,
                 'message': f'註冊錯誤: {str(e)}'
-            }))
+            })
 
     async def get_attendance_logs(self, websocket):
         """取得出勤記錄"""
@@ -1253,36 +1430,21 @@ class RealtimeFaceRecognition:
             import pytz
             taipei_tz = pytz.timezone('Asia/Taipei')
             
-            if hasattr(face_db, 'use_postgres') and not face_db.use_postgres:
-                await websocket.send(json.dumps({
+            if not face_db.use_postgres:
+                self.hub.send(websocket, {
                     'type': 'attendance_list',
                     'success': True,
                     'data': []
-                }))
+                })
                 return
             
-            cursor = face_db.conn.cursor()
-            cursor.execute("""
-                SELECT 
-                    p.name,
-                    p.department,
-                    p.role,
-                    s.status,
-                    s.arrival_time,
-                    s.departure_time,
-                    s.last_seen_at,
-                    s.person_id
-                FROM attendance_sessions s
-                JOIN face_profiles p ON s.person_id = p.person_id
-                ORDER BY s.last_seen_at DESC 
-                LIMIT 100
-            """)
-            logs = cursor.fetchall()
-            cursor.close()
+            logs = await face_db.get_attendance_sessions(limit=100)
             
             result = []
             for log in logs:
-                name, department, role, status, arrival, departure, last_seen, person_id = log
+                name, department, role = log['name'], log['department'], log['role']
+                status, person_id = log['status'], log['person_id']
+                arrival, departure, last_seen = log['arrival_time'], log['departure_time'], log['last_seen_at']
                 
                 # 確保時間都有時區資訊
                 if arrival and arrival.tzinfo is None:
@@ -1335,55 +1497,54 @@ class RealtimeFaceRecognition:
                     'role': role
                 })
             
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'attendance_list',
                 'success': True,
                 'data': result
-            }))
+            })
             
         except Exception as e:
             print(f"取得出勤記錄錯誤: {e}")
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'error',
                 'message': f'取得出勤記錄失敗: {str(e)}'
-            }))
+            })
 
     async def clear_attendance_logs(self, websocket):
         """清除出勤記錄"""
         try:
-            if hasattr(face_db, 'use_postgres') and not face_db.use_postgres:
-                await websocket.send(json.dumps({
+            if not face_db.use_postgres:
+                self.hub.send(websocket, {
                     'type': 'clear_attendance_result',
                     'success': False,
                     'message': 'JSON模式不支援清除功能'
-                }))
+                })
                 return
             
-            cursor = face_db.conn.cursor()
-            cursor.execute("DELETE FROM attendance_sessions")
-            face_db.conn.commit()
-            cursor.close()
+            await face_db.clear_attendance_sessions()
             
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'clear_attendance_result',
                 'success': True,
                 'message': '出勤記錄清除成功'
-            }))
+            })
             
         except Exception as e:
             print(f"清除出勤記錄錯誤: {e}")
-            await websocket.send(json.dumps({
+            self.hub.send(websocket, {
                 'type': 'clear_attendance_result',
                 'success': False,
                 'message': f'清除失敗: {str(e)}'
-            }))
+            })
 
 async def main():
     """啟動 WebSocket 伺服器"""
+    await face_db.connect()
     recognizer = RealtimeFaceRecognition()
     
-    # 從環境變數讀取端口
+    # 從環境變數讀取端口；WEBSOCKET_WORKERS > 1 時多個程序以 SO_REUSEPORT 共用同一端口
     ws_port = int(os.getenv('WEBSOCKET_PORT', 7861))
+    reuse_port = int(os.getenv('WEBSOCKET_WORKERS', 1)) > 1
     
     print("🚀 啟動 WebSocket 即時人臉識別伺服器...")
     print(f"📡 WebSocket 伺服器位址: ws://localhost:{ws_port}")
@@ -1395,18 +1556,53 @@ async def main():
         max_size=10 * 1024 * 1024,  # 10MB 消息大小限制
         ping_interval=None,         # 關閉自動心跳，改由客戶端處理
         ping_timeout=None,          # 關閉心跳超時
-        close_timeout=10            # 10秒關閉超時
+        close_timeout=10,           # 10秒關閉超時
+        reuse_port=reuse_port,      # 由核心在各程序間分配新連線
+        process_request=recognizer.process_http_request  # GET /metrics
     )
     
-    await start_server
+    server = await start_server
     print("✅ WebSocket 伺服器已啟動")
     
-    # 啟動清理任務
-    cleanup_task = asyncio.create_task(recognizer.start_cleanup_task())
-    print("🧹 臨時訪客清理任務已啟動")
+    # 從資料庫重建在席狀態，並啟動延後寫入任務
+    await recognizer.presence.load(face_db)
+    recognizer.write_queue.start()
+    print("💾 延後寫入佇列與在席狀態機已啟動")
+    recognizer.webhooks.start()
+    if recognizer.hub.relay:
+        await recognizer.hub.relay.start()
+        print("📡 跨實例廣播轉送已啟動")
+    
+    # 啟動生命週期清理任務
+    sweeper_task = asyncio.create_task(recognizer.start_sweeper_task())
+    print(f"🧹 生命週期清理任務已啟動 (每 {recognizer.sweep_interval} 秒)")
+    partition_task = asyncio.create_task(recognizer.start_partition_task())
+    stats_task = None
+    if recognizer.stats_publish_interval > 0:
+        stats_task = asyncio.create_task(recognizer.start_stats_task())
+        print(f"📊 統計推送任務已啟動 (每 {recognizer.stats_publish_interval:g} 秒)")
     
-    # 保持伺服器運行
-    await asyncio.Future()  # run forever
+    # 收到 SIGTERM/SIGINT 時結束，並寫入佇列中剩餘的紀錄
+    stop = asyncio.Future()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    
+    try:
+        await stop
+    finally:
+        print("🛑 正在關閉 WebSocket 伺服器...")
+        server.close()
+        await server.wait_closed()
+        sweeper_task.cancel()
+        partition_task.cancel()
+        if stats_task:
+            stats_task.cancel()
+        await recognizer.write_queue.close()
+        await recognizer.webhooks.close()
+        if recognizer.hub.relay:
+            await recognizer.hub.relay.close()
+        await face_db.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+識別結果的延後寫入佇列 (write-behind)
+識別結果先回傳給客戶端，資料庫副作用在背景合併後批次寫入
+"""
+
+import os
+import time
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+# 台灣時區（資料表使用不含時區的 TIMESTAMP，以台北當地時間儲存）
+TW_TZ = timezone(timedelta(hours=8))
+
+
+def taipei_now():
+    """取得台北當地時間（naive），與資料表的 TIMESTAMP 欄位一致"""
+    return datetime.now(TW_TZ).replace(tzinfo=None)
+
+
+class WriteBehindQueue:
+    """合併識別日誌與出勤會話變更，每 N 毫秒或累積 M 筆時批次寫入"""
+
+    def __init__(self, db, on_new_sessions=None, on_sessions_lost=None, on_sessions_adopted=None,
+                 flush_interval_ms=None, max_batch=None, max_pending=None):
+        self.db = db
+        # 新會話寫入後的回呼：on_new_sessions([(session, info), ...])
+        self.on_new_sessions = on_new_sessions
+        # 更新時發現會話已不存在或已被結束的回呼：on_sessions_lost([session_uuid, ...])
+        self.on_sessions_lost = on_sessions_lost
+        # 開啟時資料庫已有該人員的活躍會話（例如其他程序寫入），改用既有會話的回呼：
+        # on_sessions_adopted([(本地 session_uuid, 既有 session_uuid, 既有 arrival_time), ...])
+        self.on_sessions_adopted = on_sessions_adopted
+        self.flush_interval = (flush_interval_ms if flush_interval_ms is not None
+                               else int(os.getenv('WRITE_BEHIND_FLUSH_MS', 200))) / 1000
+        self.max_batch = max_batch or int(os.getenv('WRITE_BEHIND_MAX_BATCH', 500))
+        self.max_pending = max_pending or int(os.getenv('WRITE_BEHIND_MAX_PENDING', 10000))
+
+        self.recognition_logs = []  # [(person_id, recognized_name, confidence, image_source, recognition_time)]
+        # 出勤會話變更，皆以 session_uuid 為鍵合併
+        self.session_opens = {}  # {session_uuid: (session, info)}
+        self.session_touches = {}  # {session_uuid: last_seen_at}
+        self.session_closes = {}  # {session_uuid: departure_time}
+
+        self.stats = {
+            'enqueued': 0,
+            'flushed_logs': 0,
+            'flushed_sessions': 0,
+            'batches': 0,
+            'dropped': 0,
+            'backpressure': 0,
+            'flush_errors': 0,
+            'last_flush_ms': 0.0
+        }
+
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._callback_tasks = set()
+        self._closed = False
+
+    @property
+    def pending(self):
+        return (len(self.recognition_logs) + len(self.session_opens)
+                + len(self.session_touches) + len(self.session_closes))
+
+    def start(self):
+        """啟動背景寫入任務"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue_recognition(self, person_id, recognized_name, confidence, image_source="unknown"):
+        """加入一筆識別日誌"""
+        if not self._admit():
+            return
+        self.recognition_logs.append((person_id, recognized_name, float(confidence), image_source, taipei_now()))
+        self._after_enqueue()
+
+    def enqueue_session_open(self, session, info=None):
+        """加入一筆新出勤會話"""
+        if not self._admit():
+            return
+        self.session_opens[session['session_uuid']] = (dict(session), info or {})
+        self._after_enqueue()
+
+    def enqueue_session_touch(self, session_uuid, last_seen_at):
+        """更新會話的 last_seen_at；同一會話只保留最新值"""
+        if session_uuid in self.session_opens:
+            self.session_opens[session_uuid][0]['last_seen_at'] = last_seen_at
+            return
+        if session_uuid not in self.session_touches and not self._admit():
+            return
+        self.session_touches[session_uuid] = last_seen_at
+        self._after_enqueue()
+
+    def enqueue_session_close(self, session_uuid, departure_time):
+        """結束會話（departure_time 同時作為最後出現時間）"""
+        if session_uuid not in self.session_closes and not self._admit():
+            return
+        self.session_touches.pop(session_uuid, None)
+        self.session_closes[session_uuid] = departure_time
+        self._after_enqueue()
+
+    def _admit(self):
+        """超過記憶體上限時丟棄新紀錄"""
+        if self._closed or self.pending >= self.max_pending:
+            self.stats['dropped'] += 1
+            if self.stats['dropped'] % 1000 == 1:
+                print(f"⚠️ 寫入佇列已滿 ({self.pending})，丟棄紀錄 (累計 {self.stats['dropped']})")
+            return False
+        return True
+
+    def _after_enqueue(self):
+        self.stats['enqueued'] += 1
+        if self.pending >= self.max_batch:
+            # 累積筆數達上限，立即觸發寫入
+            self.stats['backpressure'] += 1
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """將目前累積的紀錄寫入資料庫"""
+        async with self._flush_lock:
+            if not self.pending:
+                return
+
+            logs, self.recognition_logs = self.recognition_logs, []
+            batch = (self.session_opens, self.session_touches, self.session_closes)
+            self.session_opens, self.session_touches, self.session_closes = {}, {}, {}
+
+            if not self.db.use_postgres:
+                # JSON 模式不記錄日誌與出勤
+                return
+
+            start = time.perf_counter()
+            try:
+                new_sessions, lost_sessions, adopted_sessions = await self._write(logs, *batch)
+            except Exception as e:
+                self.stats['flush_errors'] += 1
+                print(f"批次寫入錯誤: {e}")
+                self._requeue(logs, *batch)
+                return
+
+            self.stats['batches'] += 1
+            self.stats['flushed_logs'] += len(logs)
+            self.stats['flushed_sessions'] += sum(len(part) for part in batch)
+            self.stats['last_flush_ms'] = round((time.perf_counter() - start) * 1000, 2)
+
+            if adopted_sessions:
+                self._rename_pending(adopted_sessions)
+                if self.on_sessions_adopted:
+                    self.on_sessions_adopted(adopted_sessions)
+            if lost_sessions and self.on_sessions_lost:
+                self.on_sessions_lost(lost_sessions)
+            if new_sessions and self.on_new_sessions:
+                task = asyncio.create_task(self.on_new_sessions(new_sessions))
+                self._callback_tasks.add(task)
+                task.add_done_callback(self._callback_tasks.discard)
+
+    async def _write(self, logs, opens, touches, closes):
+        """在單一交易中寫入識別日誌 (COPY)、出勤會話的開啟/更新/結束與對應的外寄匣事件"""
+        # outbox 依賴本模組的 taipei_now，延後匯入避免循環匯入
+        from outbox import arrival_event, departure_event, write_events
+
+        new_sessions = []
+        closed_sessions = []
+        lost_sessions = []
+        adopted_sessions = []
+        # 同批次內開啟又結束的會話直接以 ended 寫入；其餘結束（含重新進場前的舊會話）先於開啟執行，
+        # 如此每位人員在開啟時最多只有一筆 active，不會違反部分唯一索引
+        ended_opens = {u: opens[u] for u in closes if u in opens}
+        active_opens = {u: o for u, o in opens.items() if u not in closes}
+        early_closes = {u: t for u, t in closes.items() if u not in opens}
+
+        async with self.db.pool.acquire() as conn:
+            async with conn.transaction():
+                if logs:
+                    await conn.copy_records_to_table(
+                        'recognition_logs',
+                        records=logs,
+                        columns=['person_id', 'recognized_name', 'confidence', 'image_source', 'recognition_time']
+                    )
+
+                if early_closes:
+                    closed_sessions.extend(await self._close_sessions(conn, early_closes))
+
+                if ended_opens:
+                    sessions = [session for session, _ in ended_opens.values()]
+                    rows = await conn.fetch("""
+                        INSERT INTO attendance_sessions
+                            (session_uuid, person_id, arrival_time, last_seen_at, departure_time, status)
+                        SELECT s.session_uuid, s.person_id, s.arrival_time, s.departure_time, s.departure_time, 'ended'
+                        FROM unnest($1::varchar[], $2::varchar[], $3::timestamp[], $4::timestamp[])
+                            AS s(session_uuid, person_id, arrival_time, departure_time)
+                        WHERE EXISTS (SELECT 1 FROM face_profiles f WHERE f.person_id = s.person_id)
+                        RETURNING session_uuid
+                    """, [s['session_uuid'] for s in sessions],
+                        [s['person_id'] for s in sessions],
+                        [s['arrival_time'] for s in sessions],
+                        [max(s['last_seen_at'], closes[s['session_uuid']]) for s in sessions])
+
+                    written = {row['session_uuid'] for row in rows}
+                    for session_uuid, (session, info) in ended_opens.items():
+                        if session_uuid in written:
+                            new_sessions.append((session, info))
+                    closed_sessions.extend(written)
+
+                if active_opens:
+                    sessions = [session for session, _ in active_opens.values()]
+                    rows = await conn.fetch("""
+                        INSERT INTO attendance_sessions (session_uuid, person_id, arrival_time, last_seen_at, status)
+                        SELECT s.session_uuid, s.person_id, s.arrival_time, s.last_seen_at, 'active'
+                        FROM unnest($1::varchar[], $2::varchar[], $3::timestamp[], $4::timestamp[])
+                            AS s(session_uuid, person_id, arrival_time, last_seen_at)
+                        WHERE EXISTS (SELECT 1 FROM face_profiles f WHERE f.person_id = s.person_id)
+                        ON CONFLICT (person_id) WHERE status = 'active'
+                        DO UPDATE SET last_seen_at = GREATEST(attendance_sessions.last_seen_at, EXCLUDED.last_seen_at)
+                        RETURNING session_uuid, person_id, arrival_time, (xmax = 0) AS is_new
+                    """, [s['session_uuid'] for s in sessions],
+                        [s['person_id'] for s in sessions],
+                        [s['arrival_time'] for s in sessions],
+                        [s['last_seen_at'] for s in sessions])
+
+                    by_person = {row['person_id']: row for row in rows}
+                    for session_uuid, (session, info) in active_opens.items():
+                        row = by_person.get(session['person_id'])
+                        if row is None:
+                            # 人員已被刪除
+                            lost_sessions.append(session_uuid)
+                        elif row['is_new']:
+                            new_sessions.append((session, info))
+                        else:
+                            # 資料庫已有活躍會話，沿用既有會話，不視為新進場
+                            adopted_sessions.append((session_uuid, row['session_uuid'], row['arrival_time']))
+
+                if touches:
+                    session_uuids = list(touches.keys())
+                    rows = await conn.fetch("""
+                        UPDATE attendance_sessions a
+                        SET last_seen_at = GREATEST(a.last_seen_at, t.last_seen_at)
+                        FROM unnest($1::varchar[], $2::timestamp[]) AS t(session_uuid, last_seen_at)
+                        WHERE a.session_uuid = t.session_uuid AND a.status = 'active'
+                        RETURNING a.session_uuid
+                    """, session_uuids, [touches[u] for u in session_uuids])
+
+                    updated = {row['session_uuid'] for row in rows}
+                    lost_sessions.extend(u for u in session_uuids if u not in updated)
+
+                # 進場與離開事件和出勤變更一起提交；臨時訪客的離開於清理刪除時才寫入
+                events = [arrival_event(session, info) for session, info in new_sessions]
+                if closed_sessions:
+                    rows = await conn.fetch("""
+                        SELECT a.session_uuid, a.person_id, f.name, f.role, f.department,
+                               a.arrival_time, a.departure_time
+                        FROM attendance_sessions a
+                        JOIN face_profiles f ON f.person_id = a.person_id
+                        WHERE a.session_uuid = ANY($1::varchar[])
+                        AND NOT (f.role = '訪客' AND f.department = '臨時')
+                    """, closed_sessions)
+                    events.extend(departure_event(row) for row in rows)
+                await write_events(conn, events)
+
+        return new_sessions, lost_sessions, adopted_sessions
+
+    async def _close_sessions(self, conn, closes):
+        """結束會話，回傳實際由 active 轉為 ended 的 session_uuid"""
+        session_uuids = list(closes.keys())
+        rows = await conn.fetch("""
+            UPDATE attendance_sessions a
+            SET status = 'ended', departure_time = c.departure_time,
+                last_seen_at = GREATEST(a.last_seen_at, c.departure_time)
+            FROM unnest($1::varchar[], $2::timestamp[]) AS c(session_uuid, departure_time)
+            WHERE a.session_uuid = c.session_uuid AND a.status = 'active'
+            RETURNING a.session_uuid
+        """, session_uuids, [closes[u] for u in session_uuids])
+        return [row['session_uuid'] for row in rows]
+
+    def _rename_pending(self, adopted_sessions):
+        """寫入期間新加入的變更若指向被沿用的本地會話，改指向既有會話"""
+        for local_uuid, session_uuid, _ in adopted_sessions:
+            if local_uuid in self.session_touches:
+                self.session_touches[session_uuid] = self.session_touches.pop(local_uuid)
+            if local_uuid in self.session_closes:
+                self.session_closes[session_uuid] = self.session_closes.pop(local_uuid)
+
+    def _requeue(self, logs, opens, touches, closes):
+        """寫入失敗時放回佇列，下次重試（仍受記憶體上限約束）"""
+        room = max(self.max_pending - self.pending, 0)
+        kept_logs = logs[-room:] if room else []
+        self.stats['dropped'] += len(logs) - len(kept_logs)
+        self.recognition_logs = kept_logs + self.recognition_logs
+
+        # 會話變更數量受在場人數限制，全部放回（新的變更優先）
+        self.session_opens = {**opens, **self.session_opens}
+        self.session_touches = {**touches, **self.session_touches}
+        self.session_closes = {**closes, **self.session_closes}
+
+    async def close(self):
+        """停止背景任務並寫入剩餘紀錄"""
+        self._closed = True
+        if self._task:
+            # 喚醒背景任務，讓它完成最後一輪寫入後結束
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._callback_tasks:
+            await asyncio.gather(*self._callback_tasks, return_exceptions=True)
+        print(f"💾 寫入佇列已關閉 (批次 {self.stats['batches']}，丟棄 {self.stats['dropped']})")